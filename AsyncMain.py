@@ -0,0 +1,319 @@
+from quart import Quart, request
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import random
+import sys
+import threading
+import time
+
+from Event import *
+from EventSubscriber import *
+from Backend import StatusCode, StageTimer, compute_token, verify_transaction, check_fraud, fulfill_transaction, close_merchant_ledger, \
+    submit_authorisation, configure_authorisation_batching, close_authorisation_batchers, count_retry
+from CustomExceptions import LoggingTransactionError, IdempotencyKeyReuseError
+from RetryQueue import RetryQueue
+from Router import ShardRouter
+from ServiceClient import http_get, configure_clients, close_clients
+from AsyncServiceClient import async_http_get, async_http_post, configure_async_clients, close_async_clients
+from EventQueue import EventQueue
+from EventLog import EventLog
+from EventWorkers import EventWorkerPool
+from IdempotencyCache import IdempotencyCache
+from TransactionCache import transaction_cache
+from Metrics import instrument_app
+from Tracing import configure_tracing, close_tracing, trace_app
+from StructuredLogging import configure_logging
+from MainService import EventBroker, set_up_parser, register_component_metrics
+
+'''
+Asyncio version of the main service
+
+Same endpoints and payment workflow as main.py, but the critical path is awaitable: the database
+insert uses a non-blocking http client and backoff, the issuer authorisation awaits the shared
+authorisation batcher, and the merchant fulfillment runs on a worker thread. A slow issuer therefore
+holds a coroutine rather than a thread.
+Side effects still go through the threaded EventBroker and RetryQueue. The blocking calls left on
+the critical path run on a pool of -blocking_threads threads rather than asyncio's small default one,
+and calls to other services share -async_pool_size connections per upstream
+
+Runs on Quart's ASGI server with the same arguments as main.py: python AsyncMain.py -database_server ... -issuer_server ...
+'''
+logger = logging.getLogger(__name__)
+configure_logging("logs/api_logs.jsonl", service="main")
+
+def check_database_availability():
+    for database_server in router.servers():
+        response = http_get(f"{database_server}/status")
+        if response.status_code != 200:
+            return StatusCode.FAILURE
+    return StatusCode.SUCCESS
+
+async def log_transaction(transaction_json):
+    token = transaction_json["token"]
+    async with router.writing_async([token]) as ring:
+        database_server = ring.get_server(token)
+        for retry_attempt in range(3):
+            try:
+                response = await async_http_post(f"{database_server}/txn", json=transaction_json)
+                if response.status_code == 200:
+                    return response.json()["transaction_id"]
+                else:
+                    raise LoggingTransactionError
+            except Exception as e:
+                logger.warning(f"Attempt {retry_attempt + 1}: Error logging transaction in database: {e}")
+                if retry_attempt != 2:
+                    count_retry("insert")
+                    delay = random.randint(0, 2 ** (retry_attempt + 1))
+                    logger.warning(f"Delaying for {delay} seconds before retrying")
+                    await asyncio.sleep(delay)
+                else:
+                    logger.warning(f"All attempts at logging transaction failed.")
+    return None
+
+#publishing does not wait for the event log write, only a full event queue needs a thread to wait on
+async def publish_event(event):
+    event = EventBroker.log_event(event)
+    if not EventBroker.event_queue.put(event, timeout=0):
+        await asyncio.to_thread(EventBroker.event_queue.put, event)
+
+#concurrent authorisations are batched by the same issuer batcher as main.py, the coroutine waits on its future
+async def get_authorisation(payer:str, payee:str, amount:float) -> StatusCode:
+    return await asyncio.wrap_future(submit_authorisation(payer, payee, amount, issuer_server))
+
+#endpoint setup
+app = Quart(__name__)
+instrument_app(app)
+trace_app(app, start_traces=True)
+@app.route("/v1/status", methods=["GET"])
+async def get_server_status():
+    return {"status": "running"}, 200
+
+@app.route("/v1/token", methods=["GET"])
+async def compute_transaction_token():
+    nonce = request.args.get("nonce")
+    token = compute_token(nonce)
+    return {"message": "Token successfully registered", "token":token}, 200
+
+@app.route("/v1/txn", methods=["POST"])
+async def create_transaction():
+    info = await request.get_json()
+    payer, payee = info["payer"], info["payee"]
+    amount = float(info["amount"])
+    token = info["token"]
+    webhook = info["webhook"]
+    try:
+        response, replayed = await idempotency_cache.execute_async(
+            token,
+            [payer, payee, amount],
+            lambda: process_transaction(payer, payee, amount, token, webhook),
+            cacheable=lambda response: response[0]["transaction_id"] is not None
+        )
+    except IdempotencyKeyReuseError as e:
+        return {"message": f"{e}", "transaction_id": None, "details": None}, 422
+    if replayed:
+        return response[0], response[1], {"Idempotent-Replayed": "true"}
+    return response
+
+async def process_transaction(payer, payee, amount, token, webhook):
+    timer = StageTimer()
+    transaction_json = {
+        "payer": payer,
+        "payee": payee,
+        "amount": amount,
+        "token": token
+    }
+
+    transaction_id = await log_transaction(transaction_json)
+    timer.mark("insert")
+    if transaction_id == None:
+        logger.warning(f"{time.time()}: Error creating transaction. Details: payer:{payer}, payee:{payee}, amount:{amount}, token:{token}")
+        return {"message": "Failure creating transaction, please try again later", "transaction_id":None, "details":None}, 500, timer.headers()
+
+    http_response = {
+        "message": "",
+        "transaction_id": transaction_id,
+        "details": {
+            "payer": payer,
+            "payee": payee,
+            "amount": amount,
+            "token": token
+        }
+    }
+    #snapshot carried by the events, so subscribers do not fetch the transaction back from the database
+    details = snapshot(http_response["details"])
+    await publish_event(CreatedEvent(transaction_id, details))
+    timer.mark("publish")
+
+    #verify transaction
+    status = verify_transaction(payer, payee, amount)
+    timer.mark("verify")
+    if status == StatusCode.FAILURE:
+        await publish_event(RejectedEvent(transaction_id, details))
+        http_response["message"] = "transaction verification error"
+        return http_response, 500, timer.headers()
+
+    await publish_event(VerifiedEvent(transaction_id, details))
+    timer.mark("publish")
+
+    #check for fraud
+    status = check_fraud(payer, payee, amount)
+    timer.mark("fraud")
+    if status == StatusCode.FAILURE:
+        await publish_event(RejectedEvent(transaction_id, details))
+        http_response["message"] = "transaction fraud error"
+        return http_response, 500, timer.headers()
+
+    await publish_event(CheckedEvent(transaction_id, details))
+    timer.mark("publish")
+
+    #get authorisation from issuer
+    status = await get_authorisation(payer, payee, amount)
+    timer.mark("authorise")
+    if status == StatusCode.FAILURE:
+        await publish_event(RejectedEvent(transaction_id, details))
+        http_response["message"] = "transaction authorisation error"
+        return http_response, 500, timer.headers()
+
+    await publish_event(AuthorisedEvent(transaction_id, details))
+    timer.mark("publish")
+
+    #update merchant's account, the ledger waits on its journal so keep it off the event loop
+    status = await asyncio.to_thread(fulfill_transaction, transaction_id, payer, payee, amount)
+    timer.mark("fulfill")
+    if status == StatusCode.FAILURE:
+        await publish_event(RejectedEvent(transaction_id, details))
+        http_response["message"] = "transaction fulfillment incomplete"
+        #the retry is written to the retry log before enqueue returns, keep that wait off the event loop
+        await asyncio.to_thread(retry_queue.enqueue, transaction_id=transaction_id, webhook=webhook)
+        return http_response, 202, timer.headers()
+    await publish_event(FulfilledEvent(transaction_id, details))
+    timer.mark("publish")
+
+    http_response["message"] = "transaction completed"
+    return http_response, 200, timer.headers()
+
+@app.route("/v1/txn", methods=["GET"])
+async def get_transaction_details():
+    transaction_id= request.args.get("transaction_id")
+    try:
+        #hits are served on the event loop, only misses go to the database on a worker thread
+        found, details = transaction_cache.get_cached(transaction_id)
+        if not found:
+            details = await asyncio.to_thread(transaction_cache.fetch, router, transaction_id)
+        if details is not None:
+            return details, 200
+        else:
+            raise LookupError("transaction_id not found")
+    except Exception as e:
+        return {"message": f"Error getting transaction details {e}"}, 500
+
+@app.route("/v1/shards", methods=["GET"])
+async def get_shards():
+    return {"shards": router.servers()}, 200
+
+@app.route("/v1/shards", methods=["POST"])
+async def add_shard():
+    server = f'{(await request.get_json())["server"]}/v1'
+    try:
+        response = await async_http_get(f"{server}/status")
+        if response.status_code != 200:
+            raise ConnectionError(f"shard status {response.status_code}")
+        moved = await asyncio.to_thread(router.add_shard, server)
+        if isinstance(EventBroker.dispatcher, EventWorkerPool):
+            EventBroker.dispatcher.set_database_servers(router.servers())
+    except Exception as e:
+        logger.error(f"{time.time()}: Error adding shard {server}: {e}")
+        return {"message": f"Error adding shard {e}", "shards": router.servers()}, 500
+    return {"message": f"Shard added, {moved} transactions moved", "shards": router.servers()}, 200
+
+#resizes the pool of event worker processes, partitions move onto new workers once their events in flight are done
+@app.route("/v1/events/workers", methods=["POST"])
+async def resize_event_workers():
+    workers = int((await request.get_json())["workers"])
+    if workers < 1:
+        return {"message": "at least one event worker is needed"}, 400
+    if not isinstance(EventBroker.dispatcher, EventWorkerPool):
+        return {"message": "event subscribers run in the main process, start it with -event_workers to resize them"}, 409
+    await asyncio.to_thread(EventBroker.dispatcher.resize, workers)
+    return {"message": f"Event workers resized to {workers}", "workers": workers}, 200
+
+@app.route("/v1/events", methods=["GET"])
+async def get_event_queue_metrics():
+    dispatcher = EventBroker.dispatcher.get_metrics() if EventBroker.dispatcher else None
+    event_log = EventBroker.event_log.get_metrics() if EventBroker.event_log else None
+    return {"queue": EventBroker.event_queue.get_metrics(), "dispatcher": dispatcher, "log": event_log}, 200
+
+#asyncio.to_thread and the router's waits use the loop's default executor
+@app.before_serving
+async def set_up_blocking_executor():
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=args.blocking_threads, thread_name_prefix="blocking"))
+
+@app.after_serving
+async def close_connections():
+    await close_async_clients()
+
+
+if __name__ == "__main__":
+    shutdown_event = threading.Event()
+
+    #set up argparser
+    parser = set_up_parser()
+    parser.add_argument("-blocking_threads", type=int, default=256, help="threads running the blocking steps of payments in flight")
+    parser.add_argument("-async_pool_size", type=int, default=256, help="max connections per upstream service of the asyncio client")
+    parser.add_argument("-pool_timeout", type=float, default=30, help="seconds a call waits for a free connection of the asyncio client")
+    args = parser.parse_args()
+    router = ShardRouter([f"{database_server}/v1" for database_server in args.database_server.split(",")])
+    issuer_server = f"{args.issuer_server}/v1"
+    configure_clients(max_connections=args.pool_size, default_timeout=args.http_timeout)
+    configure_async_clients(max_connections=args.async_pool_size, default_timeout=args.http_timeout, connection_timeout=args.pool_timeout)
+    transaction_cache.configure(capacity=args.transaction_cache_size, negative_ttl=args.transaction_cache_negative_ttl)
+    configure_authorisation_batching(window=args.authorisation_batch_window_ms / 1000, max_batch=args.authorisation_batch_size, pipeline_depth=args.authorisation_pipeline_depth)
+    configure_tracing(service_name="main", rate=args.trace_sample_rate, path=args.trace_file)
+
+    #check database availability
+    status = check_database_availability()
+    if status == StatusCode.FAILURE:
+        logger.fatal(f"{time.time()}: Database isnt running")
+        sys.exit(1)
+
+    #set up event broker
+    EventBroker.database_router = router
+    EventBroker.event_queue = EventQueue(args.event_queue_size)
+    EventBroker.event_log = EventLog(args.event_log_directory)
+    EventBroker.event_workers = args.event_workers
+    EventBroker.event_partitions = args.event_partitions
+    EventBroker.subscriber_workers = args.subscriber_workers
+    EventBroker.subscriber_concurrency = args.subscriber_concurrency
+    EventBroker.subscriber_timeout = args.subscriber_timeout
+    EventBroker.subscribe_to_event(TransactionStatus.FULFILLED, EmailSubscriber())
+    EventBroker.subscribe_to_event(TransactionStatus.REJECTED,  AnalyticsSubscriber())
+    EventBroker.subscribe_to_event(TransactionStatus.TERMINATED, SupportSubscriber())
+
+    idempotency_cache = IdempotencyCache(capacity=args.idempotency_cache_size, ttl=args.idempotency_ttl)
+
+    #set up retry queue
+    retry_queue = RetryQueue(router, EventBroker, workers=args.retry_workers, max_attempts=args.retry_max_attempts)
+    register_component_metrics(retry_queue, idempotency_cache)
+
+    broker_thread = threading.Thread(target=EventBroker.run, args=(shutdown_event, ))
+    retry_thread = threading.Thread(target=retry_queue.run, args=(shutdown_event, ))
+
+    broker_thread.start()
+    retry_thread.start()
+
+    try:
+        app.run(port=8000, use_reloader=False)
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Received shutdown signal")
+    finally:
+        shutdown_event.set()
+        logger.info("Waiting for threads to finish...")
+        broker_thread.join(timeout=10)
+        retry_thread.join(timeout=10)
+        close_authorisation_batchers()
+        idempotency_cache.close()
+        close_merchant_ledger()
+        close_clients()
+        close_tracing()
+        logger.info("Shutdown complete")
@@ -0,0 +1,88 @@
+import httpx
+import time
+from urllib.parse import urlsplit
+
+from ServiceClient import observe_call
+from Tracing import start_span, inject_traceparent
+
+'''
+Asyncio counterpart of ServiceClient.py for AsyncMain.py
+
+One pooled httpx.AsyncClient per upstream. Every coroutine waiting on a service holds a
+connection, so the pool is sized for the payments in flight rather than for a pool of threads, and
+waiting for a free connection has its own timeout (`pool_timeout`) instead of sharing the time a
+call may take. Clients are bound to the event loop that created them
+'''
+
+pool_size = 256
+timeout = 5.0
+pool_timeout = 30.0
+
+clients: dict[str, "AsyncServiceClient"] = dict()
+
+
+class AsyncServiceClient:
+    def __init__(self, pool_size, timeout, pool_timeout, upstream=""):
+        self.pool_timeout = pool_timeout
+        self.timeout = httpx.Timeout(timeout, pool=pool_timeout)
+        self.upstream = upstream
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.client = httpx.AsyncClient(limits=limits, timeout=self.timeout)
+
+    async def request(self, method, url, timeout=None, **kwargs):
+        with start_span(f"{method} {urlsplit(url).path}", upstream=self.upstream) as span:
+            inject_traceparent(span, kwargs)
+            start = time.perf_counter()
+            try:
+                response = await self.client.request(method, url, timeout=httpx.Timeout(timeout, pool=self.pool_timeout) if timeout else self.timeout, **kwargs)
+            except Exception:
+                observe_call(self.upstream, method, url, "error", start)
+                raise
+            observe_call(self.upstream, method, url, response.status_code, start)
+            span.set("status", response.status_code)
+            return response
+
+    async def get(self, url, timeout=None, **kwargs):
+        return await self.request("GET", url, timeout, **kwargs)
+
+    async def post(self, url, timeout=None, **kwargs):
+        return await self.request("POST", url, timeout, **kwargs)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+#applies to clients created afterwards, so call it before the first request
+def configure_async_clients(max_connections=None, default_timeout=None, connection_timeout=None):
+    global pool_size, timeout, pool_timeout
+    if max_connections is not None:
+        pool_size = max_connections
+    if default_timeout is not None:
+        timeout = default_timeout
+    if connection_timeout is not None:
+        pool_timeout = connection_timeout
+
+
+#only ever called from the event loop thread, so no locking is needed
+def get_async_client(url) -> AsyncServiceClient:
+    parts = urlsplit(url)
+    upstream = f"{parts.scheme}://{parts.netloc}"
+    client = clients.get(upstream)
+    if client is None:
+        client = AsyncServiceClient(pool_size, timeout, pool_timeout, upstream)
+        clients[upstream] = client
+    return client
+
+
+async def async_http_get(url, **kwargs):
+    return await get_async_client(url).get(url, **kwargs)
+
+
+async def async_http_post(url, **kwargs):
+    return await get_async_client(url).post(url, **kwargs)
+
+
+async def close_async_clients():
+    for client in clients.values():
+        await client.close()
+    clients.clear()
@@ -1,8 +1,17 @@
 import logging
 import json
 import time
-import requests
 import random
+import itertools
+import threading
+from concurrent.futures import Future
+
+from CustomExceptions import AuthorisationError
+from GroupCommit import GroupCommitter
+from MerchantLedger import MerchantLedger
+from Metrics import registry
+from ServiceClient import http_post
+from Tracing import current_context, start_span, record_span
 
 logger = logging.getLogger(__name__)
 
@@ -10,6 +19,49 @@ class StatusCode:
     SUCCESS = 0
     FAILURE = 1
 
+#runs action until it returns without raising, backing off exponentially between attempts.
+#Retries are counted in the metrics under operation
+def retry_with_backoff(action, description, attempts=3, operation="other"):
+    for retry_attempt in range(attempts):
+        try:
+            return action()
+        except Exception as e:
+            logger.warning(f"Attempt {retry_attempt + 1}: Error {description}: {e}")
+            if retry_attempt != attempts - 1:
+                count_retry(operation)
+                delay = random.randint(0, 2 ** (retry_attempt + 1))
+                logger.warning(f"Delaying for {delay} seconds before retrying")
+                time.sleep(delay)
+            else:
+                logger.warning(f"All attempts at {description} failed.")
+                count_exhausted(operation)
+                raise
+
+def count_retry(operation):
+    registry.counter("retries_total", "attempts retried after an error", operation=operation).inc()
+
+def count_exhausted(operation):
+    registry.counter("retries_exhausted_total", "operations that failed after their last attempt", operation=operation).inc()
+
+#durations of the steps of a request, reported to the client in a Server-Timing header,
+#recorded in the payment_stage_seconds histograms and as spans of traced requests.
+#Durations of a step marked more than once are added up
+class StageTimer:
+    def __init__(self):
+        self.last = time.perf_counter()
+        self.stages: dict[str, float] = dict()
+
+    #the step that ran since the previous mark
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0) + (now - self.last) * 1000
+        registry.histogram("payment_stage_seconds", "time spent in every step of POST /v1/txn", stage=stage).observe(now - self.last)
+        record_span(stage, self.last, now)
+        self.last = now
+
+    def headers(self):
+        return {"Server-Timing": ", ".join(f"{stage};dur={duration:.3f}" for stage, duration in self.stages.items())}
+
 def compute_token(nonce):
     return f"{int(nonce) - random.randint(0, 10 ** 10)}"
 
@@ -36,48 +88,192 @@ def check_fraud(payer:str, payee:str, amount:float) -> StatusCode:
     return StatusCode.SUCCESS
 
 
-def get_authorisation(payer:str, payee:str, amount:float, issuer_server:str) -> StatusCode:         
-    
+#issuer authorisations requested within authorisation_batch_window seconds of each other (up to
+#authorisation_batch_size of them) are sent to the issuer in one POST /txn:batch, with up to
+#authorisation_pipeline_depth batches waiting on the issuer at once
+authorisation_batch_window = 0.002
+authorisation_batch_size = 64
+authorisation_pipeline_depth = 4
+authorisation_attempts = 3
+
+authorisation_batchers: dict[str, GroupCommitter] = dict()
+authorisation_batchers_lock = threading.Lock()
+
+#authorisations waiting for their next attempt, by retry id: (issuer server, requests)
+scheduled_retries: dict[int, tuple[str, list]] = dict()
+scheduled_retries_lock = threading.Lock()
+retry_ids = itertools.count()
+
+#applies to batchers created afterwards, so call it before the first authorisation
+def configure_authorisation_batching(window=None, max_batch=None, pipeline_depth=None):
+    global authorisation_batch_window, authorisation_batch_size, authorisation_pipeline_depth
+    if window is not None:
+        authorisation_batch_window = window
+    if max_batch is not None:
+        authorisation_batch_size = max_batch
+    if pipeline_depth is not None:
+        authorisation_pipeline_depth = pipeline_depth
+
+
+def get_authorisation_batcher(issuer_server) -> GroupCommitter:
+    with authorisation_batchers_lock:
+        batcher = authorisation_batchers.get(issuer_server)
+        if batcher is None:
+            batcher = GroupCommitter(
+                lambda requests: authorise_batch(issuer_server, requests),
+                window=authorisation_batch_window,
+                max_batch=authorisation_batch_size,
+                name="issuer-authorisation",
+                concurrency=authorisation_pipeline_depth
+            )
+            authorisation_batchers[issuer_server] = batcher
+    return batcher
+
+
+#flush of the batcher, resolves the future of every (transaction, future, trace context, attempt) request it
+#is given or schedules it for another attempt
+def authorise_batch(issuer_server, requests):
+    #the batch is traced as part of the first traced payment in it, linking the other ones
+    contexts = [context for _, _, context, _ in requests if context is not None]
+    attributes = {"transactions": len(requests)}
+    if len(contexts) > 1:
+        attributes["links"] = [context.traceparent() for context in contexts[1:]]
+    with start_span("authorise batch", parent=contexts[0] if contexts else None, **attributes):
+        send_authorisations(issuer_server, requests)
+
+
+def send_authorisations(issuer_server, requests):
+    try:
+        response = http_post(f"{issuer_server}/txn:batch", json={"transactions": [transaction_json for transaction_json, _, _, _ in requests]})
+        if response.status_code != 200:
+            raise AuthorisationError(f"status code {response.status_code}")
+        #the whole response is read before any future is resolved, a malformed one is retried as a whole
+        results = [(result["authorised"], result["retryable"]) for result in response.json()["results"]]
+    except Exception as e:
+        logger.warning(f"Error getting {len(requests)} transactions authorised: {e}")
+        retry_authorisations(issuer_server, requests)
+        return
+
+    if len(results) != len(requests):
+        logger.error(f"Issuer returned {len(results)} results for {len(requests)} transactions")
+    retry = []
+    for request, (authorised, retryable) in zip(requests, results):
+        if authorised:
+            request[1].set_result(StatusCode.SUCCESS)
+        elif retryable:
+            retry.append(request)
+        else:
+            request[1].set_result(StatusCode.FAILURE)
+    #transactions the issuer returned no result for are not known to be authorised
+    fail_authorisations(requests[len(results):])
+    if retry:
+        logger.warning(f"{len(retry)} transactions not recorded by the issuer")
+        retry_authorisations(issuer_server, retry)
+
+
+#sends the requests again after an exponential backoff, from a timer rather than the batcher's
+#threads so other payments' authorisations do not wait behind the delay
+def retry_authorisations(issuer_server, requests):
+    retries: dict[int, list] = dict()
+    exhausted = []
+    for transaction_json, future, context, attempt in requests:
+        if attempt + 1 < authorisation_attempts:
+            retries.setdefault(attempt + 1, []).append((transaction_json, future, context, attempt + 1))
+        else:
+            exhausted.append((transaction_json, future, context, attempt))
+    if exhausted:
+        logger.warning(f"All attempts at getting {len(exhausted)} transactions authorised failed.")
+        for _ in exhausted:
+            count_exhausted("authorise")
+        fail_authorisations(exhausted)
+
+    for attempt, batch in retries.items():
+        for _ in batch:
+            count_retry("authorise")
+        retry_id = next(retry_ids)
+        with scheduled_retries_lock:
+            scheduled_retries[retry_id] = (issuer_server, batch)
+        timer = threading.Timer(random.uniform(0, 2 ** attempt), resubmit_authorisations, (retry_id, ))
+        timer.daemon = True
+        timer.start()
+
+
+def resubmit_authorisations(retry_id):
+    #whoever takes the retry out of scheduled_retries resolves it, the timer or close_authorisation_batchers
+    with scheduled_retries_lock:
+        scheduled = scheduled_retries.pop(retry_id, None)
+    if scheduled is None:
+        return
+    issuer_server, requests = scheduled
+    with authorisation_batchers_lock:
+        batcher = authorisation_batchers.get(issuer_server)
+    try:
+        if batcher is None:
+            raise RuntimeError("authorisation batching is closed")
+        batcher.submit(requests)
+    except RuntimeError:
+        fail_authorisations(requests)
+
+
+def fail_authorisations(requests):
+    for _, future, _, _ in requests:
+        future.set_result(StatusCode.FAILURE)
+
+
+#returns at once, the future resolves to the StatusCode of the authorisation
+def submit_authorisation(payer:str, payee:str, amount:float, issuer_server:str) -> Future:
     transaction_json = {
         "payer": payer,
         "payee": payee, 
         "amount": amount
     }
+    future = Future()
+    get_authorisation_batcher(issuer_server).submit([(transaction_json, future, current_context.get(), 0)])
+    return future
 
-    for retry_attempt in range(3):
-        try:
-            response = requests.post(f"{issuer_server}/txn", json=transaction_json)
-        except Exception as e:
-            logger.warning(f"Attempt {retry_attempt + 1}: Error getting transaction authorised.")
-            logger.warning(e)
-            if retry_attempt != 2: 
-                delay = random.randint(0, 2 ** (retry_attempt+ 1))
-                logger.warning(f"delaying for {delay} seconds before retrying")
-                time.sleep(delay)
-            else:
-                logger.warning("All attempts getting authorisation failed")
-        else:
-            if response.status_code == 200:
-                return StatusCode.SUCCESS
-    
-    return StatusCode.FAILURE
+
+def get_authorisation(payer:str, payee:str, amount:float, issuer_server:str) -> StatusCode:         
+    return submit_authorisation(payer, payee, amount, issuer_server).result()
+
+
+#sends the authorisations still waiting before returning, the ones waiting for another attempt fail
+def close_authorisation_batchers():
+    with authorisation_batchers_lock:
+        batchers = list(authorisation_batchers.values())
+        authorisation_batchers.clear()
+    for batcher in batchers:
+        batcher.close()
+    with scheduled_retries_lock:
+        scheduled = list(scheduled_retries.values())
+        scheduled_retries.clear()
+    for _, requests in scheduled:
+        fail_authorisations(requests)
+
+merchant_ledger = None
+merchant_ledger_lock = threading.Lock()
+
+def get_merchant_ledger() -> MerchantLedger:
+    global merchant_ledger
+    with merchant_ledger_lock:
+        if merchant_ledger is None:
+            merchant_ledger = MerchantLedger()
+    return merchant_ledger
+
+def close_merchant_ledger():
+    with merchant_ledger_lock:
+        if merchant_ledger is not None:
+            merchant_ledger.close()
 
 def fulfill_transaction(transaction_id, payer, payee, amount:float) -> StatusCode:
-    merchant_database = "databases/merchant_database.json"
-    
     try:
-        with open(merchant_database, "r") as file:
-            data = json.load(file)
-            data[payee]["balance"] += amount
-            data[payee]["transaction"].append((time.time(), payer, amount))
-
-        with open(merchant_database, "w") as file:
-            json.dump(data, file, indent=4)
+        ledger = get_merchant_ledger()
     except FileNotFoundError as e:
         logger.fatal(f"{time.time()}: Merchant database missing")
     except ValueError as e:
         logger.fatal(f"{time.time()} Merchant database is corrupted. {e}")    
     else:
-        logger.info(f"transaction ({transaction_id}) logged")
-        return StatusCode.SUCCESS
-    return StatusCode.FAILURE
\ No newline at end of file
+        status = ledger.credit(transaction_id, payer, payee, amount)
+        if status == StatusCode.SUCCESS:
+            logger.info("transaction (%s) logged", transaction_id)
+        return status
+    return StatusCode.FAILURE
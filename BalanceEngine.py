@@ -0,0 +1,233 @@
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+from StorageEngine import SegmentLog, CheckpointGate
+from GroupCommit import GroupCommitter
+from TransactionHistory import TransactionHistory
+
+'''
+Balance engine of the issuer
+
+Balances are held in memory and guarded by a fixed set of striped locks. A debit checks and
+reserves the payer's balance under the payer's stripe, so two debits can never both spend the same
+funds, while payers on different stripes are debited concurrently. The debit is then appended to a
+journal (concurrent debits share one fsync) and only reported once it is durable, a debit that
+could not be journaled is refunded
+
+The journal is folded back into the user database, and debits into the transaction history, by
+checkpoint(), every `checkpoint_interval` seconds or once `checkpoint_records` changes were journaled,
+and the folded journal segments are deleted. Writers only pause while the checkpoint copies the
+balances and histories in memory, so the journal replayed on restart stays short. Journal records
+carry a sequence number and the database and the history remember the last one they hold, so a
+record is never applied twice
+'''
+logger = logging.getLogger(__name__)
+
+#entries of the user database that are not accounts
+METADATA_KEYS = ("last_modified", "journal_sequence")
+
+
+class StatusCode:
+    SUCCESS = 0
+    FAILURE = 1
+    UNAVAILABLE = 2
+
+
+class BalanceEngine:
+    def __init__(self, users, database_file="databases/usr_database.json", journal_directory="databases/usr_journal", history_directory="databases/usr_history", stripes=64, commit_window=0.002,
+                 checkpoint_interval=60, checkpoint_records=100000):
+        self.database_file = database_file
+        #conditions, so an account being opened can wait for the debits of its user to finish
+        self.stripes = [threading.Condition() for _ in range(stripes)]
+        #debits reserved and not yet journaled, by payer, and the accounts being opened
+        self.reserved: dict[str, int] = dict()
+        self.opening = set()
+        self.metadata = {key: users[key] for key in METADATA_KEYS if key in users}
+        self.accounts = {user: {"balance": account["balance"]} for user, account in users.items() if user not in METADATA_KEYS}
+
+        checkpointed = self.metadata.get("journal_sequence", -1)
+        self.history = TransactionHistory(history_directory)
+        if not self.history.imported:
+            #histories written by earlier versions into the user database, up to the database's journal record
+            for user, account in users.items():
+                if user not in METADATA_KEYS:
+                    for timestamp, payee, amount in account.get("transactions", []):
+                        self.history.append(user, timestamp, payee, amount)
+            self.history.sequence = checkpointed
+
+        self.journal = SegmentLog(journal_directory)
+        last_sequence = max(checkpointed, self.history.sequence)
+        replayed = 0
+        for record in self.journal.read():
+            if record["sequence"] > min(checkpointed, self.history.sequence):
+                self.apply(record, balances=record["sequence"] > checkpointed, history=record["sequence"] > self.history.sequence)
+                replayed += 1
+            last_sequence = max(last_sequence, record["sequence"])
+        self.sequence = itertools.count(last_sequence + 1)
+        logger.info(f"Balance engine loaded, {replayed} journal records replayed")
+        self.committer = GroupCommitter(self.journal.append, window=commit_window, name="issuer-journal")
+
+        #the records replayed count as changes, so the first checkpoint folds them
+        self.gate = CheckpointGate(max_changes=checkpoint_records, changes=replayed)
+        self.checkpoint_interval = checkpoint_interval
+        self.stopped = threading.Event()
+        self.checkpointer = threading.Thread(target=self.run_checkpoints, name="issuer-checkpoint", daemon=True)
+        self.checkpointer.start()
+
+    def stripe(self, user):
+        return self.stripes[zlib.crc32(user.encode()) % len(self.stripes)]
+
+    #caller must hold the stripe of the user, or be the only thread running
+    def apply(self, record, balances=True, history=True):
+        match record["op"]:
+            case "open":
+                if balances:
+                    self.accounts[record["user"]] = {"balance": record["balance"]}
+                if history:
+                    self.history.reset(record["user"])
+            case "debit":
+                if balances:
+                    self.accounts[record["payer"]]["balance"] -= record["amount"]
+                if history:
+                    self.history.append(record["payer"], record["timestamp"], record["payee"], record["amount"])
+
+    #checks and reserves the debits in order, so a payer's balance covers every debit of the batch, then
+    #journals them with one write. Debits that could not be journaled are refunded and reported UNAVAILABLE
+    def debit_batch(self, transactions) -> list[StatusCode]:
+        with self.gate.writing():
+            return self.reserve_and_journal(transactions)
+
+    def reserve_and_journal(self, transactions) -> list[StatusCode]:
+        statuses = []
+        records = []
+        for payer, payee, amount in transactions:
+            if payer not in self.accounts or amount <= 0:
+                statuses.append(StatusCode.FAILURE)
+                continue
+            with self.stripe(payer):
+                #an account being opened has no balance to debit yet
+                if payer in self.opening or self.accounts[payer]["balance"] < amount:
+                    statuses.append(StatusCode.FAILURE)
+                    continue
+                self.accounts[payer]["balance"] -= amount
+                self.reserved[payer] = self.reserved.get(payer, 0) + 1
+            records.append({"op": "debit", "sequence": next(self.sequence), "payer": payer, "payee": payee, "amount": amount, "timestamp": time.time()})
+            statuses.append(StatusCode.SUCCESS)
+        if not records:
+            return statuses
+
+        try:
+            self.committer.commit(records)
+        except Exception as e:
+            logger.error(f"{time.time()}: Error journaling {len(records)} debits, refunding them: {e}")
+            for record in records:
+                with self.stripe(record["payer"]):
+                    self.accounts[record["payer"]]["balance"] += record["amount"]
+                    self.release(record["payer"])
+            return [StatusCode.UNAVAILABLE if status == StatusCode.SUCCESS else status for status in statuses]
+
+        for record in records:
+            with self.stripe(record["payer"]):
+                self.history.append(record["payer"], record["timestamp"], record["payee"], record["amount"])
+                self.release(record["payer"])
+        return statuses
+
+    #caller holds the stripe of the payer
+    def release(self, payer):
+        self.reserved[payer] -= 1
+        if not self.reserved[payer]:
+            del self.reserved[payer]
+            if payer in self.opening:
+                self.stripe(payer).notify_all()
+
+    def debit(self, payer, payee, amount:float) -> StatusCode:
+        return self.debit_batch([(payer, payee, amount)])[0]
+
+    #opens the account, or resets it if it exists. Debits of the user already reserved are journaled
+    #first and new ones are refused until the account is open, so the journal holds them in the order
+    #they were applied. The stripe is not held while the record is journaled
+    def open_account(self, user, balance:float) -> StatusCode:
+        stripe = self.stripe(user)
+        with self.gate.writing():
+            with stripe:
+                if user in self.opening:
+                    return StatusCode.FAILURE
+                self.opening.add(user)
+                stripe.wait_for(lambda: user not in self.reserved)
+                record = {"op": "open", "sequence": next(self.sequence), "user": user, "balance": balance}
+            try:
+                self.committer.commit([record])
+            except Exception as e:
+                logger.error(f"{time.time()}: Error journaling account of {user}: {e}")
+                with stripe:
+                    self.opening.discard(user)
+                return StatusCode.FAILURE
+            with stripe:
+                self.apply(record)
+                self.opening.discard(user)
+        return StatusCode.SUCCESS
+
+    def get_balance(self, user):
+        with self.stripe(user):
+            return self.accounts[user]["balance"]
+
+    #debits of the user in the order they were made, and the cursor of the next page. None if the user does not exist
+    def get_history(self, user, since=None, until=None, limit=100, cursor=None):
+        if user not in self.accounts:
+            return None
+        with self.stripe(user):
+            view = self.history.view(user)
+        return self.history.query(view, since=since, until=until, limit=limit, cursor=cursor)
+
+    #folds the journal into the transaction history and the user database, then deletes the folded
+    #segments. Writers only wait while the balances and histories are copied
+    def checkpoint(self):
+        with self.gate.pause() as changes:
+            if not changes:
+                return
+            #every record up to last_sequence is journaled and applied, and in the sealed segments
+            self.journal.seal()
+            sealed = self.journal.sealed_segments()
+            last_sequence = next(self.sequence) - 1
+            self.sequence = itertools.count(last_sequence + 1)
+            history = self.history.snapshot(last_sequence)
+            accounts = {user: dict(account) for user, account in self.accounts.items()}
+        #the history goes first, a crash before the database is replaced only replays balances
+        self.history.checkpoint(history)
+        tmp_file = f"{self.database_file}.tmp"
+        with open(tmp_file, "w") as file:
+            json.dump({**self.metadata, "journal_sequence": last_sequence, **accounts}, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, self.database_file)
+        self.metadata["journal_sequence"] = last_sequence
+        self.journal.replace_segments(sealed, [])
+        self.gate.checkpointed(changes)
+        logger.info(f"Balance engine checkpointed to {self.database_file}, {changes} changes folded")
+
+    def run_checkpoints(self):
+        while True:
+            self.gate.due.wait(self.checkpoint_interval)
+            if self.stopped.is_set():
+                return
+            try:
+                self.checkpoint()
+            except Exception as e:
+                logger.error(f"{time.time()}: Error checkpointing balance engine: {e}")
+
+    def close(self):
+        self.stopped.set()
+        self.gate.due.set()
+        self.checkpointer.join()
+        self.committer.close()
+        try:
+            self.checkpoint()
+        except Exception as e:
+            logger.critical(f"Error checkpointing balance engine: {e}")
+        self.journal.close()
+        self.history.close()
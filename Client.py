@@ -30,13 +30,15 @@ def create_new_transaction(arg_list:list):
 
         for retry_attempt in range(3):
             try: 
-                param_json = {"nonce": sessionID}
-                response = requests.get(f"{payment_api_url}/token", params=param_json)
-                if response.status_code == 200:
-                    token = response.json()["token"]
-                    print("Transaction successfully registered")
-                else:
-                     raise TransactionRegistrationError
+                #retries keep the token, so the payment api replays the first attempt instead of paying twice
+                if "token" not in request_json:
+                    param_json = {"nonce": sessionID}
+                    response = requests.get(f"{payment_api_url}/token", params=param_json)
+                    if response.status_code == 200:
+                        request_json["token"] = response.json()["token"]
+                        print("Transaction successfully registered")
+                    else:
+                         raise TransactionRegistrationError
             
             except Exception as e:
                 message = response.json()["message"]
@@ -51,7 +53,6 @@ def create_new_transaction(arg_list:list):
 
             else:
 
-                request_json["token"] = token
                 request_json["webhook"] = "http://127.0.0.1:9000/v1"
                 try: 
                     response = requests.post(f"{payment_api_url}/txn", json=request_json)
@@ -23,4 +23,7 @@ class LoggingTransactionError(Exception):
     pass
 
 class LoggingTransactionStatusError(Exception):
+    pass
+
+class IdempotencyKeyReuseError(Exception):
     pass
\ No newline at end of file
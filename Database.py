@@ -1,22 +1,30 @@
 import json
-import pathlib
 import logging
 import time
 from flask import Flask, request
 import threading
 import signal
 import sys
+import argparse
 
 from CustomExceptions import DirtyCacheError
+from StorageEngine import StorageEngine, JsonFileEngine, SegmentLogEngine
+from GroupCommit import GroupCommitter
+from TransactionIndex import TransactionIndex
+from Metrics import registry, instrument_app
+from Tracing import configure_tracing, close_tracing, trace_app
+from StructuredLogging import configure_logging
 
 logger = logging.getLogger()
-logging.basicConfig(filename='logs/db_logs.txt', level=logging.INFO)
+configure_logging("logs/db_logs.jsonl", service="database")
 
 #routing functions
 app = Flask(__name__)
+instrument_app(app)
+trace_app(app)
 @app.route("/v1/status", methods=["GET"])
 def get_database_status():
-    if database.data:
+    if database.data is not None:
         return {"status": "running"}, 200
     return {"status": "internal server error"}, 500
 
@@ -31,11 +39,31 @@ def log_transaction():
 @app.route("/v1/txn", methods=["GET"])
 def get_transaction_details():
     transaction_id= request.args.get("transaction_id")
+    if transaction_id is None:
+        return query_transactions()
     details = database.get_transaction(transaction_id=transaction_id)
     if details != None:
         return {"message": "transaction found", "details":details}, 200
     return {"message": "transaction_id not found", "details": None}, 500
 
+#GET /v1/txn?payer=...&payee=...&since=...&until=...&limit=...&cursor=...
+def query_transactions():
+    try:
+        since = request.args.get("since", type=float)
+        until = request.args.get("until", type=float)
+        limit = request.args.get("limit", default=100, type=int)
+        cursor = request.args.get("cursor")
+        if cursor is not None:
+            timestamp, _, token = cursor.partition(":")
+            cursor = (float(timestamp), token)
+    except ValueError as e:
+        return {"message": f"Invalid query: {e}", "transactions": [], "next_cursor": None}, 400
+
+    transactions, next_cursor = database.query_transactions(payer=request.args.get("payer"), payee=request.args.get("payee"), since=since, until=until, limit=limit, cursor=cursor)
+    if next_cursor is not None:
+        next_cursor = f"{next_cursor[0]!r}:{next_cursor[1]}"
+    return {"message": f"{len(transactions)} transactions found", "transactions": transactions, "next_cursor": next_cursor}, 200
+
 @app.route("/v1/txn_status", methods=["POST"])
 def log_transaction_status():
     info = request.get_json()
@@ -44,101 +72,295 @@ def log_transaction_status():
         return {"message": "Transaction status logged"}, 200
     return {"message": "Transaction_id not found"}, 500
 
+@app.route("/v1/txn:batch", methods=["POST"])
+def log_transactions():
+    transactions = request.get_json()["transactions"]
+    statuses = database.log_transactions(transactions)
+    results = []
+    for transaction, status in zip(transactions, statuses):
+        result = {"token": transaction["token"], "transaction_id": None, "retryable": False}
+        if status == StatusCode.SUCCESS:
+            result.update(message="Transaction logged", transaction_id=transaction["token"])
+        elif status == StatusCode.UNAVAILABLE:
+            result.update(message="Transaction not persisted", retryable=True)
+        else:
+            result.update(message="Duplicate transaction id")
+        results.append(result)
+    return {"message": f"{statuses.count(StatusCode.SUCCESS)}/{len(transactions)} transactions logged", "results": results}, 200
+
+@app.route("/v1/txn_status:batch", methods=["POST"])
+def log_transaction_statuses():
+    updates = request.get_json()["updates"]
+    statuses = database.log_statuses(updates)
+    results = []
+    for update, status in zip(updates, statuses):
+        result = {"transaction_id": update["transaction_id"], "logged": status == StatusCode.SUCCESS, "retryable": False}
+        if status == StatusCode.SUCCESS:
+            result["message"] = "Transaction status logged"
+        elif status == StatusCode.UNAVAILABLE:
+            result.update(message="Transaction status not persisted", retryable=True)
+        else:
+            result["message"] = "Transaction_id not found"
+        results.append(result)
+    return {"message": f"{statuses.count(StatusCode.SUCCESS)}/{len(updates)} statuses logged", "results": results}, 200
+
+#shard rebalancing, see Router.py
+@app.route("/v1/txn:export", methods=["GET"])
+def export_transactions():
+    try:
+        ranges = []
+        for arc in request.args.get("ranges", "").split(","):
+            start, _, end = arc.partition("-")
+            ranges.append((int(start), int(end)))
+        limit = request.args.get("limit", default=1000, type=int)
+        cursor = request.args.get("cursor")
+        if cursor is not None:
+            position, _, token = cursor.partition(":")
+            cursor = (int(position), token)
+    except ValueError as e:
+        return {"message": f"Invalid ranges: {e}", "transactions": [], "next_cursor": None}, 400
+
+    transactions, next_cursor = database.export_hash_ranges(ranges, limit=limit, cursor=cursor)
+    if next_cursor is not None:
+        next_cursor = f"{next_cursor[0]}:{next_cursor[1]}"
+    return {"message": f"{len(transactions)} transactions exported", "transactions": transactions, "next_cursor": next_cursor}, 200
+
+#transactions written to moving arcs while they were being copied, by id
+@app.route("/v1/txn:export", methods=["POST"])
+def export_transactions_by_id():
+    transactions = database.export_transactions(request.get_json()["transaction_ids"])
+    return {"message": f"{len(transactions)} transactions exported", "transactions": transactions}, 200
+
+@app.route("/v1/txn:import", methods=["POST"])
+def import_transactions():
+    transactions = request.get_json()["transactions"]
+    if database.import_transactions(transactions) == StatusCode.SUCCESS:
+        return {"message": f"{len(transactions)} transactions imported"}, 200
+    return {"message": "Transactions not persisted"}, 503
+
+@app.route("/v1/txn:delete", methods=["POST"])
+def delete_transactions():
+    transaction_ids = request.get_json()["transaction_ids"]
+    if database.delete_transactions(transaction_ids) == StatusCode.SUCCESS:
+        return {"message": f"{len(transaction_ids)} transactions deleted"}, 200
+    return {"message": "Deletion not persisted"}, 503
+
 class StatusCode:
     SUCCESS = 0
     FAILURE = 1
+    UNAVAILABLE = 2
 
 class Database:
-    def __init__(self, database_file):
-        self.database_file = database_file
+    def __init__(self, storage_engine: StorageEngine, commit_window=0.002, commit_batch_size=128):
+        self.storage_engine = storage_engine
+        self.lock = threading.Lock()
+        self.pending = set()
         try:
-            with open (database_file, "r") as file:
-                self.data = json.load(file)
-            file_path = pathlib.Path(database_file)
-            timestamp = file_path.stat().st_mtime
-            if self.data["last_modified"] != "new" and self.data["last_modified"] != timestamp:
-                raise DirtyCacheError
-            
+            self.data = storage_engine.load()
         except DirtyCacheError:
             logger.error("Unauthorised amendments to transaction data")
             raise
-        except FileNotFoundError:
-            logger.error(f"Error: The file {database_file} was not found.")
+        except FileNotFoundError as e:
+            logger.error(f"Error: The file {e.filename} was not found.")
             raise
         except Exception as e:
             logger.error(f"Error opening file: {e}")
             raise
         else:
-            logger.info(f"Database initialised at {timestamp}")
+            logger.info(f"Database initialised at {time.time()}")
+        self.index = TransactionIndex()
+        self.index.build(self.data)
+        #writes are acknowledged only once the batch holding them has been persisted
+        self.committer = GroupCommitter(self.flush, window=commit_window, max_batch=commit_batch_size, name="database-commit")
+        registry.register(self.collect_metrics)
+
+    def collect_metrics(self):
+        yield "database_records", "transactions held by this shard", "gauge", {}, len(self.data)
+        yield "database_pending_inserts", "inserts waiting for their batch to be persisted", "gauge", {}, len(self.pending)
+
+    #runs on the committer thread only, so self.data is never modified while it is being persisted
+    def flush(self, records):
+        self.storage_engine.persist(records, self.data)
+        #writes become visible to readers only once they are durable
+        with self.lock:
+            for record in records:
+                previous = self.data.get(record["id"])
+                StorageEngine.apply(self.data, record)
+                #imports may overwrite and shard moves delete transactions that are already indexed
+                if record["op"] in ("txn", "delete") and previous is not None:
+                    self.index.remove(record["id"], previous["details"])
+                if record["op"] == "txn":
+                    self.index.add(record["id"], record["details"])
+                self.pending.discard(record["id"])
 
     def log_transaction(self, payer, payee, amount, token):
-        if token in self.data:
-            logger.warning(f"Duplicate transaction ignored. id:{token}, payer:{payer}, payee:{payee}, amount:{amount}")
-            return None
-        
-        details = dict()
-        details["payer"] = payer
-        details["payee"] = payee
-        details["amount"] = amount
-        details["timestamp"] = time.time()
-        self.data[token]= dict()
-        self.data[token]["details"] = details
+        status = self.log_transactions([{"payer": payer, "payee": payee, "amount": amount, "token": token}])[0]
+        if status == StatusCode.SUCCESS:
+            return token
+        return None
+
+    #FAILURE for duplicates, UNAVAILABLE when the batch could not be persisted
+    def log_transactions(self, transactions) -> list[StatusCode]:
+        results = [StatusCode.FAILURE] * len(transactions)
+        records = []
+        staged = []
+
+        #tokens waiting on a flush count as taken, so a concurrent duplicate cannot slip in
+        with self.lock:
+            for index, transaction in enumerate(transactions):
+                token = transaction["token"]
+                if token in self.data or token in self.pending:
+                    logger.warning(f"Duplicate transaction ignored. id:{token}, payer:{transaction['payer']}, payee:{transaction['payee']}, amount:{transaction['amount']}")
+                    continue
+
+                details = dict()
+                details["payer"] = transaction["payer"]
+                details["payee"] = transaction["payee"]
+                details["amount"] = transaction["amount"]
+                details["timestamp"] = time.time()
+                self.pending.add(token)
+                records.append(StorageEngine.transaction_record(token, details))
+                staged.append((index, token))
+
+        if not records:
+            return results
 
         try:
-            with open(self.database_file, "w") as file:
-                json.dump(self.data, file, indent=4)
+            self.committer.commit(records)
         except Exception as e:
-            pass
+            logger.error(f"Error persisting {len(records)} transactions: {e}")
+            with self.lock:
+                for index, token in staged:
+                    self.pending.discard(token)
+                    results[index] = StatusCode.UNAVAILABLE
         else:
-            return token
-        return None
+            for index, _ in staged:
+                results[index] = StatusCode.SUCCESS
+        return results
 
     def log_status(self, transaction_id, status) -> StatusCode:
-        if self.data and transaction_id in self.data:
-            self.data[transaction_id]["status"] = status
-            try:
-                with open(self.database_file, "w") as file:
-                    json.dump(self.data, file, indent=4)
-            except Exception as e:
-                return StatusCode.FAILURE
-            else:
-                return StatusCode.SUCCESS
-        elif self.data:
-            logger.warning(f"transaction id not found in database. id: {transaction_id}")
-        else:
+        return self.log_statuses([{"transaction_id": transaction_id, "status": status}])[0]
+
+    #FAILURE for unknown transactions, UNAVAILABLE when the batch could not be persisted
+    def log_statuses(self, updates) -> list[StatusCode]:
+        results = [StatusCode.FAILURE] * len(updates)
+        if self.data is None:
             logger.error(f"data is not initialised.")
+            return results
 
-        return StatusCode.FAILURE
+        records = []
+        staged = []
+        for index, update in enumerate(updates):
+            transaction_id = update["transaction_id"]
+            if transaction_id not in self.data:
+                logger.warning(f"transaction id not found in database. id: {transaction_id}")
+                continue
+            records.append(StorageEngine.status_record(transaction_id, update["status"]))
+            staged.append(index)
+
+        if not records:
+            return results
+
+        try:
+            self.committer.commit(records)
+        except Exception as e:
+            logger.error(f"Error persisting {len(records)} status updates: {e}")
+            for index in staged:
+                results[index] = StatusCode.UNAVAILABLE
+        else:
+            for index in staged:
+                results[index] = StatusCode.SUCCESS
+        return results
 
     def get_transaction(self, transaction_id):
         transaction_details = None
-        if self.data and transaction_id in self.data:
+        if self.data is not None and transaction_id in self.data:
             transaction_details = self.data[transaction_id]["details"]
-        elif self.data:
+        elif self.data is not None:
             logger.warning(f"Transaction id not found in database. id: {transaction_id}")
         else:
             logger.error(f"Data is not initialised.")
 
         return transaction_details
     
+    def query_transactions(self, payer=None, payee=None, since=None, until=None, limit=100, cursor=None):
+        with self.lock:
+            tokens, next_cursor = self.index.query(payer=payer, payee=payee, since=since, until=until, limit=limit, cursor=cursor)
+            transactions = [{"transaction_id": token, **self.data[token]} for token in tokens]
+        return transactions, next_cursor
+
+    def export_hash_ranges(self, ranges, limit=1000, cursor=None):
+        with self.lock:
+            tokens, next_cursor = self.index.query_hash_ranges(ranges, limit=limit, cursor=cursor)
+            transactions = [{"transaction_id": token, **self.data[token]} for token in tokens]
+        return transactions, next_cursor
+
+    #unknown ids are skipped
+    def export_transactions(self, transaction_ids):
+        with self.lock:
+            return [{"transaction_id": token, **self.data[token]} for token in transaction_ids if token in self.data]
+
+    #upserts transactions copied from another shard, keeping their original details and status
+    def import_transactions(self, transactions) -> StatusCode:
+        records = []
+        for transaction in transactions:
+            record = StorageEngine.transaction_record(transaction["transaction_id"], transaction["details"])
+            if "status" in transaction:
+                record["status"] = transaction["status"]
+            records.append(record)
+        try:
+            self.committer.commit(records)
+        except Exception as e:
+            logger.error(f"Error importing {len(records)} transactions: {e}")
+            return StatusCode.UNAVAILABLE
+        return StatusCode.SUCCESS
+
+    def delete_transactions(self, transaction_ids) -> StatusCode:
+        try:
+            self.committer.commit([StorageEngine.delete_record(transaction_id) for transaction_id in transaction_ids])
+        except Exception as e:
+            logger.error(f"Error deleting {len(transaction_ids)} transactions: {e}")
+            return StatusCode.UNAVAILABLE
+        return StatusCode.SUCCESS
+
     def handle_shutdown(self):
         try:
-            with open(self.database_file, "w") as file:
-                json.dump(self.data, file, indent=4)
+            self.committer.close()
+            self.storage_engine.close(self.data)
         except Exception as e:
             logger.critical(f"Error flushing data back to database: {e}")
         else:
             logger.info("Data successfully flushed")
 
+def set_up_parser():
+    parser = argparse.ArgumentParser(
+                    prog="database",
+                    description="Database service of the payment api")
+    parser.add_argument("-storage_engine", choices=["segment", "json"], default="segment", help="segment: append-only log, json: legacy single file")
+    parser.add_argument("-database_file", default="databases/txn_database.json", help="json database file, imported on first start of the segment engine")
+    parser.add_argument("-log_directory", default="databases/txn_log", help="directory holding the segment log")
+    parser.add_argument("-port", type=int, default=8001, help="port of this shard")
+    parser.add_argument("-commit_window_ms", type=float, default=2, help="how long writes wait to be batched into one flush")
+    parser.add_argument("-commit_batch_size", type=int, default=128, help="number of pending writes that triggers a flush")
+    parser.add_argument("-trace_file", default="logs/traces.jsonl", help="json lines file spans of traced requests are appended to")
+    return parser
+
 if __name__ == "__main__":
-    database = Database("databases/txn_database.json")
+    args = set_up_parser().parse_args()
+    if args.storage_engine == "json":
+        storage_engine = JsonFileEngine(args.database_file)
+    else:
+        storage_engine = SegmentLogEngine(args.log_directory, legacy_file=args.database_file)
+    database = Database(storage_engine, commit_window=args.commit_window_ms / 1000, commit_batch_size=args.commit_batch_size)
+    configure_tracing(service_name=f"database:{args.port}", path=args.trace_file)
 
     try:
-        app.run(port=8001)
+        app.run(port=args.port)
     except KeyboardInterrupt:
         logger.info("Shutdown signal received (Ctrl-C)")
     finally:
         database.handle_shutdown()
+        close_tracing()
 
 
     
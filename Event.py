@@ -1,5 +1,8 @@
 from abc import ABC, abstractmethod
 from enum import IntEnum
+from types import MappingProxyType
+
+from Tracing import current_traceparent
 
 '''
 payment state machine:
@@ -19,24 +22,44 @@ class TransactionStatus(IntEnum):
     REJECTED = 5
     TERMINATED = 6
 
-#Events - immutable, only logging the status
+#read-only copy of the transaction details, shared by all events of a transaction
+def snapshot(details):
+    if details is None or isinstance(details, MappingProxyType):
+        return details
+    return MappingProxyType(dict(details))
+
+#Events - immutable, logging the status and optionally a snapshot of the transaction details
 class Event(ABC):
-    def __init__(self, transaction_id):
+    def __init__(self, transaction_id, details=None):
         self.transaction_id = transaction_id
+        self.details = snapshot(details)
+        #position in the event log, set once the event is durable
+        self.offset = None
+        #trace of the request that published the event, None when it is not traced
+        self.traceparent = current_traceparent()
     
     def get_transaction_id(self):
         return self.transaction_id
+
+    #None when the publisher did not have the details, subscribers then fetch them from the database
+    def get_details(self):
+        return self.details
     
     @abstractmethod
     def get_status(self):
         pass
 
     def to_string(self):
-        return {"id": self.transaction_id, "status": self.get_status()}
+        record = {"id": self.transaction_id, "status": self.get_status()}
+        if self.details is not None:
+            record["details"] = dict(self.details)
+        if self.traceparent is not None:
+            record["trace"] = self.traceparent
+        return record
 
 class CreatedEvent(Event):
-    def __init__(self, transaction_id:str):
-        super().__init__(transaction_id)
+    def __init__(self, transaction_id:str, details=None):
+        super().__init__(transaction_id, details)
         self.status = TransactionStatus.CREATED
     
     def get_status(self):
@@ -44,8 +67,8 @@ class CreatedEvent(Event):
 
     
 class VerifiedEvent(Event):
-    def __init__(self, transaction_id:str):
-        super().__init__(transaction_id)
+    def __init__(self, transaction_id:str, details=None):
+        super().__init__(transaction_id, details)
         self.status = TransactionStatus.VERIFIED
     
     def get_status(self):
@@ -53,8 +76,8 @@ class VerifiedEvent(Event):
     
     
 class CheckedEvent(Event):
-    def __init__(self, transaction_id:str):
-        super().__init__(transaction_id)
+    def __init__(self, transaction_id:str, details=None):
+        super().__init__(transaction_id, details)
         self.status = TransactionStatus.CHECKED
     
     def get_status(self):
@@ -62,8 +85,8 @@ class CheckedEvent(Event):
 
 
 class AuthorisedEvent(Event):
-    def __init__(self, transaction_id:str):
-        super().__init__(transaction_id)
+    def __init__(self, transaction_id:str, details=None):
+        super().__init__(transaction_id, details)
         self.status = TransactionStatus.AUTHORISED
     
     def get_status(self):
@@ -71,8 +94,8 @@ class AuthorisedEvent(Event):
 
 
 class FulfilledEvent(Event):
-    def __init__(self, transaction_id:str):
-        super().__init__(transaction_id)
+    def __init__(self, transaction_id:str, details=None):
+        super().__init__(transaction_id, details)
         self.status = TransactionStatus.FULFILLED
     
     def get_status(self):
@@ -80,8 +103,8 @@ class FulfilledEvent(Event):
 
 
 class RejectedEvent(Event):
-    def __init__(self, transaction_id:str):
-        super().__init__(transaction_id)
+    def __init__(self, transaction_id:str, details=None):
+        super().__init__(transaction_id, details)
         self.status = TransactionStatus.REJECTED
     
     def get_status(self):
@@ -89,9 +112,24 @@ class RejectedEvent(Event):
 
 
 class TerminatedEvent(Event):
-    def __init__(self, transaction_id:str):
-        super().__init__(transaction_id)
+    def __init__(self, transaction_id:str, details=None):
+        super().__init__(transaction_id, details)
         self.status = TransactionStatus.TERMINATED
     
     def get_status(self):
-        return self.status
\ No newline at end of file
+        return self.status
+
+
+#rebuilds an event from to_string()
+def event_from_string(record) -> Event:
+    event_types = {
+        TransactionStatus.CREATED: CreatedEvent,
+        TransactionStatus.VERIFIED: VerifiedEvent,
+        TransactionStatus.CHECKED: CheckedEvent,
+        TransactionStatus.AUTHORISED: AuthorisedEvent,
+        TransactionStatus.FULFILLED: FulfilledEvent,
+        TransactionStatus.REJECTED: RejectedEvent
+    }
+    event = event_types.get(record["status"], TerminatedEvent)(record["id"], record.get("details"))
+    event.traceparent = record.get("trace")
+    return event
@@ -0,0 +1,226 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from Backend import StatusCode
+from Metrics import registry
+from Tracing import start_span
+
+'''
+Fan-out of events to their subscribers
+
+All subscribers of an event run concurrently on a shared pool and report back through callbacks,
+the broker thread never waits on them. Events of different transactions are handled in parallel,
+events of the same transaction wait in that transaction's lane until the previous one has been
+handled by every subscriber, so subscribers see a transaction's events in order
+
+Every subscriber has a concurrency limit (deliveries beyond it wait in the subscriber's backlog)
+and a timeout. A delivery still running at its timeout counts as a failure and the event moves on,
+its thread keeps the subscriber's slot until it actually returns
+'''
+logger = logging.getLogger(__name__)
+
+
+class SubscriberSlot:
+    def __init__(self, max_concurrency, timeout):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting: deque["Delivery"] = deque()
+
+
+class EventDispatch:
+    def __init__(self, event, subscribers):
+        self.event = event
+        self.remaining = len(subscribers)
+        self.failed = []
+
+
+class Delivery:
+    def __init__(self, dispatch, subscriber, slot):
+        self.dispatch = dispatch
+        self.subscriber = subscriber
+        self.slot = slot
+        self.completed = False
+
+
+class EventDispatcher:
+    def __init__(self, deliver, on_complete, max_workers=16, max_concurrency=4, timeout=10.0):
+        self.deliver = deliver
+        self.on_complete = on_complete
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="subscriber")
+        self.slots: dict[object, SubscriberSlot] = dict()
+        self.lanes: dict[str, deque] = dict()
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        #stopped: no new events are accepted. closed: no more deliveries are started
+        self.stopped = False
+        self.closed = False
+        self.deliveries = 0
+        self.failures = 0
+        self.timeouts = 0
+
+        self.deadlines = []
+        self.sequence = itertools.count()
+        self.deadline_condition = threading.Condition()
+        self.watchdog = threading.Thread(target=self.expire_deliveries, name="subscriber-watchdog", daemon=True)
+        self.watchdog.start()
+
+    def configure(self, subscriber, max_concurrency=None, timeout=None):
+        with self.lock:
+            slot = self.get_slot(subscriber)
+            if max_concurrency is not None:
+                slot.max_concurrency = max_concurrency
+            if timeout is not None:
+                slot.timeout = timeout
+
+    #caller holds the lock
+    def get_slot(self, subscriber) -> SubscriberSlot:
+        slot = self.slots.get(subscriber)
+        if slot is None:
+            slot = SubscriberSlot(self.max_concurrency, self.timeout)
+            self.slots[subscriber] = slot
+        return slot
+
+    #queues the event behind earlier events of the same transaction, returns without waiting for subscribers
+    def dispatch(self, event, subscribers):
+        transaction_id = event.get_transaction_id()
+        with self.lock:
+            if self.stopped:
+                raise RuntimeError("event dispatcher is closed")
+            lane = self.lanes.get(transaction_id)
+            if lane is not None:
+                lane.append((event, list(subscribers)))
+                return
+            self.lanes[transaction_id] = deque()
+        self.start(event, list(subscribers))
+
+    def start(self, event, subscribers):
+        while not subscribers:
+            self.complete(event, [])
+            next_event = self.next_in_lane(event.get_transaction_id())
+            if next_event is None:
+                return
+            event, subscribers = next_event
+
+        dispatch = EventDispatch(event, subscribers)
+        with self.lock:
+            if self.closed:
+                return
+            for subscriber in subscribers:
+                delivery = Delivery(dispatch, subscriber, self.get_slot(subscriber))
+                if delivery.slot.in_flight < delivery.slot.max_concurrency:
+                    delivery.slot.in_flight += 1
+                    self.executor.submit(self.run_delivery, delivery)
+                else:
+                    delivery.slot.waiting.append(delivery)
+
+    def run_delivery(self, delivery: Delivery):
+        with self.deadline_condition:
+            heapq.heappush(self.deadlines, (time.monotonic() + delivery.slot.timeout, next(self.sequence), delivery))
+            self.deadline_condition.notify()
+        event = delivery.dispatch.event
+        start = time.perf_counter()
+        with start_span(f"deliver {type(delivery.subscriber).__name__}", parent=event.traceparent, status=event.get_status().name) as span:
+            try:
+                status = self.deliver(delivery.subscriber, event)
+            except Exception as e:
+                logger.error(f"{time.time()}: {delivery.subscriber} raised handling {event.to_string()}: {e}")
+                status = StatusCode.FAILURE
+            span.set("failed", status == StatusCode.FAILURE)
+        registry.histogram("subscriber_delivery_seconds", "time a subscriber took to handle an event", subscriber=type(delivery.subscriber).__name__).observe(time.perf_counter() - start)
+        self.finish_delivery(delivery, status)
+
+        with self.lock:
+            slot = delivery.slot
+            slot.in_flight -= 1
+            if slot.waiting and not self.closed:
+                slot.in_flight += 1
+                self.executor.submit(self.run_delivery, slot.waiting.popleft())
+
+    #first of completion and timeout wins
+    def finish_delivery(self, delivery: Delivery, status, timed_out=False):
+        dispatch = delivery.dispatch
+        with self.lock:
+            if delivery.completed:
+                return
+            delivery.completed = True
+            self.deliveries += 1
+            self.timeouts += timed_out
+            if status == StatusCode.FAILURE:
+                self.failures += 1
+                dispatch.failed.append(delivery.subscriber)
+            dispatch.remaining -= 1
+            if dispatch.remaining:
+                return
+
+        self.complete(dispatch.event, dispatch.failed)
+        next_event = self.next_in_lane(dispatch.event.get_transaction_id())
+        if next_event is not None:
+            self.start(*next_event)
+
+    def complete(self, event, failed):
+        try:
+            self.on_complete(event, failed)
+        except Exception as e:
+            logger.error(f"{time.time()}: Error completing {event.to_string()}: {e}")
+
+    def next_in_lane(self, transaction_id):
+        with self.lock:
+            lane = self.lanes[transaction_id]
+            if lane:
+                return lane.popleft()
+            del self.lanes[transaction_id]
+            self.idle.notify_all()
+            return None
+
+    def expire_deliveries(self):
+        while True:
+            with self.deadline_condition:
+                while not self.deadlines or self.deadlines[0][0] > time.monotonic():
+                    if self.closed:
+                        return
+                    self.deadline_condition.wait(self.deadlines[0][0] - time.monotonic() if self.deadlines else None)
+                _, _, delivery = heapq.heappop(self.deadlines)
+            if not delivery.completed:
+                logger.error(f"{time.time()}: {delivery.subscriber} timed out handling {delivery.dispatch.event.to_string()}")
+                self.finish_delivery(delivery, StatusCode.FAILURE, timed_out=True)
+
+    #stops accepting events, waits for the events being handled and returns the ones that never started.
+    #The watchdog keeps expiring deliveries meanwhile, then deliveries stop being started, and the
+    #executor is only shut down once nothing can submit to it any more
+    def close(self, timeout=10.0) -> list:
+        with self.lock:
+            self.stopped = True
+            unstarted = [event for lane in self.lanes.values() for event, _ in lane]
+            for lane in self.lanes.values():
+                lane.clear()
+            if not self.idle.wait_for(lambda: not self.lanes, timeout):
+                logger.warning(f"{time.time()}: {len(self.lanes)} events still being handled at shutdown")
+            self.closed = True
+            for slot in self.slots.values():
+                slot.waiting.clear()
+        with self.deadline_condition:
+            self.deadlines.clear()
+            self.deadline_condition.notify()
+        self.watchdog.join()
+        #deliveries still running are waited for, their events stay unacknowledged if they do not finish
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        return unstarted
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                "transactions_in_flight": len(self.lanes),
+                "events_waiting": sum(len(lane) for lane in self.lanes.values()),
+                "deliveries": self.deliveries,
+                "failures": self.failures,
+                "timeouts": self.timeouts,
+                "subscribers": {type(subscriber).__name__: {"in_flight": slot.in_flight, "waiting": len(slot.waiting)} for subscriber, slot in self.slots.items()}
+            }
@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+
+from Event import Event, event_from_string
+from GroupCommit import GroupCommitter, CommitTicket
+from StorageEngine import SegmentLog
+
+'''
+Durable log of the events published to the EventBroker
+
+Every event gets the next offset and is handed to a group committer before it is queued, so
+concurrent publishers share one fsync and none of them waits for it: the broker waits for the event
+to be durable before delivering it, so subscribers never see an event that is not in the log. The
+broker acknowledges an event once all of its subscribers have handled it. The committed offset is
+the highest offset up to which every event is acknowledged, and it is checkpointed every
+`checkpoint_interval` seconds. Sealed segments made only of committed events are then deleted
+
+On restart the events after the committed offset are handed to the broker again, so delivery is at
+least once: events acknowledged after the last checkpoint are delivered twice. Replay seeks straight
+to the first segment holding uncommitted events
+'''
+logger = logging.getLogger(__name__)
+
+
+class EventLog:
+    def __init__(self, directory="databases/event_log", consumer="broker", segment_size=8 * 1024 * 1024, commit_window=0.002, checkpoint_interval=1.0):
+        self.log = SegmentLog(directory, segment_size)
+        self.offsets_file = pathlib.Path(directory) / "offsets.json"
+        self.consumer = consumer
+        self.lock = threading.Lock()
+
+        self.committed_offset = self.load_offsets().get(consumer, -1)
+        self.checkpointed_offset = self.committed_offset
+        self.acknowledged: set[int] = set()
+        #writes of the events appended and not confirmed durable yet, by offset
+        self.unconfirmed: dict[int, CommitTicket] = dict()
+        #read by the broker thread during replay and by the checkpointer
+        self.segment_ends = dict()
+        self.segment_lock = threading.Lock()
+        last_offset = max([self.segment_end(segment_id) for segment_id in self.log.segments] + [self.committed_offset])
+        self.next_offset = last_offset + 1
+        #events appended by a previous run that were never acknowledged
+        self.replay_end = last_offset
+
+        self.committer = GroupCommitter(self.log.append, window=commit_window, name="event-log")
+        self.checkpoint_interval = checkpoint_interval
+        self.stopped = threading.Event()
+        self.checkpointer = threading.Thread(target=self.run_checkpoints, name="event-log-checkpoint", daemon=True)
+        self.checkpointer.start()
+
+    def load_offsets(self) -> dict:
+        try:
+            with open(self.offsets_file) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return dict()
+
+    #offset of the last event in the segment, -1 if it is empty. Only cached for sealed segments
+    def segment_end(self, segment_id):
+        with self.segment_lock:
+            if segment_id in self.segment_ends:
+                return self.segment_ends[segment_id]
+            sealed = segment_id in self.log.sealed_segments()
+            record = self.log.read_last(segment_id)
+            end = record["offset"] if record is not None else -1
+            if sealed:
+                self.segment_ends[segment_id] = end
+            return end
+
+    #sets the event's offset and submits it without waiting for the write, see wait_durable()
+    def append(self, event: Event):
+        with self.lock:
+            offset = self.next_offset
+            self.next_offset += 1
+            self.unconfirmed[offset] = self.committer.submit([{"offset": offset, **event.to_string()}])
+        event.offset = offset
+
+    #returns once the event is durable, raises and clears its offset if it could not be written
+    def wait_durable(self, event: Event):
+        with self.lock:
+            ticket = self.unconfirmed.pop(event.offset, None)
+        if ticket is None:
+            return
+        try:
+            ticket.wait()
+        except Exception:
+            #the offset will never be delivered, do not let it hold back the committed offset
+            self.acknowledge(event.offset)
+            event.offset = None
+            raise
+
+    def acknowledge(self, offset):
+        with self.lock:
+            if offset <= self.committed_offset:
+                return
+            self.acknowledged.add(offset)
+            while self.committed_offset + 1 in self.acknowledged:
+                self.committed_offset += 1
+                self.acknowledged.remove(self.committed_offset)
+
+    #events left unacknowledged by the previous run, in offset order
+    def replay(self):
+        committed = self.committed_offset
+        count = 0
+        started = time.time()
+        for segment_id in list(self.log.segments):
+            if self.segment_end(segment_id) <= committed:
+                continue
+            for record in self.log.read_segment(segment_id):
+                if record["offset"] > self.replay_end:
+                    break
+                if record["offset"] > committed:
+                    event = event_from_string(record)
+                    event.offset = record["offset"]
+                    count += 1
+                    yield event
+        logger.info(f"Replayed {count} unacknowledged events in {time.time() - started:.3f}s")
+
+    def checkpoint(self):
+        with self.lock:
+            committed = self.committed_offset
+        if committed == self.checkpointed_offset:
+            return
+        offsets = self.load_offsets()
+        offsets[self.consumer] = committed
+        tmp_path = self.offsets_file.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(offsets, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.offsets_file)
+        self.checkpointed_offset = committed
+
+        #segments are only deleted once the offset covering them is durable
+        done = [segment_id for segment_id in self.log.sealed_segments() if self.segment_end(segment_id) <= committed]
+        if done:
+            self.log.drop_segments(done)
+            with self.segment_lock:
+                for segment_id in done:
+                    self.segment_ends.pop(segment_id, None)
+            logger.info(f"Dropped {len(done)} acknowledged event log segments")
+
+    def run_checkpoints(self):
+        while not self.stopped.wait(self.checkpoint_interval):
+            try:
+                self.checkpoint()
+            except Exception as e:
+                logger.error(f"{time.time()}: Error checkpointing event log offsets: {e}")
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                "next_offset": self.next_offset,
+                "committed_offset": self.committed_offset,
+                "unacknowledged": self.next_offset - 1 - self.committed_offset,
+                "segments": len(self.log.segments)
+            }
+
+    def close(self):
+        self.stopped.set()
+        self.checkpointer.join()
+        self.committer.close()
+        self.checkpoint()
+        self.log.close()
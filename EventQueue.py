@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import deque
+
+'''
+Bounded blocking queue between the event publishers and the EventBroker
+
+The broker thread sleeps on a condition variable while the queue is empty instead of polling it.
+Publishers block while the queue is full, so a slow broker slows down the producers rather than
+letting the backlog grow without bound. put(block=False) ignores the bound, it is meant for the
+broker itself, which would otherwise wait on its own queue
+'''
+
+
+class EventQueue:
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.events = deque()
+        self.condition = threading.Condition()
+        self.published = 0
+        self.consumed = 0
+        self.high_water_mark = 0
+        self.blocked_puts = 0
+        self.blocked_seconds = 0.0
+
+    def __len__(self):
+        return len(self.events)
+
+    #returns False if the queue stayed full for timeout seconds
+    def put(self, event, block=True, timeout=None) -> bool:
+        with self.condition:
+            if block and len(self.events) >= self.capacity:
+                if timeout == 0:
+                    return False
+                self.blocked_puts += 1
+                started = time.monotonic()
+                has_space = self.condition.wait_for(lambda: len(self.events) < self.capacity, timeout)
+                self.blocked_seconds += time.monotonic() - started
+                if not has_space:
+                    return False
+            self.events.append(event)
+            self.published += 1
+            self.high_water_mark = max(self.high_water_mark, len(self.events))
+            self.condition.notify_all()
+            return True
+
+    #returns None if no event arrived within timeout seconds
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.events, timeout):
+                return None
+            event = self.events.popleft()
+            self.consumed += 1
+            self.condition.notify_all()
+            return event
+
+    def drain(self) -> list:
+        with self.condition:
+            events = list(self.events)
+            self.events.clear()
+            self.consumed += len(events)
+            self.condition.notify_all()
+            return events
+
+    def get_metrics(self):
+        with self.condition:
+            return {
+                "depth": len(self.events),
+                "capacity": self.capacity,
+                "high_water_mark": self.high_water_mark,
+                "published": self.published,
+                "consumed": self.consumed,
+                "blocked_puts": self.blocked_puts,
+                "blocked_seconds": round(self.blocked_seconds, 6)
+            }
@@ -1,9 +1,10 @@
 from abc import ABC, abstractmethod
-import requests
 import logging
 import time
 
 from Backend import StatusCode
+from TransactionCache import transaction_cache
+from StructuredLogging import add_log_file
 '''
 RESTFUL API - CRUD 
 uniformed representations - resources as URI, not actions, interact directly with resources
@@ -20,55 +21,50 @@ payment state machine:
 - settled
 '''
 
-logger = logging.getLogger(__name__)
-logger.propagate = False  
-handler = logging.FileHandler("logs/subscriber_logs.txt")
-logger.addHandler(handler)
+logger = add_log_file(__name__, "logs/subscriber_logs.jsonl")
 
 
 #Subscribers
 class EventSubscriber(ABC):
+    #details is the snapshot carried by the event, None if the publisher did not have it
     @abstractmethod
-    def handle_event(self, database_server, transaction_id) -> StatusCode: 
+    def handle_event(self, database_router, transaction_id, details=None) -> StatusCode: 
         pass
 
+    def get_details(self, database_router, transaction_id, details):
+        if details is not None:
+            return dict(details)
+        return transaction_cache.get(database_router, transaction_id)
+
 class AnalyticsSubscriber(EventSubscriber):
-    def handle_event(self, database_server, transaction_id) -> StatusCode:
+    def handle_event(self, database_router, transaction_id, details=None) -> StatusCode:
         try:
-            param_json = {"transaction_id": transaction_id}
-            response = requests.get(f"{database_server}/txn", params=param_json)
-            if response.status_code == 200:
-                details = response.json()["details"]
-                logger.info(f"{time.time()}: Transaction {transaction_id} logged for analytics: transaction details: {details}")
-                logger.info(f"{time.time()}: Transaction {transaction_id} logged for analytics: transaction details: {details}")
+            details = self.get_details(database_router, transaction_id, details)
+            if details is not None:
+                logger.info("Transaction %s logged for analytics: transaction details: %s", transaction_id, details)
                 return StatusCode.SUCCESS
         except Exception as e:
-            logger.error(f"{time.time()}: Error occurred logging transaction for analytics. Error {str(e)}")
+            logger.error("Error occurred logging transaction for analytics. Error %s", e)
         return StatusCode.FAILURE
 
 class EmailSubscriber(EventSubscriber):
-    def handle_event(self, database_server, transaction_id) -> StatusCode: 
+    def handle_event(self, database_router, transaction_id, details=None) -> StatusCode: 
         try:
-            param_json = {"transaction_id": transaction_id}
-            response = requests.get(f"{database_server}/txn", params=param_json)
-            if response.status_code == 200:
-                details = response.json()["details"]
-                logger.info(f"{time.time()}: Transaction {transaction_id} details sent to merchant: transaction details: {details}")
+            details = self.get_details(database_router, transaction_id, details)
+            if details is not None:
+                logger.info("Transaction %s details sent to merchant: transaction details: %s", transaction_id, details)
                 return StatusCode.SUCCESS
         except Exception as e:
-            logger.error(f"{time.time()}: Error occurred sending details to merchant. Error {str(e)}")
+            logger.error("Error occurred sending details to merchant. Error %s", e)
         return StatusCode.FAILURE
 
 class SupportSubscriber(EventSubscriber):
-    def handle_event(self, database_server, transaction_id) -> StatusCode:
+    def handle_event(self, database_router, transaction_id, details=None) -> StatusCode:
         try:
-            param_json = {"transaction_id": transaction_id}
-            response = requests.get(f"{database_server}/txn", params=param_json)
-            if response.status_code == 200:
-                details = response.json()["details"]
-                logger.info(f"{time.time()}: Transaction {transaction_id} details sent to support personnnel: transaction details: {details}")
-                print("support", )
+            details = self.get_details(database_router, transaction_id, details)
+            if details is not None:
+                logger.info("Transaction %s details sent to support personnnel: transaction details: %s", transaction_id, details)
                 return StatusCode.SUCCESS
         except Exception as e:
-            logger.error(f"{time.time()}: Error occurred sending details to support personnnel. Error {str(e)}")
+            logger.error("Error occurred sending details to support personnnel. Error %s", e)
         return StatusCode.FAILURE
\ No newline at end of file
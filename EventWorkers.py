@@ -0,0 +1,286 @@
+import itertools
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from collections import deque
+
+from Event import event_from_string
+from EventDispatcher import EventDispatcher
+from Router import ShardRouter, hash_token
+from TransactionCache import transaction_cache
+from Tracing import configure_tracing, get_tracing_settings, close_tracing
+from StructuredLogging import close_logging
+
+'''
+Event subscribers hosted in worker processes
+
+Events are split by transaction id into `partitions` streams. Every partition is owned by one
+worker process, which runs the subscribers through its own EventDispatcher, so side effects use
+their own cores and do not compete with the payment api for the GIL. A transaction always maps to
+the same partition, and a partition only moves to another worker once the events it sent to the
+previous owner are done, so every transaction's events are still handled in order
+
+Partitions are spread evenly over the live workers and rebalanced when a worker joins or leaves.
+A crashed worker is replaced, and the events it had not finished are sent again to the new owner
+of their partition
+'''
+logger = logging.getLogger(__name__)
+
+
+#entry point of a worker process
+def run_worker(worker_id, subscribers, subscriber_limits, database_servers, settings, tracing, inbox, results):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure_tracing(**{**tracing, "service_name": f"{tracing['service_name']}:worker-{worker_id}"})
+    routers = [ShardRouter(database_servers)]
+    dispatcher = EventDispatcher(
+        lambda subscriber, event: subscriber.handle_event(routers[0], event.get_transaction_id(), event.get_details()),
+        lambda event, failed: results.put((worker_id, event.offset, [type(subscriber).__name__ for subscriber in failed])),
+        **settings
+    )
+    for subscriber, limits in subscriber_limits.items():
+        dispatcher.configure(subscriber, **limits)
+
+    while True:
+        message = inbox.get()
+        match message[0]:
+            case "event":
+                _, sequence, record = message
+                event = event_from_string(record)
+                event.offset = sequence
+                transaction_cache.invalidate(event.get_transaction_id())
+                dispatcher.dispatch(event, subscribers.get(event.get_status(), []))
+            case "servers":
+                routers[0] = ShardRouter(message[1])
+            case "stop":
+                break
+    dispatcher.close()
+    close_tracing()
+    close_logging()
+
+
+class WorkerHandle:
+    def __init__(self, worker_id, process, inbox):
+        self.worker_id = worker_id
+        self.process = process
+        self.inbox = inbox
+        self.leaving = False
+        self.in_flight = 0
+
+
+class Partition:
+    def __init__(self):
+        self.owner = None
+        #worker the partition moves to once the events in flight at the owner are done
+        self.target = None
+        self.in_flight = 0
+        self.held: deque[int] = deque()
+
+
+class EventWorkerPool:
+    def __init__(self, subscribers, subscriber_limits, database_servers, on_complete, workers=2, partitions=64, max_workers=16, max_concurrency=4, timeout=10.0):
+        self.context = multiprocessing.get_context("spawn")
+        self.subscribers = {status: list(status_subscribers) for status, status_subscribers in subscribers.items()}
+        self.subscriber_limits = dict(subscriber_limits)
+        self.database_servers = list(database_servers)
+        self.settings = {"max_workers": max_workers, "max_concurrency": max_concurrency, "timeout": timeout}
+        self.on_complete = on_complete
+
+        self.lock = threading.Lock()
+        self.workers: dict[int, WorkerHandle] = dict()
+        self.worker_ids = itertools.count()
+        self.partitions = [Partition() for _ in range(partitions)]
+        #sequence -> (event, partition, worker id), worker id is None while the event is held
+        self.in_flight: dict[int, list] = dict()
+        self.sequence = itertools.count()
+        self.restarts = 0
+        self.moves = 0
+        self.stopped = False
+
+        self.results = self.context.Queue()
+        self.collector = threading.Thread(target=self.collect_results, name="event-worker-results", daemon=True)
+        self.collector.start()
+        with self.lock:
+            for _ in range(workers):
+                self.start_worker()
+            self.rebalance()
+        self.supervisor = threading.Thread(target=self.supervise, name="event-worker-supervisor", daemon=True)
+        self.supervisor.start()
+
+    #caller holds the lock
+    def start_worker(self):
+        worker_id = next(self.worker_ids)
+        inbox = self.context.Queue()
+        process = self.context.Process(
+            target=run_worker,
+            args=(worker_id, self.subscribers, self.subscriber_limits, self.database_servers, self.settings, get_tracing_settings(), inbox, self.results),
+            name=f"event-worker-{worker_id}",
+            daemon=True
+        )
+        process.start()
+        self.workers[worker_id] = WorkerHandle(worker_id, process, inbox)
+        logger.info(f"Event worker {worker_id} started (pid {process.pid})")
+
+    def partition_of(self, transaction_id):
+        return hash_token(transaction_id) % len(self.partitions)
+
+    #same interface as EventDispatcher.dispatch, the workers hold their own subscribers
+    def dispatch(self, event, subscribers=None):
+        sequence = next(self.sequence)
+        partition_id = self.partition_of(event.get_transaction_id())
+        with self.lock:
+            if self.stopped:
+                raise RuntimeError("event worker pool is closed")
+            self.in_flight[sequence] = [event, partition_id, None]
+            partition = self.partitions[partition_id]
+            if partition.owner is None or partition.target is not None or partition.held:
+                partition.held.append(sequence)
+            else:
+                self.send(sequence, partition.owner)
+
+    #caller holds the lock
+    def send(self, sequence, worker_id):
+        entry = self.in_flight[sequence]
+        worker = self.workers[worker_id]
+        entry[2] = worker_id
+        worker.in_flight += 1
+        self.partitions[entry[1]].in_flight += 1
+        worker.inbox.put(("event", sequence, entry[0].to_string()))
+
+    #caller holds the lock
+    def release_held(self, partition: Partition):
+        while partition.held and partition.owner is not None and partition.target is None:
+            self.send(partition.held.popleft(), partition.owner)
+
+    #caller holds the lock. Partitions whose owner still has events in flight move once those are done
+    def rebalance(self):
+        live = sorted(worker_id for worker_id, worker in self.workers.items() if not worker.leaving)
+        for partition_id, partition in enumerate(self.partitions):
+            desired = live[partition_id % len(live)] if live else None
+            if desired == (partition.target if partition.target is not None else partition.owner):
+                continue
+            if partition.owner is None or partition.in_flight == 0 or desired == partition.owner:
+                partition.owner, partition.target = desired, None
+                self.release_held(partition)
+            else:
+                partition.target = desired
+            self.moves += 1
+
+    def collect_results(self):
+        while True:
+            try:
+                worker_id, sequence, failed = self.results.get(timeout=0.5)
+            except queue.Empty:
+                if self.stopped and not self.in_flight:
+                    return
+                continue
+            except (EOFError, OSError):
+                return
+            with self.lock:
+                entry = self.in_flight.get(sequence)
+                #results of a worker that was declared dead after its events were sent elsewhere
+                if entry is None or entry[2] != worker_id:
+                    continue
+                del self.in_flight[sequence]
+                event, partition_id, _ = entry
+                self.workers[worker_id].in_flight -= 1
+                partition = self.partitions[partition_id]
+                partition.in_flight -= 1
+                if partition.target is not None and partition.in_flight == 0:
+                    partition.owner, partition.target = partition.target, None
+                    self.release_held(partition)
+            try:
+                self.on_complete(event, failed)
+            except Exception as e:
+                logger.error(f"{time.time()}: Error completing {event.to_string()}: {e}")
+
+    #replaces crashed workers and stops workers that have handed over all their partitions
+    def supervise(self):
+        while not self.stopped:
+            time.sleep(0.5)
+            with self.lock:
+                if self.stopped:
+                    return
+                for worker_id, worker in list(self.workers.items()):
+                    if worker.leaving and worker.in_flight == 0 and not self.owns_partitions(worker_id):
+                        worker.inbox.put(("stop",))
+                        del self.workers[worker_id]
+                    elif not worker.process.is_alive():
+                        logger.error(f"{time.time()}: Event worker {worker_id} exited with code {worker.process.exitcode}")
+                        self.remove_dead_worker(worker_id)
+                        if not worker.leaving:
+                            self.restarts += 1
+                            self.start_worker()
+                        self.rebalance()
+
+    #caller holds the lock
+    def owns_partitions(self, worker_id):
+        return any(worker_id in (partition.owner, partition.target) for partition in self.partitions)
+
+    #caller holds the lock. Events the worker had not finished go back to the front of their partition
+    def remove_dead_worker(self, worker_id):
+        del self.workers[worker_id]
+        unfinished = dict()
+        for sequence, entry in self.in_flight.items():
+            if entry[2] == worker_id:
+                entry[2] = None
+                unfinished.setdefault(entry[1], []).append(sequence)
+        for partition_id, partition in enumerate(self.partitions):
+            sequences = unfinished.get(partition_id, [])
+            partition.in_flight -= len(sequences)
+            partition.held = deque(sorted(sequences + list(partition.held)))
+            if partition.owner == worker_id:
+                partition.owner = None
+            if partition.target == worker_id:
+                partition.target = None
+            if partition.target is not None and partition.in_flight == 0:
+                partition.owner, partition.target = partition.target, None
+            self.release_held(partition)
+
+    #workers join or leave until `workers` are running, partitions follow
+    def resize(self, workers):
+        with self.lock:
+            live = [worker for worker in self.workers.values() if not worker.leaving]
+            for _ in range(workers - len(live)):
+                self.start_worker()
+            for worker in live[max(workers, 0):]:
+                worker.leaving = True
+            self.rebalance()
+
+    def set_database_servers(self, servers):
+        with self.lock:
+            self.database_servers = list(servers)
+            for worker in self.workers.values():
+                worker.inbox.put(("servers", self.database_servers))
+
+    #stops accepting events, waits for the workers to finish theirs and returns the events left over
+    def close(self, timeout=10.0) -> list:
+        with self.lock:
+            self.stopped = True
+        deadline = time.monotonic() + timeout
+        while self.in_flight and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with self.lock:
+            for worker in self.workers.values():
+                worker.inbox.put(("stop",))
+            workers = list(self.workers.values())
+            unfinished = [entry[0] for _, entry in sorted(self.in_flight.items())]
+        for worker in workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        return unfinished
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                "workers": {worker_id: {"pid": worker.process.pid, "alive": worker.process.is_alive(), "leaving": worker.leaving, "in_flight": worker.in_flight, "partitions": sum(partition.owner == worker_id for partition in self.partitions)} for worker_id, worker in self.workers.items()},
+                "partitions": len(self.partitions),
+                "partitions_moving": sum(partition.target is not None for partition in self.partitions),
+                "events_in_flight": len(self.in_flight),
+                "events_held": sum(len(partition.held) for partition in self.partitions),
+                "moves": self.moves,
+                "restarts": self.restarts
+            }
@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from Metrics import registry, SIZE_BUCKETS
+
+'''
+Group commit
+
+Writers hand their records to the committer and block until the batch holding them is durable.
+Records that arrive within `window` seconds of the first pending record (or until `max_batch`
+records are pending) are flushed together, so many concurrent writers share one fsync.
+submit() queues records without waiting, which makes the committer a plain time/size batcher.
+With `concurrency` above 1, up to that many batches are flushed at once on a pool of threads while
+the next batch is collected, for flushes that wait on a remote service rather than a disk
+'''
+logger = logging.getLogger(__name__)
+
+
+class CommitTicket:
+    def __init__(self, records):
+        self.records = records
+        self.done = threading.Event()
+        self.error = None
+
+    #blocks until the records are durable, re-raises the flush error otherwise
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class GroupCommitter:
+    def __init__(self, flush, window=0.002, max_batch=128, name="group-commit", concurrency=1):
+        self.flush = flush
+        self.window = window
+        self.max_batch = max_batch
+        #batches start flushing only when one of the `concurrency` flushes is free
+        self.executor = ThreadPoolExecutor(concurrency, thread_name_prefix=name) if concurrency > 1 else None
+        self.flush_slots = threading.Semaphore(concurrency)
+        self.pending: list[CommitTicket] = []
+        self.pending_records = 0
+        self.first_arrival = None
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.batch_records = registry.histogram("group_commit_batch_records", "records flushed together", buckets=SIZE_BUCKETS, committer=name)
+        self.flush_seconds = registry.histogram("group_commit_flush_seconds", "time of a flush", committer=name)
+        self.flush_errors = registry.counter("group_commit_flush_errors_total", "flushes that raised", committer=name)
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    #blocks until the records are durable, re-raises the flush error otherwise
+    def commit(self, records):
+        self.submit(records).wait()
+
+    #queues the records for the next batch without waiting for it to be flushed
+    def submit(self, records) -> CommitTicket:
+        ticket = CommitTicket(records)
+        with self.condition:
+            if self.stopped:
+                raise RuntimeError("group committer is closed")
+            if not self.pending:
+                self.first_arrival = time.monotonic()
+            self.pending.append(ticket)
+            self.pending_records += len(records)
+            self.condition.notify()
+        return ticket
+
+    def run(self):
+        while True:
+            #records keep collecting while every flush is busy
+            if self.executor is not None:
+                self.flush_slots.acquire()
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                deadline = self.first_arrival + self.window
+                while not self.stopped and self.pending_records < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.take_batch()
+
+            if self.executor is None:
+                self.flush_batch(batch)
+            else:
+                self.executor.submit(self.flush_batch, batch)
+
+    #a single flush takes everything pending, concurrent flushes take up to max_batch records each so
+    #a backlog is spread over the free flushes. Records left pending are flushed without waiting again
+    def take_batch(self) -> list[CommitTicket]:
+        if self.executor is None:
+            batch = self.pending
+        else:
+            taken = records = 0
+            while taken < len(self.pending) and (taken == 0 or records + len(self.pending[taken].records) <= self.max_batch):
+                records += len(self.pending[taken].records)
+                taken += 1
+            batch = self.pending[:taken]
+        self.pending = self.pending[len(batch):]
+        self.pending_records -= sum(len(ticket.records) for ticket in batch)
+        return batch
+
+    def flush_batch(self, batch: list[CommitTicket]):
+        error = None
+        records = [record for ticket in batch for record in ticket.records]
+        self.batch_records.observe(len(records))
+        try:
+            with self.flush_seconds.time():
+                self.flush(records)
+        except Exception as e:
+            logger.error(f"Error flushing batch of {len(batch)} commits: {e}")
+            self.flush_errors.inc()
+            error = e
+        finally:
+            if self.executor is not None:
+                self.flush_slots.release()
+
+        for ticket in batch:
+            ticket.error = error
+            ticket.done.set()
+
+    #flushes whatever is pending before returning
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from CustomExceptions import IdempotencyKeyReuseError
+from GroupCommit import GroupCommitter
+from StorageEngine import SegmentLog
+
+'''
+Idempotency keys of POST /v1/txn
+
+Requests are keyed by their transaction token. The first request with a key runs the payment, the
+ones arriving while it runs wait for its response instead of running it again, and later ones get
+the stored response straight away. A key reused for a different payment is refused
+
+Completed responses are kept for `ttl` seconds in an LRU bounded to `capacity` keys, and appended to
+a segment log without waiting for the fsync, so a restart keeps all but the last few milliseconds
+of them. Sealed segments are folded into the live keys in the background
+'''
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyEntry:
+    def __init__(self, fingerprint, response=None, expires_at=None):
+        self.fingerprint = fingerprint
+        #resolves to the response, or to None if the request failed without one
+        self.future = Future()
+        self.expires_at = expires_at
+        if response is not None:
+            self.future.set_result(response)
+
+
+class IdempotencyCache:
+    def __init__(self, capacity=10000, ttl=24 * 60 * 60, directory="databases/idempotency", segment_size=1024 * 1024, compaction_interval=60, min_sealed_segments=4):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.in_flight: dict[str, IdempotencyEntry] = dict()
+        self.completed: OrderedDict[str, IdempotencyEntry] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+        self.log = SegmentLog(directory, segment_size=segment_size)
+        self.log.seal()
+        self.load()
+        self.committer = GroupCommitter(self.log.append, name="idempotency-log")
+        self.compaction_interval = compaction_interval
+        self.min_sealed_segments = min_sealed_segments
+        self.stop_event = threading.Event()
+        self.compaction_thread = threading.Thread(target=self.run_compaction, name="idempotency-log-compaction", daemon=True)
+        self.compaction_thread.start()
+
+    #latest live record of every key, oldest first and at most capacity of them
+    def live_records(self, segment_ids):
+        now = time.time()
+        records = OrderedDict()
+        for record in self.log.read(segment_ids):
+            records.pop(record["key"], None)
+            if record["expires_at"] > now:
+                records[record["key"]] = record
+        return list(records.values())[-self.capacity:]
+
+    def load(self):
+        sealed = self.log.sealed_segments()
+        records = self.live_records(sealed)
+        for record in records:
+            self.completed[record["key"]] = IdempotencyEntry(record["fingerprint"], tuple(record["response"]), record["expires_at"])
+        self.log.replace_segments(sealed, records)
+        logger.info(f"Loaded {len(records)} idempotency keys")
+
+    def run_compaction(self):
+        while not self.stop_event.wait(self.compaction_interval):
+            try:
+                sealed = self.log.sealed_segments()
+                if len(sealed) >= self.min_sealed_segments:
+                    self.log.replace_segments(sealed, self.live_records(sealed))
+            except Exception as e:
+                logger.error(f"Error compacting idempotency log: {e}")
+
+    #the entry of the key and whether the caller is the one to run the request
+    def begin(self, key, fingerprint) -> tuple[IdempotencyEntry, bool]:
+        with self.lock:
+            entry = self.in_flight.get(key)
+            if entry is not None:
+                self.coalesced += 1
+            else:
+                entry = self.completed.get(key)
+                if entry is not None and entry.expires_at <= time.time():
+                    del self.completed[key]
+                    entry = None
+                if entry is not None:
+                    self.completed.move_to_end(key)
+                    self.hits += 1
+            if entry is not None:
+                if entry.fingerprint != fingerprint:
+                    raise IdempotencyKeyReuseError(f"idempotency key {key} was used for a different transaction")
+                return entry, False
+            self.misses += 1
+            entry = IdempotencyEntry(fingerprint)
+            self.in_flight[key] = entry
+            return entry, True
+
+    #stores the response if it can be replayed, otherwise the next request with the key runs again
+    def complete(self, key, entry: IdempotencyEntry, response, store=True):
+        with self.lock:
+            del self.in_flight[key]
+            if store:
+                entry.expires_at = time.time() + self.ttl
+                self.completed[key] = entry
+                while len(self.completed) > self.capacity:
+                    self.completed.popitem(last=False)
+                    self.evictions += 1
+        entry.future.set_result(response if store else None)
+        if store:
+            try:
+                self.committer.submit([{"key": key, "fingerprint": entry.fingerprint, "response": list(response), "expires_at": entry.expires_at}])
+            except RuntimeError as e:
+                logger.warning(f"Idempotency key {key} not persisted: {e}")
+
+    #returns the response and whether it was replayed. Raises IdempotencyKeyReuseError
+    def execute(self, key, fingerprint, action, cacheable=lambda response: True):
+        while True:
+            entry, owner = self.begin(key, fingerprint)
+            if owner:
+                break
+            response = entry.future.result()
+            if response is not None:
+                return response, True
+        try:
+            response = action()
+        except BaseException:
+            self.complete(key, entry, None, store=False)
+            raise
+        self.complete(key, entry, response, store=cacheable(response))
+        return response, False
+
+    #same as execute for a coroutine action, waiting for a running duplicate does not block the event loop
+    async def execute_async(self, key, fingerprint, action, cacheable=lambda response: True):
+        while True:
+            entry, owner = self.begin(key, fingerprint)
+            if owner:
+                break
+            response = await asyncio.wrap_future(entry.future)
+            if response is not None:
+                return response, True
+        try:
+            response = await action()
+        except BaseException:
+            self.complete(key, entry, None, store=False)
+            raise
+        self.complete(key, entry, response, store=cacheable(response))
+        return response, False
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                "size": len(self.completed),
+                "capacity": self.capacity,
+                "in_flight": len(self.in_flight),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions
+            }
+
+    def close(self):
+        self.stop_event.set()
+        self.compaction_thread.join()
+        self.committer.close()
+        self.log.close()
@@ -5,7 +5,11 @@ import logging
 import time
 
 #user defined libraries
+from BalanceEngine import BalanceEngine
 from CustomExceptions import DirtyCacheError
+from Metrics import registry, instrument_app, SIZE_BUCKETS
+from Tracing import configure_tracing, close_tracing, trace_app
+from StructuredLogging import configure_logging
 
 '''
 RESTFUL API - CRUD 
@@ -24,11 +28,14 @@ Rough payment workflow
 5. releasing funds to business 
 '''
 logger = logging.getLogger()
-logging.basicConfig(filename='logs/issuer_logs.txt', level=logging.INFO)
+configure_logging("logs/issuer_logs.jsonl", service="issuer")
 
 class StatusCode:
     SUCCESS = 0
     FAILURE = 1
+    UNAVAILABLE = 2
+
+AUTHORISATION_OUTCOMES = {StatusCode.SUCCESS: "authorised", StatusCode.UNAVAILABLE: "unavailable"}
 
 
 class Transaction:
@@ -43,6 +50,8 @@ class Transaction:
 
 #endpoints
 app = Flask(__name__)
+instrument_app(app)
+trace_app(app)
 @app.route("/v1/status", methods=["GET"])
 def get_status():
     return {"message": "issuer running"}, 200
@@ -50,29 +59,66 @@ def get_status():
 @app.route("/v1/txn", methods=["POST"])
 def create_transaction():
     info = request.get_json()
-    logger.info(f"Transaction received: {info}")
+    logger.info("Transaction received: %s", info)
     transaction = Transaction(info["payer"], info["payee"], float(info["amount"]))
-    status = issuer.check_validity(transaction)
+    status = issuer.authorise_batch([transaction])[0]
     if status == StatusCode.SUCCESS:
-        issuer.authorise(transaction)
         return {"message": "transaction authorised"}, 200
+    elif status == StatusCode.UNAVAILABLE:
+        return {"message": "transaction not recorded"}, 500
     else:
         return {"message": "transaction rejected"}, 500
 
+@app.route("/v1/txn:batch", methods=["POST"])
+def create_transactions():
+    transactions = [Transaction(info["payer"], info["payee"], float(info["amount"])) for info in request.get_json()["transactions"]]
+    logger.info("Batch of %d transactions received", len(transactions))
+    registry.histogram("issuer_authorisation_batch_transactions", "transactions authorised per request", buckets=SIZE_BUCKETS).observe(len(transactions))
+    statuses = issuer.authorise_batch(transactions)
+    results = []
+    for status in statuses:
+        result = {"authorised": status == StatusCode.SUCCESS, "retryable": False}
+        if status == StatusCode.SUCCESS:
+            result["message"] = "transaction authorised"
+        elif status == StatusCode.UNAVAILABLE:
+            result.update(message="transaction not recorded", retryable=True)
+        else:
+            result["message"] = "transaction rejected"
+        results.append(result)
+    return {"message": f"{statuses.count(StatusCode.SUCCESS)}/{len(transactions)} transactions authorised", "results": results}, 200
+
+#GET /v1/user/txn?user=...&since=...&until=...&limit=...&cursor=...
+@app.route("/v1/user/txn", methods=["GET"])
+def get_user_transactions():
+    user = request.args.get("user")
+    try:
+        since = request.args.get("since", type=float)
+        until = request.args.get("until", type=float)
+        limit = request.args.get("limit", default=100, type=int)
+        cursor = request.args.get("cursor", type=int)
+    except ValueError as e:
+        return {"message": f"Invalid query: {e}", "transactions": [], "next_cursor": None}, 400
+
+    history = issuer.get_history(user, since=since, until=until, limit=limit, cursor=cursor)
+    if history is None:
+        return {"message": f"user {user} not found", "transactions": [], "next_cursor": None}, 500
+    transactions, next_cursor = history
+    return {"message": f"{len(transactions)} transactions found", "transactions": transactions, "next_cursor": next_cursor}, 200
+
 @app.route("/v1/user", methods=["POST"])
 def create_user():
     user = request.get_json()["user"]
     status = issuer.create_user(user)
     if status == StatusCode.SUCCESS:
-        logger.info(f"User {user} created by admin")
+        logger.info("User %s created by admin", user)
         return {"message": f"user {user} created"}, 200
     return {"message": f"user {user} not created"}, 500
 
 
 class Issuer:
-    def __init__(self, database_file):
+    def __init__(self, database_file, journal_directory="databases/usr_journal"):
         self.database_file = database_file
-        self.users = self.load_user_data(database_file)
+        self.balances = BalanceEngine(self.load_user_data(database_file), database_file, journal_directory)
     
     def load_user_data(self, database_file):
         try:
@@ -94,47 +140,32 @@ class Issuer:
                 logger.info(f"{time.time()}: user data successfully loaded")
             return user_data
     
-    def check_validity(self, transaction: Transaction) -> StatusCode:
-        payer, payee, amount = transaction.get_transaction_information()
-        if payer not in self.users:
-            return StatusCode.FAILURE
-        if self.users[payer]["balance"] < amount:
-            return StatusCode.FAILURE
-        return StatusCode.SUCCESS
-
-    def authorise(self, transaction: Transaction) -> StatusCode:
-        payer, payee, amount = transaction.get_transaction_information()
-        self.users[payer]["balance"] -= amount
-        self.users[payer]["transactions"].append((time.time(), payee, amount))
-        try:
-            with open(self.database_file, "w") as file:
-                json.dump(self.users, file, indent=4)
-        except Exception as e:
-            logger.error(f"Error occurred recording transaction: {e}")
-        else:
-            return StatusCode.SUCCESS
-        return StatusCode.FAILURE
+    #every debit is checked and applied atomically by the balance engine
+    def authorise_batch(self, transactions: list[Transaction]) -> list[StatusCode]:
+        statuses = self.balances.debit_batch([transaction.get_transaction_information() for transaction in transactions])
+        for status in statuses:
+            registry.counter("issuer_authorisations_total", "transactions authorised, rejected or not recorded", outcome=AUTHORISATION_OUTCOMES.get(status, "rejected")).inc()
+        return statuses
 
     def create_user(self, user):
-        self.users[user] = {
-            "balance": 1000,
-            "transactions": []
-        }
+        return self.balances.open_account(user, 1000)
 
-        try:
-            with open(self.database_file, "w") as file:
-                json.dump(self.users, file, indent=4)
-        except Exception as e:
-            logger.error(f"Error occurred recording transaction: {e}")
-        else:
-            return StatusCode.SUCCESS
-        return StatusCode.FAILURE
+    def get_history(self, user, since=None, until=None, limit=100, cursor=None):
+        return self.balances.get_history(user, since=since, until=until, limit=limit, cursor=cursor)
+
+    def close(self):
+        self.balances.close()
 
 
 
 if __name__ == "__main__":
     issuer = Issuer("databases/usr_database.json")
-    app.run(port=8002)
+    configure_tracing(service_name="issuer")
+    try:
+        app.run(port=8002)
+    finally:
+        issuer.close()
+        close_tracing()
     
 
 
@@ -0,0 +1,242 @@
+import argparse
+import logging
+import time
+from collections import defaultdict
+
+from Event import Event, TerminatedEvent, TransactionStatus
+from EventSubscriber import EventSubscriber
+from Backend import retry_with_backoff
+from CustomExceptions import LoggingTransactionStatusError
+from GroupCommit import GroupCommitter
+from EventQueue import EventQueue
+from EventDispatcher import EventDispatcher
+from EventLog import EventLog
+from EventWorkers import EventWorkerPool
+from TransactionCache import transaction_cache
+from Metrics import registry, flatten_metrics
+from Router import ShardRouter
+from ServiceClient import http_post
+
+'''
+Parts of the main service shared by main.py (Flask) and AsyncMain.py (Quart): the command line
+arguments, the EventBroker and the metrics of the broker's components. Importing it sets up no app
+and no logging, each service does that itself
+'''
+logger = logging.getLogger(__name__)
+
+def set_up_parser():
+    parser = argparse.ArgumentParser(
+                    prog="payment api",
+                    description="A simple payment api program using microservices and EDA",
+                    epilog="...")
+    parser.add_argument("-database_server", help="comma separated urls of the database shards")
+    parser.add_argument("-issuer_server", help="url of issuer server")
+    parser.add_argument("-pool_size", type=int, default=16, help="max keep-alive connections per upstream service")
+    parser.add_argument("-http_timeout", type=float, default=5, help="default timeout in seconds of calls to other services")
+    parser.add_argument("-event_log_directory", default="databases/event_log", help="directory of the durable event log")
+    parser.add_argument("-event_queue_size", type=int, default=10000, help="max events waiting for the event broker, publishers block beyond it")
+    parser.add_argument("-event_workers", type=int, default=0, help="worker processes hosting the event subscribers, 0 runs them in the main process")
+    parser.add_argument("-event_partitions", type=int, default=64, help="partitions of the event stream shared out between the event workers")
+    parser.add_argument("-authorisation_batch_window_ms", type=float, default=2, help="milliseconds concurrent issuer authorisations are collected for before being sent together")
+    parser.add_argument("-authorisation_batch_size", type=int, default=64, help="max issuer authorisations sent in one request")
+    parser.add_argument("-authorisation_pipeline_depth", type=int, default=4, help="max batches of issuer authorisations waiting on the issuer at once")
+    parser.add_argument("-idempotency_cache_size", type=int, default=10000, help="max transaction responses kept for replay to retried requests")
+    parser.add_argument("-idempotency_ttl", type=float, default=24 * 60 * 60, help="seconds a transaction response is replayed to retried requests")
+    parser.add_argument("-transaction_cache_size", type=int, default=10000, help="max transaction details cached by the main service")
+    parser.add_argument("-transaction_cache_negative_ttl", type=float, default=2, help="seconds a transaction missing from the database is remembered as missing")
+    parser.add_argument("-trace_sample_rate", type=float, default=0.01, help="fraction of incoming requests traced, requests carrying a traceparent header follow the caller's decision")
+    parser.add_argument("-trace_file", default="logs/traces.jsonl", help="json lines file spans are appended to")
+    parser.add_argument("-retry_workers", type=int, default=8, help="fulfillment retries running at once")
+    parser.add_argument("-retry_max_attempts", type=int, default=10, help="failed fulfillment attempts after which a transaction is dead-lettered")
+    parser.add_argument("-subscriber_workers", type=int, default=16, help="threads shared by all event subscribers")
+    parser.add_argument("-subscriber_concurrency", type=int, default=4, help="max events handled at once by each subscriber")
+    parser.add_argument("-subscriber_timeout", type=float, default=10, help="seconds after which a subscriber handling an event counts as failed")
+    return parser
+
+#queue depths, hit rates and error counts the components already keep, read on every scrape of /v1/metrics
+def register_component_metrics(retry_queue, idempotency_cache):
+    def collect():
+        yield from flatten_metrics("event_queue", EventBroker.event_queue.get_metrics(), "event queue", counters=("published", "consumed", "blocked_puts", "blocked_seconds"))
+        if EventBroker.event_log is not None:
+            yield from flatten_metrics("event_log", EventBroker.event_log.get_metrics(), "event log")
+        if EventBroker.dispatcher is not None:
+            yield from flatten_metrics("event_dispatcher", EventBroker.dispatcher.get_metrics(), "event dispatcher", counters=("deliveries", "failures", "timeouts", "moves", "restarts"))
+        yield from flatten_metrics("retry_queue", retry_queue.get_metrics(), "retry queue", counters=("succeeded", "failed_attempts", "dead_lettered"))
+        yield from flatten_metrics("idempotency_cache", idempotency_cache.get_metrics(), "idempotency cache", counters=("hits", "misses", "coalesced", "evictions"))
+        yield from flatten_metrics("transaction_cache", transaction_cache.get_metrics(), "transaction cache", counters=("hits", "negative_hits", "misses", "coalesced", "evictions", "invalidations"))
+    registry.register(collect)
+
+#EventBroker
+class EventBroker:
+    subscribers = defaultdict(list)
+    subscriber_limits = dict()
+    event_queue = EventQueue()
+    event_log: EventLog = None
+    database_router: ShardRouter = None
+    status_batcher: GroupCommitter = None
+    status_batch_window = 0.005
+    status_batch_size = 100
+    dispatcher: EventDispatcher | EventWorkerPool = None
+    event_workers = 0
+    event_partitions = 64
+    subscriber_workers = 16
+    subscriber_concurrency = 4
+    subscriber_timeout = 10.0
+
+    #max_concurrency and timeout override the broker wide subscriber_concurrency and subscriber_timeout
+    @classmethod
+    def subscribe_to_event(cls, status: TransactionStatus, subscriber: EventSubscriber, max_concurrency=None, timeout=None):
+        try:
+            if not isinstance(status, TransactionStatus):
+                raise TypeError(f"event_type {status} must implement TransactionStatus")
+            if not isinstance(subscriber, EventSubscriber):
+                raise TypeError(f"subscriber {subscriber} must implement EventSubscriber")
+        except TypeError as e:
+            logger.fatal("{time.time()}: Invalid type found in event subscription. {e}")
+            raise
+        else:
+            cls.subscribers[status].append(subscriber)
+            cls.subscriber_limits[subscriber] = {"max_concurrency": max_concurrency, "timeout": timeout}
+
+    #blocks while the event queue is full, not for the event log write, which the broker thread
+    #waits for before delivering the event. block=False is for events published by the broker thread itself
+    @classmethod
+    def publish_event(cls, event, block=True):
+        event = cls.log_event(event)
+        cls.event_queue.put(event, block=block)
+
+    #submits the event to the event log, returns the event to queue
+    @classmethod
+    def log_event(cls, event):
+        if not isinstance(event, Event):
+            logger.error(f"{time.time()}: event {event} does not implement Event")
+            event = TerminatedEvent(event.get_transaction_id())
+        if cls.event_log is not None:
+            cls.event_log.append(event)
+        registry.counter("events_published_total", "events published to the broker", status=event.get_status().name).inc()
+        return event
+
+    #the event is delivered even if it could not be written, it is only lost on restart
+    @classmethod
+    def wait_durable(cls, event):
+        if cls.event_log is None or event.offset is None:
+            return
+        try:
+            cls.event_log.wait_durable(event)
+        except Exception as e:
+            logger.critical(f"{time.time()}: Error writing event {event.to_string()} to the event log, it will be lost on restart: {e}")
+            registry.counter("event_log_errors_total", "events that could not be written to the event log").inc()
+    
+    #flush callback of the status batcher: one request for the whole batch, resending only the retryable items
+    @classmethod
+    def log_statuses(cls, updates):
+        pending = updates
+
+        def send():
+            nonlocal pending
+            retry = []
+            with cls.database_router.writing([update["transaction_id"] for update in pending]) as ring:
+                for database_server, updates in cls.database_router.group_by_server(ring, pending, key=lambda update: update["transaction_id"]).items():
+                    try:
+                        response = http_post(f"{database_server}/txn_status:batch", json={"updates": updates})
+                        if response.status_code != 200:
+                            raise LoggingTransactionStatusError(f"status code {response.status_code}")
+                    except Exception as e:
+                        logger.warning(f"Error logging {len(updates)} transaction statuses in {database_server}: {e}")
+                        retry.extend(updates)
+                        continue
+                    for update, result in zip(updates, response.json()["results"]):
+                        if result["logged"]:
+                            continue
+                        if result["retryable"]:
+                            retry.append(update)
+                        else:
+                            logger.warning(f"Error logging status of transaction ({update['transaction_id']}) in database: {result['message']}")
+            pending = retry
+            if pending:
+                raise LoggingTransactionStatusError(f"{len(pending)} statuses not persisted")
+
+        retry_with_backoff(send, f"logging {len(updates)} transaction statuses in database", operation="log_statuses")
+    
+    #completion callback of the dispatcher, runs once every subscriber has handled the event
+    @classmethod
+    def handle_event_completion(cls, event, failed_subscribers):
+        for subscriber in failed_subscribers:
+            logger.error(f"{time.time()}: {subscriber} failed handling transaction {event.get_transaction_id()} with status{event.get_status()}")
+            registry.counter("subscriber_failures_total", "events a subscriber failed to handle", subscriber=type(subscriber).__name__).inc()
+        registry.counter("events_completed_total", "events handled by all of their subscribers", outcome="failed" if failed_subscribers else "succeeded").inc()
+        if failed_subscribers:
+            terminated = TerminatedEvent(event.get_transaction_id(), event.get_details())
+            terminated.traceparent = event.traceparent
+            cls.publish_event(terminated, block=False)
+        if cls.event_log is not None and event.offset is not None:
+            cls.event_log.acknowledge(event.offset)
+
+    @classmethod
+    def handle_event(cls, event):
+        cls.wait_durable(event)
+        start = time.perf_counter()
+        status = event.get_status()
+        transaction_id = event.get_transaction_id()
+        cls.status_batcher.submit([{"transaction_id": transaction_id, "status": status}])
+        transaction_cache.invalidate(transaction_id)
+        cls.dispatcher.dispatch(event, cls.subscribers.get(status, []))
+        registry.histogram("event_broker_dispatch_seconds", "time the broker thread spends handing an event over to its subscribers").observe(time.perf_counter() - start)
+
+    #events not yet acknowledged stay in the event log and are delivered again on the next start
+    @classmethod
+    def handle_shutdown(cls, unstarted_events):
+        events = unstarted_events + cls.event_queue.drain()
+        if cls.event_log is not None:
+            cls.event_log.close()
+            for event in events:
+                cls.wait_durable(event)
+            lost = sum(event.offset is None for event in events)
+            logger.info(f"{len(events) - lost} pending events kept in the event log")
+        else:
+            lost = len(events)
+        if lost:
+            logger.critical(f"{lost} pending events were never written to the event log and are lost")
+    
+    @classmethod
+    def run(cls, shutdown_event):
+        #status updates are sent to the database in batches by a background flusher
+        cls.status_batcher = GroupCommitter(cls.log_statuses, window=cls.status_batch_window, max_batch=cls.status_batch_size, name="status-batcher")
+        #subscribers run in parallel across transactions and in order within one,
+        #either on the dispatcher's pool or in worker processes each owning a share of the transactions
+        if cls.event_workers:
+            cls.dispatcher = EventWorkerPool(
+                cls.subscribers,
+                cls.subscriber_limits,
+                cls.database_router.servers(),
+                cls.handle_event_completion,
+                workers=cls.event_workers,
+                partitions=cls.event_partitions,
+                max_workers=cls.subscriber_workers,
+                max_concurrency=cls.subscriber_concurrency,
+                timeout=cls.subscriber_timeout
+            )
+        else:
+            cls.dispatcher = EventDispatcher(
+                lambda subscriber, event: subscriber.handle_event(cls.database_router, event.get_transaction_id(), event.get_details()),
+                cls.handle_event_completion,
+                max_workers=cls.subscriber_workers,
+                max_concurrency=cls.subscriber_concurrency,
+                timeout=cls.subscriber_timeout
+            )
+            for subscriber, limits in cls.subscriber_limits.items():
+                cls.dispatcher.configure(subscriber, **limits)
+        #events left unacknowledged by the previous run go first
+        if cls.event_log is not None:
+            for event in cls.event_log.replay():
+                if shutdown_event.is_set():
+                    break
+                cls.handle_event(event)
+        while not shutdown_event.is_set():
+            #sleeps until an event is published, waking up periodically to check for shutdown
+            event = cls.event_queue.get(timeout=0.5)
+            if event is not None:
+                cls.handle_event(event)
+        unstarted_events = cls.dispatcher.close()
+        cls.status_batcher.close()
+        cls.handle_shutdown(unstarted_events)
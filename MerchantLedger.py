@@ -0,0 +1,155 @@
+from concurrent.futures import Future
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+from StorageEngine import SegmentLog, CheckpointGate
+from GroupCommit import GroupCommitter
+
+'''
+Merchant ledger
+
+Balances are held in memory and guarded by a fixed set of striped locks, so credits to different
+merchants run concurrently while two credits to the same merchant can never lose an update.
+Every credit is appended to a journal before it is applied, and the journal is folded back into
+merchant_database.json by checkpoint(), every `checkpoint_interval` seconds or once
+`checkpoint_records` credits were journaled. Credits only pause while the balances are copied.
+Credits are keyed on the transaction id, so a retried fulfillment is acknowledged without being
+applied twice, and a retry arriving while the first credit is still being journaled gets its outcome
+'''
+logger = logging.getLogger(__name__)
+
+
+class StatusCode:
+    SUCCESS = 0
+    FAILURE = 1
+
+
+class MerchantLedger:
+    def __init__(self, database_file="databases/merchant_database.json", journal_directory="databases/merchant_journal", stripes=64, commit_window=0.002,
+                 checkpoint_interval=60, checkpoint_records=100000):
+        self.database_file = database_file
+        self.stripes = [threading.Lock() for _ in range(stripes)]
+        self.credited = set()
+        #credits being journaled, a duplicate waits for the outcome of the first one
+        self.pending: dict[str, Future] = dict()
+        self.pending_lock = threading.Lock()
+
+        with open(database_file, "r") as file:
+            self.merchants = json.load(file)
+        for merchant in self.merchants.values():
+            for entry in merchant["transaction"]:
+                #entries written before the ledger existed carry no transaction id
+                if len(entry) == 4:
+                    self.credited.add(entry[3])
+
+        self.journal = SegmentLog(journal_directory)
+        replayed = 0
+        for credit in self.journal.read():
+            if self.apply(credit):
+                replayed += 1
+        logger.info(f"Merchant ledger loaded, {replayed} credits replayed from journal")
+        self.committer = GroupCommitter(self.journal.append, window=commit_window, name="merchant-journal")
+
+        self.gate = CheckpointGate(max_changes=checkpoint_records, changes=replayed)
+        self.checkpoint_interval = checkpoint_interval
+        self.stopped = threading.Event()
+        self.checkpointer = threading.Thread(target=self.run_checkpoints, name="merchant-checkpoint", daemon=True)
+        self.checkpointer.start()
+
+    def stripe(self, payee):
+        return self.stripes[zlib.crc32(payee.encode()) % len(self.stripes)]
+
+    #caller must hold the stripe of the payee, or be the only thread running
+    def apply(self, credit) -> bool:
+        if credit["id"] in self.credited:
+            return False
+        merchant = self.merchants[credit["payee"]]
+        merchant["balance"] += credit["amount"]
+        merchant["transaction"].append((credit["timestamp"], credit["payer"], credit["amount"], credit["id"]))
+        self.credited.add(credit["id"])
+        return True
+
+    def credit(self, transaction_id, payer, payee, amount:float) -> StatusCode:
+        if payee not in self.merchants:
+            logger.error(f"{time.time()}: Merchant {payee} not found, transaction ({transaction_id}) not credited")
+            return StatusCode.FAILURE
+        with self.gate.writing():
+            return self.journal_credit(transaction_id, payer, payee, amount)
+
+    def journal_credit(self, transaction_id, payer, payee, amount) -> StatusCode:
+        with self.pending_lock:
+            if transaction_id in self.credited:
+                logger.warning(f"Transaction ({transaction_id}) already credited to {payee}")
+                return StatusCode.SUCCESS
+            outcome = self.pending.get(transaction_id)
+            if outcome is None:
+                outcome = self.pending[transaction_id] = Future()
+                duplicate = False
+            else:
+                duplicate = True
+        if duplicate:
+            return outcome.result()
+
+        credit = {"id": transaction_id, "payer": payer, "payee": payee, "amount": amount, "timestamp": time.time()}
+        status = StatusCode.SUCCESS
+        try:
+            self.committer.commit([credit])
+            with self.stripe(payee):
+                self.apply(credit)
+        except Exception as e:
+            logger.fatal(f"{time.time()}: Error journaling credit of transaction ({transaction_id}): {e}")
+            status = StatusCode.FAILURE
+        finally:
+            with self.pending_lock:
+                del self.pending[transaction_id]
+            outcome.set_result(status)
+        return status
+
+    def get_balance(self, payee):
+        with self.stripe(payee):
+            return self.merchants[payee]["balance"]
+
+    #folds the journal into the merchant database, then deletes the folded segments. Credits only
+    #wait while the balances are copied
+    def checkpoint(self):
+        with self.gate.pause() as changes:
+            if not changes:
+                return
+            #every credit applied so far is in the sealed segments
+            self.journal.seal()
+            sealed = self.journal.sealed_segments()
+            merchants = {payee: {**merchant, "transaction": list(merchant["transaction"])} for payee, merchant in self.merchants.items()}
+        tmp_file = f"{self.database_file}.tmp"
+        with open(tmp_file, "w") as file:
+            json.dump(merchants, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, self.database_file)
+        self.journal.replace_segments(sealed, [])
+        self.gate.checkpointed(changes)
+        logger.info(f"Merchant ledger checkpointed to {self.database_file}, {changes} credits folded")
+
+    def run_checkpoints(self):
+        while True:
+            self.gate.due.wait(self.checkpoint_interval)
+            if self.stopped.is_set():
+                return
+            try:
+                self.checkpoint()
+            except Exception as e:
+                logger.error(f"{time.time()}: Error checkpointing merchant ledger: {e}")
+
+    def close(self):
+        self.stopped.set()
+        self.gate.due.set()
+        self.checkpointer.join()
+        self.committer.close()
+        try:
+            self.checkpoint()
+        except Exception as e:
+            logger.critical(f"Error checkpointing merchant ledger: {e}")
+        self.journal.close()
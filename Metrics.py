@@ -0,0 +1,214 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+'''
+Metrics of a service, exposed in the Prometheus text format on GET /v1/metrics
+
+Counters and histograms are looked up once by name and labels and then updated in place, an update
+is a bisect and an increment under the metric's own lock (about a microsecond). Values that other
+components already keep (queue depths, cache hits, ...) are not copied on every update, collectors
+read them from the component's get_metrics() when the endpoint is scraped
+
+Every process has its own registry, so the metrics of event worker processes are not included
+'''
+
+#seconds, from 100µs to 10s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    #times the block in seconds
+    def time(self):
+        return HistogramTimer(self)
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            yield f"{name}_bucket", {**labels, "le": bound}, cumulative
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, cumulative
+
+
+class HistogramTimer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class MetricFamily:
+    def __init__(self, name, help, kind, factory):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.factory = factory
+        self.children: dict[tuple, Counter | Histogram] = dict()
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families: dict[str, MetricFamily] = dict()
+        self.collectors = []
+
+    def get(self, name, help, kind, factory, labels):
+        family = self.families.get(name)
+        key = tuple(sorted(labels.items())) if len(labels) > 1 else tuple(labels.items())
+        if family is not None:
+            child = family.children.get(key)
+            if child is not None:
+                return child
+        with self.lock:
+            family = self.families.setdefault(name, MetricFamily(name, help, kind, factory))
+            return family.children.setdefault(key, factory())
+
+    def counter(self, name, help, **labels) -> Counter:
+        return self.get(name, help, "counter", Counter, labels)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels) -> Histogram:
+        return self.get(name, help, "histogram", lambda: Histogram(buckets), labels)
+
+    #collector() returns (name, help, kind, labels, value) tuples, it is called on every scrape
+    def register(self, collector):
+        with self.lock:
+            self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            families = list(self.families.values())
+            collectors = list(self.collectors)
+        for family in families:
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for key, child in list(family.children.items()):
+                for name, labels, value in child.samples(family.name, dict(key)):
+                    lines.append(format_sample(name, labels, value))
+
+        described = set()
+        for collector in collectors:
+            try:
+                samples = list(collector())
+            except Exception as e:
+                lines.append(f"# collector error: {e}")
+                continue
+            for name, help, kind, labels, value in samples:
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {name} {help}")
+                    lines.append(f"# TYPE {name} {kind}")
+                lines.append(format_sample(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+
+def format_sample(name, labels, value):
+    value = int(value) if isinstance(value, bool) else value
+    if labels:
+        label_text = ",".join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+        return f"{name}{{{label_text}}} {value}"
+    return f"{name} {value}"
+
+
+def escape_label(label):
+    return str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+#(name, help, kind, labels, value) of every number in a get_metrics() dict, the keys in counters only
+#ever grow and are exposed as counters. Nested dicts of dicts are keyed by an entity (a subscriber,
+#a worker), the entity becomes a label
+def flatten_metrics(prefix, metrics: dict, help, counters=(), labels=None):
+    labels = labels or dict()
+    for key, value in metrics.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, (bool, int, float)):
+            description = f"{help}: {key.replace('_', ' ')}"
+            if key in counters:
+                yield f"{name}_total", description, "counter", labels, value
+            else:
+                yield name, description, "gauge", labels, value
+        elif isinstance(value, dict) and value and all(isinstance(entry, dict) for entry in value.values()):
+            for entity, entry in value.items():
+                yield from flatten_metrics(name, entry, help, counters, {**labels, "key": entity})
+        elif isinstance(value, dict):
+            yield from flatten_metrics(name, value, help, counters, labels)
+
+
+registry = Registry()
+
+
+#request latency of every endpoint and GET /v1/metrics, for Flask and Quart apps
+request_start: ContextVar[float] = ContextVar("request_start")
+
+def instrument_app(app):
+    is_quart = type(app).__module__.startswith("quart")
+    if is_quart:
+        from quart import request
+    else:
+        from flask import request
+
+    def start_request_timer():
+        request_start.set(time.perf_counter())
+
+    def observe_request(response):
+        start = request_start.get(None)
+        if start is not None:
+            endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            registry.histogram("http_server_request_seconds", "latency of the requests served", endpoint=endpoint, method=request.method, status=response.status_code).observe(time.perf_counter() - start)
+        return response
+
+    def get_prometheus_metrics():
+        return registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+    #Quart runs plain functions on a worker thread, where setting the timer would not reach the request
+    if is_quart:
+        app.before_request(as_coroutine(start_request_timer))
+        app.after_request(as_coroutine(observe_request))
+        app.route("/v1/metrics", methods=["GET"])(as_coroutine(get_prometheus_metrics))
+    else:
+        app.before_request(start_request_timer)
+        app.after_request(observe_request)
+        app.route("/v1/metrics", methods=["GET"])(get_prometheus_metrics)
+
+
+def as_coroutine(function):
+    async def run(*args):
+        return function(*args)
+    run.__name__ = function.__name__
+    return run
@@ -1,45 +1,171 @@
+from concurrent.futures import ThreadPoolExecutor
 from collections import deque
-import requests
+import heapq
+import itertools
+import os
 
 from Backend import *
-from Event import FulfilledEvent
+from Event import FulfilledEvent, TerminatedEvent
+from GroupCommit import GroupCommitter
+from Metrics import registry
+from ServiceClient import http_post
+from StorageEngine import SegmentLog
+from TransactionCache import transaction_cache
+from Tracing import current_traceparent, start_span
+from StructuredLogging import add_log_file
 
-logger = logging.getLogger(__name__)
-logger.propagate = False  
-handler = logging.FileHandler("logs/failed_txn_logs.txt")
-logger.addHandler(handler)
+'''
+Retries of transactions whose fulfillment failed
+
+Transactions wait in a heap ordered by their next attempt. The scheduler hands due transactions to a
+bounded pool of workers, and only while a worker is free, so retries go as fast as the merchant
+ledger and the database accept them. A failed attempt is rescheduled with exponential backoff and
+jitter. After max_attempts the transaction is dead-lettered and a TerminatedEvent is published
+
+Every change to the queue (enqueue, failed attempt, done, dead-lettered) is appended to a segment log
+before it takes effect, and sealed segments are folded into the transactions still waiting in the
+background. The log is read on the retry thread once the main service is up, transactions enqueued
+meanwhile are scheduled straight away
+'''
+logger = add_log_file(__name__, "logs/failed_txn_logs.jsonl")
 
 class FailedTransaction :
-    def __init__(self, transaction_id, webhook):
+    def __init__(self, transaction_id, webhook, attempts=0, traceparent=None):
         self.id = transaction_id
         self.webhook = webhook
+        self.attempts = attempts
+        #trace of the payment that failed, retries are recorded in it
+        self.traceparent = traceparent
 
 class RetryQueue:
-    def __init__(self, database_server, broker):
-        self.queue: deque[FailedTransaction] = deque()
-        self.initialise_retry_queue()
-        self.database_server = database_server
+    def __init__(self, database_router, broker, workers=8, max_attempts=10, base_delay=1.0, max_delay=300.0,
+                 log_directory="databases/retry_log", legacy_file="databases/retry_queue.json", segment_size=1024 * 1024, compaction_interval=60, min_sealed_segments=4):
+        self.queue: list[tuple[float, int, FailedTransaction]] = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.workers = workers
+        self.free_workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="retry")
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.dead_letters: deque[FailedTransaction] = deque(maxlen=1000)
+        self.succeeded = 0
+        self.failed_attempts = 0
+        self.dead_lettered = 0
+        self.database_router = database_router
         self.event_broker = broker
-    
-    def initialise_retry_queue(self):
+
+        self.log = SegmentLog(log_directory, segment_size=segment_size)
+        self.fresh_log = self.log.size() == 0
+        #everything written before this start is in sealed segments, new records go to the active one
+        self.log.seal()
+        self.backlog_segments = self.log.sealed_segments()
+        self.legacy_file = legacy_file
+        self.loaded = threading.Event()
+        self.committer = GroupCommitter(self.log.append, name="retry-log")
+        self.compaction_interval = compaction_interval
+        self.min_sealed_segments = min_sealed_segments
+        self.stop_event = threading.Event()
+        self.compaction_thread = threading.Thread(target=self.run_compaction, name="retry-log-compaction", daemon=True)
+
+    @staticmethod
+    def apply(pending, record):
+        match record["op"]:
+            case "enqueue":
+                pending[record["id"]] = FailedTransaction(record["id"], record["webhook"], record["attempts"], record.get("trace"))
+            case "attempt":
+                if record["id"] in pending:
+                    pending[record["id"]].attempts = record["attempts"]
+            case "done" | "dead":
+                pending.pop(record["id"], None)
+
+    @staticmethod
+    def enqueue_record(txn: FailedTransaction):
+        record = {"op": "enqueue", "id": txn.id, "webhook": txn.webhook, "attempts": txn.attempts}
+        if txn.traceparent is not None:
+            record["trace"] = txn.traceparent
+        return record
+
+    #writes the record before the change takes effect, the change is kept in memory if the write fails
+    def persist(self, record):
         try:
-            with open("databases/retry_queue.json") as file:
+            self.committer.commit([record])
+        except Exception as e:
+            logger.critical(f"{time.time()}: Error writing {record} to the retry log, it will be lost on restart: {e}")
+
+    #transactions left by the previous run, scheduled in chunks so enqueue is never held up for long
+    def load(self):
+        start = time.time()
+        pending = dict()
+        for record in self.log.read(self.backlog_segments):
+            self.apply(pending, record)
+        if self.fresh_log and self.legacy_file and os.path.exists(self.legacy_file):
+            self.import_legacy_file(pending)
+
+        txns = list(pending.values())
+        for offset in range(0, len(txns), 1000):
+            with self.condition:
+                for txn in txns[offset:offset + 1000]:
+                    heapq.heappush(self.queue, (time.time() + self.backoff(txn.attempts), next(self.sequence), txn))
+                self.condition.notify()
+        self.loaded.set()
+        logger.info(f"Loaded {len(txns)} transactions to retry from {self.log.directory} in {time.time() - start:.3f}s")
+        self.compaction_thread.start()
+
+    #one-off migration of the json file written by earlier versions
+    def import_legacy_file(self, pending):
+        try:
+            with open(self.legacy_file) as file:
                 txns = json.load(file)
         except Exception as e:
-            logger.critical(f"Error initialising retry queue: {e}")
-        else:
-            for txn in txns:
-                self.enqueue(txn["id"], txn["webhook"])
-    
-    def enqueue(self, transaction_id, webhook):
-        txn = FailedTransaction(transaction_id, webhook)
-        self.queue.append(txn)
-    
+            logger.critical(f"Error importing retry queue from {self.legacy_file}: {e}")
+            return
+        records = [{"op": "enqueue", "id": txn["id"], "webhook": txn["webhook"], "attempts": txn.get("attempts", 0)} for txn in txns]
+        for record in records:
+            self.apply(pending, record)
+        self.committer.commit(records)
+        os.replace(self.legacy_file, f"{self.legacy_file}.imported")
+        logger.info(f"Imported {len(records)} transactions to retry from {self.legacy_file}")
+
+    def run_compaction(self):
+        while not self.stop_event.wait(self.compaction_interval):
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Error compacting retry log: {e}")
+
+    #folds every sealed segment into the enqueue records of the transactions still waiting
+    def compact(self):
+        sealed = self.log.sealed_segments()
+        if len(sealed) < self.min_sealed_segments:
+            return
+        pending = dict()
+        for record in self.log.read(sealed):
+            self.apply(pending, record)
+        self.log.replace_segments(sealed, [self.enqueue_record(txn) for txn in pending.values()])
+        logger.info(f"Compacted {len(sealed)} retry log segments into {len(pending)} records")
+
+    def enqueue(self, transaction_id, webhook, attempts=0):
+        txn = FailedTransaction(transaction_id, webhook, attempts, current_traceparent())
+        self.persist(self.enqueue_record(txn))
+        self.schedule(txn)
+
+    #the n-th retry waits base_delay * 2^(n-1), capped at max_delay, half of it randomised so that
+    #transactions that failed together do not retry together
+    def backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempts)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def schedule(self, txn: FailedTransaction):
+        with self.condition:
+            heapq.heappush(self.queue, (time.time() + self.backoff(txn.attempts), next(self.sequence), txn))
+            self.condition.notify()
+
     def fulfill_transaction(self, transaction_id):
-        response = requests.get(f"{self.database_server}/txn", params={"transaction_id": transaction_id})
-        if response.status_code == 200:
-            details = response.json()["details"]
-            status = fulfill_transaction(details["payer"], details["payee"], details["amount"])
+        details = transaction_cache.get(self.database_router, transaction_id)
+        if details is not None:
+            status = fulfill_transaction(transaction_id, details["payer"], details["payee"], details["amount"])
             return status
         return StatusCode.FAILURE
 
@@ -51,51 +177,96 @@ class RetryQueue:
 
         for retry_attempt in range(3):
             try:
-                response = requests.post(f"{webhook}/txn", json=request_json)
+                response = http_post(f"{webhook}/txn", json=request_json)
                 if response.status_code == 200:
                     break
                 else:
                     raise Exception
-                
+
             except Exception as e:
                 logger.warning(f"Attempt {retry_attempt + 1}: Error sending updates to client")
                 if retry_attempt != 2:
+                    count_retry("webhook")
                     delay = random.randint(0, 2 ** (retry_attempt+ 1))
                     logger.warning(f"delaying for {delay} seconds before retrying")
                     time.sleep(delay)
                 else:
                     logger.warning("All attempts updating the client failed")
                 logger.warning(e)
-    
-    def handle_shutdown(self):
-        if self.queue:
-            queue = []
-            for txn in self.queue:
-                queue.append({"id": txn.id, "webhook":txn.webhook})
-            
+
+    def retry(self, txn: FailedTransaction):
+        with start_span("retry fulfillment", parent=txn.traceparent, attempt=txn.attempts + 1):
+            self.run_attempt(txn)
+
+    def run_attempt(self, txn: FailedTransaction):
+        try:
+            start = time.perf_counter()
             try:
-                with open("databases/retry_queue.json") as file:
-                    json.dump(queue, file, indent=4)
+                status = self.fulfill_transaction(txn.id)
             except Exception as e:
-                logger.critical(f"Error flushing retry events to database: {e}")
+                logger.warning(f"{time.time()}: Error fulfilling transaction ({txn.id}): {e}")
+                status = StatusCode.FAILURE
+            outcome = "succeeded" if status == StatusCode.SUCCESS else "failed"
+            registry.histogram("retry_queue_attempt_seconds", "time of a fulfillment retry", outcome=outcome).observe(time.perf_counter() - start)
+
+            if status == StatusCode.SUCCESS:
+                self.persist({"op": "done", "id": txn.id})
+                with self.condition:
+                    self.succeeded += 1
+                self.event_broker.publish_event(FulfilledEvent(txn.id))
+                self.send_updates(txn.id, txn.webhook)
+                return
+
+            txn.attempts += 1
+            with self.condition:
+                self.failed_attempts += 1
+            if txn.attempts >= self.max_attempts:
+                self.persist({"op": "dead", "id": txn.id, "attempts": txn.attempts})
+                logger.error(f"{time.time()}: Transaction ({txn.id}) dead-lettered after {txn.attempts} failed fulfillment attempts")
+                with self.condition:
+                    self.dead_letters.append(txn)
+                    self.dead_lettered += 1
+                self.event_broker.publish_event(TerminatedEvent(txn.id))
             else:
-                logger.info("Failed txns flushed to database")
-        else:
-            logger.info("Retry queue is empty. No data is flushed")
+                self.persist({"op": "attempt", "id": txn.id, "attempts": txn.attempts})
+                self.schedule(txn)
+        finally:
+            with self.condition:
+                self.free_workers += 1
+                self.condition.notify()
+
+    #the retry log is already up to date, only pending writes are flushed
+    def handle_shutdown(self):
+        self.stop_event.set()
+        if self.compaction_thread.is_alive():
+            self.compaction_thread.join()
+        self.committer.close()
+        self.log.close()
+        logger.info(f"Retry queue closed with {len(self.queue)} transactions waiting")
+
+    def get_metrics(self):
+        with self.condition:
+            return {
+                "scheduled": len(self.queue),
+                "in_flight": self.workers - self.free_workers,
+                "succeeded": self.succeeded,
+                "failed_attempts": self.failed_attempts,
+                "dead_lettered": self.dead_lettered,
+                "loaded": self.loaded.is_set()
+            }
 
     def run(self, shutdown_event):
+        self.load()
         while not shutdown_event.is_set():
-            for _ in range(len(self.queue)):
-                txn = self.queue.popleft()
-                transaction_id = txn.id
-                webhook = txn.webhook
-                status = self.fulfill_transaction(transaction_id)
-                if status == StatusCode.SUCCESS:
-                    self.event_broker.publish_event(FulfilledEvent(transaction_id))
-                    self.send_updates(transaction_id, webhook)
-                else:
-                    self.enqueue(transaction_id, webhook)
-                time.sleep(5)
+            with self.condition:
+                #sleeps until a worker is free and the earliest retry is due, waking up periodically to check for shutdown
+                now = time.time()
+                if not self.free_workers or not self.queue or self.queue[0][0] > now:
+                    timeout = self.queue[0][0] - now if self.queue and self.free_workers else 0.5
+                    self.condition.wait(min(timeout, 0.5))
+                    continue
+                _, _, txn = heapq.heappop(self.queue)
+                self.free_workers -= 1
+            self.executor.submit(self.retry, txn)
+        self.executor.shutdown(wait=True)
         self.handle_shutdown()
-        
-        
\ No newline at end of file
@@ -0,0 +1,246 @@
+from bisect import bisect_left
+from contextlib import contextmanager, asynccontextmanager
+import asyncio
+import hashlib
+import itertools
+import logging
+import threading
+
+from ServiceClient import http_get, http_post
+
+'''
+Routing of transactions to Database shards
+
+Tokens are hashed onto a ring of 2^64 positions. Every shard owns `virtual_nodes` points on the ring
+and with them the arcs (previous point, point]. A token belongs to the first point at or after its hash
+
+Adding a shard moves only the arcs the new shard takes over:
+1. bulk copy of the moving arcs from their current owners while traffic continues, the router
+   records the transactions written to the moving arcs from then on
+2. new writes to the moving arcs are held back and the ones in flight drain, writes to the other
+   arcs carry on. The transactions written during the bulk copy are copied again
+3. the ring is switched, held writes are released and routed to the new shard
+4. the moved transactions are deleted from their previous owners
+'''
+logger = logging.getLogger(__name__)
+
+EXPORT_PAGE_SIZE = 5000
+
+
+def hash_token(token) -> int:
+    return int.from_bytes(hashlib.md5(str(token).encode()).digest()[:8], "big")
+
+
+#True if position lies on the arc (start, end], arcs may wrap around the end of the ring
+def in_range(position, start, end) -> bool:
+    if start < end:
+        return start < position <= end
+    return position > start or position <= end
+
+
+class ConsistentHashRing:
+    def __init__(self, servers=(), virtual_nodes=64):
+        self.virtual_nodes = virtual_nodes
+        self.points: list[int] = []
+        self.owners: dict[int, str] = dict()
+        for server in servers:
+            self.add(server)
+
+    def copy(self):
+        ring = ConsistentHashRing(virtual_nodes=self.virtual_nodes)
+        ring.points = list(self.points)
+        ring.owners = dict(self.owners)
+        return ring
+
+    def add(self, server):
+        for replica in range(self.virtual_nodes):
+            point = hash_token(f"{server}#{replica}")
+            if point not in self.owners:
+                self.owners[point] = server
+                self.points.insert(bisect_left(self.points, point), point)
+
+    def servers(self):
+        return sorted(set(self.owners.values()))
+
+    def get_server_for_hash(self, position):
+        index = bisect_left(self.points, position)
+        return self.owners[self.points[index % len(self.points)]]
+
+    def get_server(self, token):
+        return self.get_server_for_hash(hash_token(token))
+
+    #the arcs owned by server, as (start, end] pairs
+    def ranges_of(self, server):
+        ranges = []
+        for index, point in enumerate(self.points):
+            if self.owners[point] == server:
+                ranges.append((self.points[index - 1], point))
+        return ranges
+
+
+class ShardRouter:
+    def __init__(self, servers, virtual_nodes=64):
+        self.ring = ConsistentHashRing(servers, virtual_nodes)
+        self.frozen_ranges = []
+        #arcs being moved and the transactions written to them since the move started
+        self.moving_ranges = []
+        self.changed_ids = set()
+        #(position, transaction id) pairs of every write in flight, by write id
+        self.inflight_writes: dict[int, list[tuple[int, str]]] = dict()
+        self.write_ids = itertools.count()
+        self.condition = threading.Condition()
+        self.rebalance_lock = threading.Lock()
+
+    def servers(self):
+        return self.ring.servers()
+
+    def server_for(self, transaction_id):
+        return self.ring.get_server(transaction_id)
+
+    #writes hold the ring they were routed with until they complete. Writes to arcs that are being
+    #moved wait until the move is complete, and a move only waits for the in-flight writes to those arcs
+    @contextmanager
+    def writing(self, transaction_ids):
+        ring, write_id = self.enter_write(transaction_ids)
+        try:
+            yield ring
+        finally:
+            self.exit_write(write_id)
+
+    #same as writing(), without blocking the event loop while a move is in progress
+    @asynccontextmanager
+    async def writing_async(self, transaction_ids):
+        entered = self.enter_write(transaction_ids, block=False)
+        if entered is None:
+            future = asyncio.get_running_loop().run_in_executor(None, self.enter_write, transaction_ids)
+            try:
+                entered = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                #the write is entered on the worker thread regardless, leave it as soon as it is
+                future.add_done_callback(self.exit_entered_write)
+                raise
+        ring, write_id = entered
+        try:
+            yield ring
+        finally:
+            self.exit_write(write_id)
+
+    #returns (ring, write id), None when block is not set and the write would have to wait
+    def enter_write(self, transaction_ids, block=True):
+        writes = [(hash_token(transaction_id), transaction_id) for transaction_id in transaction_ids]
+        with self.condition:
+            while self.touches(writes, self.frozen_ranges):
+                if not block:
+                    return None
+                self.condition.wait()
+            if self.moving_ranges:
+                self.changed_ids.update(self.moving_ids(writes))
+            write_id = next(self.write_ids)
+            self.inflight_writes[write_id] = writes
+            return self.ring, write_id
+
+    def exit_write(self, write_id):
+        with self.condition:
+            del self.inflight_writes[write_id]
+            if self.frozen_ranges:
+                self.condition.notify_all()
+
+    def exit_entered_write(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.exit_write(future.result()[1])
+
+    @staticmethod
+    def touches(writes, ranges):
+        return any(in_range(position, start, end) for position, _ in writes for start, end in ranges)
+
+    def moving_ids(self, writes):
+        return [transaction_id for position, transaction_id in writes
+                if any(in_range(position, start, end) for start, end in self.moving_ranges)]
+
+    def group_by_server(self, ring, items, key):
+        groups = dict()
+        for item in items:
+            groups.setdefault(ring.get_server(key(item)), []).append(item)
+        return groups
+
+    #returns the number of transactions moved onto the new shard
+    def add_shard(self, server):
+        with self.rebalance_lock:
+            if server in self.ring.servers():
+                return 0
+            new_ring = self.ring.copy()
+            new_ring.add(server)
+
+            moves = dict()
+            for start, end in new_ring.ranges_of(server):
+                moves.setdefault(self.ring.get_server_for_hash(end), []).append((start, end))
+            moving_ranges = [arc for arcs in moves.values() for arc in arcs]
+
+            #writes already in flight may land after the bulk copy has read their arc
+            with self.condition:
+                self.moving_ranges = moving_ranges
+                self.changed_ids = set()
+                for writes in self.inflight_writes.values():
+                    self.changed_ids.update(self.moving_ids(writes))
+            try:
+                moved = dict()
+                for source, ranges in moves.items():
+                    moved[source] = set(self.copy_ranges(source, server, ranges))
+
+                with self.condition:
+                    self.frozen_ranges = moving_ranges
+                    while any(self.touches(writes, moving_ranges) for writes in self.inflight_writes.values()):
+                        self.condition.wait()
+                    changed_ids = self.changed_ids
+                for source, transaction_ids in self.group_by_server(self.ring, changed_ids, lambda transaction_id: transaction_id).items():
+                    moved.setdefault(source, set()).update(self.copy_transactions(source, server, sorted(transaction_ids)))
+                self.ring = new_ring
+            finally:
+                with self.condition:
+                    self.frozen_ranges = []
+                    self.moving_ranges = []
+                    self.changed_ids = set()
+                    self.condition.notify_all()
+
+            for source, transaction_ids in moved.items():
+                transaction_ids = sorted(transaction_ids)
+                for offset in range(0, len(transaction_ids), EXPORT_PAGE_SIZE):
+                    response = http_post(f"{source}/txn:delete", json={"transaction_ids": transaction_ids[offset:offset + EXPORT_PAGE_SIZE]})
+                    if response.status_code != 200:
+                        logger.error(f"Error deleting moved transactions from {source}: {response.json()['message']}")
+
+            count = sum(len(transaction_ids) for transaction_ids in moved.values())
+            logger.info(f"Shard {server} added, {count} transactions moved")
+            return count
+
+    def copy_ranges(self, source, destination, ranges):
+        params = {"ranges": ",".join(f"{start}-{end}" for start, end in ranges), "limit": EXPORT_PAGE_SIZE}
+        copied = []
+        while True:
+            response = http_get(f"{source}/txn:export", params=params, timeout=60)
+            if response.status_code != 200:
+                raise ConnectionError(f"Error exporting transactions from {source}: {response.json()['message']}")
+            page = response.json()
+            if page["transactions"]:
+                response = http_post(f"{destination}/txn:import", json={"transactions": page["transactions"]}, timeout=60)
+                if response.status_code != 200:
+                    raise ConnectionError(f"Error importing transactions into {destination}: {response.json()['message']}")
+                copied.extend(transaction["transaction_id"] for transaction in page["transactions"])
+            if page["next_cursor"] is None:
+                return copied
+            params["cursor"] = page["next_cursor"]
+
+    #copies the given transactions, returns the ids of the ones the source holds
+    def copy_transactions(self, source, destination, transaction_ids):
+        copied = []
+        for offset in range(0, len(transaction_ids), EXPORT_PAGE_SIZE):
+            response = http_post(f"{source}/txn:export", json={"transaction_ids": transaction_ids[offset:offset + EXPORT_PAGE_SIZE]}, timeout=60)
+            if response.status_code != 200:
+                raise ConnectionError(f"Error exporting transactions from {source}: {response.json()['message']}")
+            transactions = response.json()["transactions"]
+            if transactions:
+                response = http_post(f"{destination}/txn:import", json={"transactions": transactions}, timeout=60)
+                if response.status_code != 200:
+                    raise ConnectionError(f"Error importing transactions into {destination}: {response.json()['message']}")
+                copied.extend(transaction["transaction_id"] for transaction in transactions)
+        return copied
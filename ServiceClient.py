@@ -0,0 +1,97 @@
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+from Metrics import registry
+from Tracing import start_span, inject_traceparent
+
+'''
+Pooled HTTP clients for calls between services
+
+One keep-alive session per upstream (scheme://host:port), so repeated calls to the same service
+reuse their TCP connections instead of opening a new one each time. The latency of every call and
+the calls that got no response are recorded in the metrics, and calls made within a traced request
+get a span and pass the trace on in a traceparent header
+'''
+
+pool_size = 16
+timeout = 5.0
+
+clients: dict[str, "ServiceClient"] = dict()
+clients_lock = threading.Lock()
+
+
+class ServiceClient:
+    def __init__(self, pool_size, timeout, upstream=""):
+        self.timeout = timeout
+        self.upstream = upstream
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, url, timeout=None, **kwargs):
+        with start_span(f"{method} {urlsplit(url).path}", upstream=self.upstream) as span:
+            inject_traceparent(span, kwargs)
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            except Exception:
+                observe_call(self.upstream, method, url, "error", start)
+                raise
+            observe_call(self.upstream, method, url, response.status_code, start)
+            span.set("status", response.status_code)
+            return response
+
+    def get(self, url, timeout=None, **kwargs):
+        return self.request("GET", url, timeout, **kwargs)
+
+    def post(self, url, timeout=None, **kwargs):
+        return self.request("POST", url, timeout, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+#status is "error" for calls that got no response
+def observe_call(upstream, method, url, status, start):
+    registry.histogram("http_client_request_seconds", "latency of calls to other services", upstream=upstream, method=method, path=urlsplit(url).path, status=status).observe(time.perf_counter() - start)
+
+
+#applies to clients created afterwards, so call it before the first request
+def configure_clients(max_connections=None, default_timeout=None):
+    global pool_size, timeout
+    if max_connections is not None:
+        pool_size = max_connections
+    if default_timeout is not None:
+        timeout = default_timeout
+
+
+def get_client(url) -> ServiceClient:
+    parts = urlsplit(url)
+    upstream = f"{parts.scheme}://{parts.netloc}"
+    client = clients.get(upstream)
+    if client is None:
+        with clients_lock:
+            client = clients.get(upstream)
+            if client is None:
+                client = ServiceClient(pool_size, timeout, upstream)
+                clients[upstream] = client
+    return client
+
+
+def http_get(url, **kwargs):
+    return get_client(url).get(url, **kwargs)
+
+
+def http_post(url, **kwargs):
+    return get_client(url).post(url, **kwargs)
+
+
+def close_clients():
+    with clients_lock:
+        for client in clients.values():
+            client.close()
+        clients.clear()
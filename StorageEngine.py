@@ -0,0 +1,386 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import json
+import os
+import pathlib
+import logging
+import threading
+import time
+
+from CustomExceptions import DirtyCacheError
+
+'''
+Storage engines for the Database service
+
+- JsonFileEngine: legacy layout, the whole dict is rewritten into one json file on every write
+- SegmentLogEngine: every transaction / status change is appended as one json line to a segment log.
+  The log is replayed into memory at startup and sealed segments are compacted in the background,
+  so the cost of a write does not depend on the size of the ledger
+'''
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".log"
+
+
+class SegmentLog:
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, fsync=True):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.lock = threading.Lock()
+
+        #leftovers from a compaction that crashed before its rename are never part of the log
+        for tmp_file in self.directory.glob(f"*{SEGMENT_SUFFIX}.tmp"):
+            tmp_file.unlink()
+
+        self.segments = sorted(int(path.stem) for path in self.directory.glob(f"*{SEGMENT_SUFFIX}"))
+        if not self.segments:
+            self.segments.append(self.first_segment_id())
+        else:
+            self.truncate_torn_tail(self.segment_path(self.segments[-1]))
+        self.open_active_segment()
+
+    def open_active_segment(self):
+        self.active_file = open(self.segment_path(self.segments[-1]), "ab")
+        self.active_size = self.active_file.tell()
+
+    #cuts a partial record left by a crash, otherwise the next append would be glued onto it
+    def truncate_torn_tail(self, path):
+        with open(path, "rb+") as file:
+            size = file.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                start = max(0, end - 4096)
+                file.seek(start)
+                newline = file.read(end - start).rfind(b"\n")
+                if newline != -1:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end != size:
+                file.truncate(end)
+                file.flush()
+                os.fsync(file.fileno())
+                logger.warning(f"Truncated {size - end} bytes of torn record from {path}")
+
+    def first_segment_id(self):
+        return 0
+
+    def next_segment_id(self):
+        return self.segments[-1] + 1
+
+    def segment_path(self, segment_id):
+        return self.directory / f"{segment_id:020d}{SEGMENT_SUFFIX}"
+
+    def append(self, records, sync=True):
+        lines = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records).encode("utf-8")
+        with self.lock:
+            offset = self.active_size
+            try:
+                self.active_file.write(lines)
+                self.active_file.flush()
+                if sync and self.fsync:
+                    os.fsync(self.active_file.fileno())
+            except Exception:
+                self.discard_from(offset)
+                raise
+            self.active_size += len(lines)
+            if self.active_size >= self.segment_size:
+                self.roll()
+
+    #drops a failed write so that nothing after offset can be replayed. Caller must hold self.lock
+    def discard_from(self, offset):
+        try:
+            self.active_file.close()
+        except Exception:
+            pass
+        os.truncate(self.segment_path(self.segments[-1]), offset)
+        self.open_active_segment()
+
+    def sync(self):
+        with self.lock:
+            self.active_file.flush()
+            if self.fsync:
+                os.fsync(self.active_file.fileno())
+
+    #seals the active segment and starts a new one. Caller must hold self.lock
+    def roll(self):
+        self.active_file.flush()
+        os.fsync(self.active_file.fileno())
+        self.active_file.close()
+        self.segments.append(self.next_segment_id())
+        self.open_active_segment()
+
+    def seal(self):
+        with self.lock:
+            self.roll()
+
+    def sealed_segments(self):
+        with self.lock:
+            return self.segments[:-1]
+
+    def read_segment(self, segment_id):
+        with open(self.segment_path(segment_id), "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    #a torn write at the tail of the last segment is expected after a crash
+                    logger.warning(f"Skipping corrupted record in segment {segment_id}")
+
+    #last record of a segment without reading the whole file, None if the segment is empty
+    def read_last(self, segment_id):
+        with open(self.segment_path(segment_id), "rb") as file:
+            end = file.seek(0, os.SEEK_END)
+            tail = b""
+            while end > 0:
+                start = max(0, end - 4096)
+                file.seek(start)
+                tail = file.read(end - start) + tail
+                end = start
+                lines = tail.rstrip(b"\n").rsplit(b"\n", 1)
+                if len(lines) == 2 or end == 0:
+                    return json.loads(lines[-1]) if lines[-1] else None
+        return None
+
+    def read(self, segment_ids=None):
+        if segment_ids is None:
+            with self.lock:
+                self.active_file.flush()
+                segment_ids = list(self.segments)
+        for segment_id in segment_ids:
+            yield from self.read_segment(segment_id)
+
+    #atomically replaces a prefix of sealed segments with a single compacted segment
+    def replace_segments(self, segment_ids, records):
+        if not segment_ids:
+            return
+        target = segment_ids[-1]
+        tmp_path = self.segment_path(target).with_suffix(f"{SEGMENT_SUFFIX}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            for record in records:
+                file.write(json.dumps(record, separators=(",", ":")) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.segment_path(target))
+
+        with self.lock:
+            for segment_id in segment_ids[:-1]:
+                self.segment_path(segment_id).unlink(missing_ok=True)
+            self.segments = [segment_id for segment_id in self.segments if segment_id not in segment_ids[:-1]]
+
+    #deletes sealed segments that are no longer needed, the active segment is never dropped
+    def drop_segments(self, segment_ids):
+        with self.lock:
+            dropped = set(segment_ids) & set(self.segments[:-1])
+            for segment_id in dropped:
+                self.segment_path(segment_id).unlink(missing_ok=True)
+            self.segments = [segment_id for segment_id in self.segments if segment_id not in dropped]
+
+    def size(self):
+        with self.lock:
+            return sum(self.segment_path(segment_id).stat().st_size for segment_id in self.segments)
+
+    def close(self):
+        with self.lock:
+            self.active_file.flush()
+            os.fsync(self.active_file.fileno())
+            self.active_file.close()
+
+
+#keeps checkpoints of a journaled structure consistent while it is being written. Writers hold the gate
+#from journaling a change until it is applied in memory, pause() holds new writers back and waits for
+#the ones inside, so the snapshot taken under it holds exactly the journal records written so far.
+#Once `max_changes` changes are not checkpointed `due` is set, for checkpoints triggered by the size of the journal
+class CheckpointGate:
+    def __init__(self, max_changes=None, changes=0):
+        self.condition = threading.Condition()
+        self.writers = 0
+        self.paused = False
+        self.max_changes = max_changes
+        self.changes = changes
+        self.due = threading.Event()
+
+    @contextmanager
+    def writing(self):
+        with self.condition:
+            while self.paused:
+                self.condition.wait()
+            self.writers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writers -= 1
+                self.changes += 1
+                if self.max_changes and self.changes >= self.max_changes:
+                    self.due.set()
+                if self.paused and not self.writers:
+                    self.condition.notify_all()
+
+    #yields the number of changes not checkpointed yet
+    @contextmanager
+    def pause(self):
+        with self.condition:
+            self.paused = True
+            while self.writers:
+                self.condition.wait()
+            changes = self.changes
+        try:
+            yield changes
+        finally:
+            with self.condition:
+                self.paused = False
+                self.condition.notify_all()
+
+    #call once the snapshot taken with `changes` changes is durable
+    def checkpointed(self, changes):
+        with self.condition:
+            self.changes -= changes
+            if not self.max_changes or self.changes < self.max_changes:
+                self.due.clear()
+
+
+class StorageEngine(ABC):
+    #returns the in-memory representation of the database
+    @abstractmethod
+    def load(self) -> dict:
+        pass
+
+    #makes records durable, raises on failure. data is the in-memory state before the records are applied
+    #and must not be modified by the engine
+    @abstractmethod
+    def persist(self, records: list, data: dict):
+        pass
+
+    def close(self, data: dict):
+        pass
+
+    @staticmethod
+    def transaction_record(token, details):
+        return {"op": "txn", "id": token, "details": details}
+
+    @staticmethod
+    def status_record(token, status):
+        return {"op": "status", "id": token, "status": status}
+
+    @staticmethod
+    def delete_record(token):
+        return {"op": "delete", "id": token}
+
+    @staticmethod
+    def apply(data, record):
+        match record["op"]:
+            case "txn":
+                data[record["id"]] = {"details": record["details"]}
+                if "status" in record:
+                    data[record["id"]]["status"] = record["status"]
+            case "status":
+                #entries are replaced rather than mutated so shallow copies of data stay consistent
+                if record["id"] in data:
+                    data[record["id"]] = {**data[record["id"]], "status": record["status"]}
+            case "delete":
+                data.pop(record["id"], None)
+            case _:
+                logger.warning(f"Unknown record type ignored: {record}")
+
+
+class JsonFileEngine(StorageEngine):
+    def __init__(self, database_file):
+        self.database_file = database_file
+
+    def load(self) -> dict:
+        with open(self.database_file, "r") as file:
+            data = json.load(file)
+        timestamp = pathlib.Path(self.database_file).stat().st_mtime
+        if data["last_modified"] != "new" and data["last_modified"] != timestamp:
+            raise DirtyCacheError("Unauthorised amendments to transaction data")
+        return data
+
+    def persist(self, records, data):
+        state = dict(data)
+        for record in records:
+            self.apply(state, record)
+        with open(self.database_file, "w") as file:
+            json.dump(state, file, indent=4)
+
+    def close(self, data):
+        self.persist([], data)
+
+
+class SegmentLogEngine(StorageEngine):
+    def __init__(self, directory, legacy_file=None, segment_size=64 * 1024 * 1024, compaction_interval=60, min_sealed_segments=4):
+        self.log = SegmentLog(directory, segment_size=segment_size)
+        self.legacy_file = legacy_file
+        self.compaction_interval = compaction_interval
+        self.min_sealed_segments = min_sealed_segments
+        self.stop_event = threading.Event()
+        self.compaction_thread = None
+
+    def load(self) -> dict:
+        start = time.time()
+        data = dict()
+        for record in self.log.read():
+            self.apply(data, record)
+
+        if not data and self.legacy_file and os.path.exists(self.legacy_file):
+            self.import_legacy_file(data)
+
+        logger.info(f"Replayed {len(data)} transactions from {self.log.directory} in {time.time() - start:.3f}s")
+        self.start_compaction()
+        return data
+
+    #one-off migration from the JsonFileEngine layout
+    def import_legacy_file(self, data):
+        legacy_data = JsonFileEngine(self.legacy_file).load()
+        records = []
+        for token, entry in legacy_data.items():
+            if not isinstance(entry, dict) or "details" not in entry:
+                continue
+            record = self.transaction_record(token, entry["details"])
+            if "status" in entry:
+                record["status"] = entry["status"]
+            records.append(record)
+            self.apply(data, record)
+        self.log.append(records)
+        logger.info(f"Imported {len(records)} transactions from {self.legacy_file}")
+
+    def persist(self, records, data):
+        self.log.append(records)
+
+    def start_compaction(self):
+        if self.compaction_thread is None and self.compaction_interval:
+            self.compaction_thread = threading.Thread(target=self.run_compaction, daemon=True)
+            self.compaction_thread.start()
+
+    def run_compaction(self):
+        while not self.stop_event.wait(self.compaction_interval):
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Error compacting transaction log: {e}")
+
+    #folds every sealed segment into one. The active segment is never touched so writers are not blocked
+    def compact(self):
+        sealed = self.log.sealed_segments()
+        if len(sealed) < self.min_sealed_segments:
+            return
+        data = dict()
+        for record in self.log.read(sealed):
+            self.apply(data, record)
+
+        records = []
+        for token, entry in data.items():
+            record = self.transaction_record(token, entry["details"])
+            if "status" in entry:
+                record["status"] = entry["status"]
+            records.append(record)
+        self.log.replace_segments(sealed, records)
+        logger.info(f"Compacted {len(sealed)} segments into {len(records)} records")
+
+    def close(self, data):
+        self.stop_event.set()
+        if self.compaction_thread is not None:
+            self.compaction_thread.join()
+        self.log.close()
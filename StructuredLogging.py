@@ -0,0 +1,254 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from Metrics import registry
+from Tracing import current_context
+
+'''
+Logging of the services
+
+Loggers hand their records to a background writer instead of writing them: a record costs the
+caller a deque append, and its message is only formatted (record.getMessage(), so pass values as
+logger arguments rather than in an f-string) by the writer. The writer wakes up every
+`flush_interval` seconds, or as soon as `max_batch` records are waiting, and writes every file's
+records as json lines with one write per file:
+    {"ts": 1760000000.123456, "level": "INFO", "logger": "Database", "service": "database", "msg": "...", "trace": "<trace id>"}
+
+Files are rotated once they reach `max_bytes` and at every `rotate_interval` boundary (UTC), keeping
+`backup_count` rotated files named <file>.<yyyymmdd-hhmmss>. Processes sharing a file (event
+workers) reopen it when another one has rotated it
+
+Records beyond `max_pending` waiting records are dropped and counted rather than slowing down the
+caller. Records still waiting are written at exit, processes that skip atexit (multiprocessing
+workers) call close_logging()
+'''
+writer: "LogWriter" = None
+writer_lock = threading.Lock()
+settings = {}
+#one encoder for every record, json.dumps builds a new one per call when given default
+encode = json.JSONEncoder(default=str).encode
+
+
+class RotatingFile:
+    def __init__(self, path, max_bytes, rotate_interval, backup_count):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.open()
+        #a file left by an earlier run in an earlier interval is rotated before writing to it
+        if self.size and self.interval_start(os.fstat(self.fd).st_mtime) < self.interval_start(time.time()):
+            self.rotate()
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        status = os.fstat(self.fd)
+        self.inode = status.st_ino
+        self.size = status.st_size
+        self.next_rotation = self.interval_start(time.time()) + self.rotate_interval
+
+    def interval_start(self, timestamp):
+        return timestamp // self.rotate_interval * self.rotate_interval
+
+    def write(self, data: bytes):
+        try:
+            if os.stat(self.path).st_ino != self.inode:
+                os.close(self.fd)
+                self.open()
+        except FileNotFoundError:
+            os.close(self.fd)
+            self.open()
+        if self.size and (self.size + len(data) > self.max_bytes or time.time() >= self.next_rotation):
+            self.rotate()
+        os.write(self.fd, data)
+        self.size += len(data)
+
+    #another process writing the same file may have rotated it already, its file is then left in place.
+    #The file is always reopened, even if renaming or pruning fails
+    def rotate(self):
+        os.close(self.fd)
+        try:
+            try:
+                if os.stat(self.path).st_ino != self.inode:
+                    return
+            except FileNotFoundError:
+                return
+            rotated = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}"
+            suffix = 1
+            while os.path.exists(rotated):
+                rotated = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}.{suffix}"
+                suffix += 1
+            try:
+                os.replace(self.path, rotated)
+            except FileNotFoundError:
+                pass
+            for old in sorted(glob.glob(f"{glob.escape(self.path)}.*"))[:-self.backup_count or None]:
+                try:
+                    os.remove(old)
+                except FileNotFoundError:
+                    pass
+        finally:
+            self.open()
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LogWriter:
+    def __init__(self, service=None, flush_interval=0.05, max_batch=1000, max_pending=100000, max_bytes=64 * 1024 * 1024, rotate_interval=24 * 60 * 60, backup_count=7):
+        self.service = service
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.file_settings = {"max_bytes": max_bytes, "rotate_interval": rotate_interval, "backup_count": backup_count}
+        self.records: deque[tuple[str, logging.LogRecord]] = deque()
+        self.files: dict[str, RotatingFile] = dict()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.written = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, path, record):
+        if len(self.records) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.records.append((path, record))
+        if len(self.records) >= self.max_batch:
+            self.wakeup.set()
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        batches: dict[str, list[str]] = dict()
+        while self.records:
+            path, record = self.records.popleft()
+            batches.setdefault(path, []).append(self.format(record))
+        for path, lines in batches.items():
+            try:
+                file = self.files.get(path)
+                if file is None:
+                    file = self.files[path] = RotatingFile(path, **self.file_settings)
+                file.write("".join(lines).encode())
+                self.written += len(lines)
+            except Exception as e:
+                #logging the error would only queue it behind the records that could not be written
+                print(f"Error writing {len(lines)} log records to {path}: {e}", file=sys.stderr)
+
+    def format(self, record: logging.LogRecord):
+        try:
+            message = record.getMessage()
+        except Exception as e:
+            message = f"{record.msg!r} {record.args!r} (formatting failed: {e})"
+        entry = {"ts": round(record.created, 6), "level": record.levelname, "logger": record.name}
+        if self.service is not None:
+            entry["service"] = self.service
+        entry["msg"] = message
+        if record.trace_id is not None:
+            entry["trace"] = record.trace_id
+        if record.exc_info:
+            entry["exc"] = "".join(traceback.format_exception(*record.exc_info))
+        return encode(entry) + "\n"
+
+    def get_metrics(self):
+        return {"pending": len(self.records), "written": self.written, "dropped": self.dropped}
+
+    def close(self):
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join()
+        for file in self.files.values():
+            file.close()
+        self.files.clear()
+
+
+#hands records to the writer without taking the handler lock or formatting them
+class QueuedFileHandler(logging.Handler):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def handle(self, record):
+        passed = self.filter(record)
+        if passed:
+            self.emit(record)
+        return passed
+
+    def emit(self, record):
+        #the trace is the one of the calling thread, not of the writer
+        context = current_context.get()
+        record.trace_id = context.trace_id if context is not None else None
+        get_writer().submit(self.path, record)
+
+
+def get_writer() -> LogWriter:
+    global writer
+    if writer is None:
+        with writer_lock:
+            if writer is None:
+                writer = LogWriter(**settings)
+    return writer
+
+
+def collect_metrics():
+    if writer is not None:
+        metrics = writer.get_metrics()
+        yield "logging_pending_records", "log records waiting to be written", "gauge", {}, metrics["pending"]
+        yield "logging_written_records_total", "log records written", "counter", {}, metrics["written"]
+        yield "logging_dropped_records_total", "log records dropped because too many were waiting", "counter", {}, metrics["dropped"]
+
+registry.register(collect_metrics)
+
+
+#sends the root logger to path, like logging.basicConfig only the first call configures it.
+#writer_settings are the keyword arguments of LogWriter, they apply once the writer is started
+def configure_logging(path, level=logging.INFO, service=None, **writer_settings):
+    root = logging.getLogger()
+    if any(isinstance(handler, QueuedFileHandler) for handler in root.handlers):
+        return
+    settings.update(writer_settings, service=service)
+    #the json lines have no caller, thread or process fields, skip collecting them for every record
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    if writer is not None:
+        writer.service = service
+    root.setLevel(level)
+    root.addHandler(QueuedFileHandler(path))
+
+
+#sends the records of the named logger to their own file instead of the root logger's
+def add_log_file(name, path, level=logging.INFO):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(level)
+    logger.addHandler(QueuedFileHandler(path))
+    return logger
+
+
+def close_logging():
+    global writer
+    with writer_lock:
+        if writer is not None:
+            writer.close()
+            writer = None
+
+atexit.register(close_logging)
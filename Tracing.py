@@ -0,0 +1,350 @@
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from Metrics import registry
+
+'''
+Distributed tracing of payments
+
+Traces start at the main service: a request without a traceparent header is sampled with
+probability `sample_rate` (head-based sampling), and only sampled requests get a trace context.
+The context travels in W3C traceparent headers on calls between services, on events (into the
+subscribers, in this process or in event workers) and on RetryQueue retries. Everything downstream
+of an unsampled request does no tracing work at all
+
+Spans are appended by a background writer to one json lines file shared by all services, one span
+per line with short keys:
+    t: trace id, s: span id, p: parent span id, n: name, sv: service,
+    ts: start (µs since the epoch), d: duration (µs), a: attributes
+Spans beyond `max_pending` waiting spans are dropped and counted rather than growing without bound
+when the file cannot keep up
+
+    python Tracing.py logs/traces.jsonl -slowest 5
+prints the span trees of the slowest traces
+'''
+logger = logging.getLogger(__name__)
+
+service = "main"
+sample_rate = 0.01
+trace_file = "logs/traces.jsonl"
+collector: "SpanCollector" = None
+collector_lock = threading.Lock()
+
+#perf_counter() + epoch_offset is the wall clock time, spans are timed with perf_counter
+epoch_offset = time.time() - time.perf_counter()
+
+
+class SpanContext:
+    __slots__ = ("trace_id", "span_id")
+
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+
+#context of the span running in this thread or task, None when it is not traced
+current_context: ContextVar[SpanContext | None] = ContextVar("current_context", default=None)
+
+
+#only sampled contexts are returned, malformed headers and unsampled ones are not traced
+def parse_traceparent(header) -> SpanContext | None:
+    if not header:
+        return None
+    parts = header.split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        if not int(parts[3], 16) & 1:
+            return None
+    except ValueError:
+        return None
+    return SpanContext(parts[1], parts[2])
+
+
+def current_traceparent():
+    context = current_context.get()
+    return context.traceparent() if context is not None else None
+
+
+def new_id(bits):
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class Span:
+    def __init__(self, name, parent: SpanContext | None, attributes):
+        self.name = name
+        self.parent_id = parent.span_id if parent is not None else None
+        self.context = SpanContext(parent.trace_id if parent is not None else new_id(128), new_id(64))
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.token = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.token = current_context.set(self.context)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        current_context.reset(self.token)
+        if exc_type is not None:
+            self.attributes["error"] = f"{exc_type.__name__}: {exc_value}"
+        self.end()
+
+    def end(self):
+        record(self.context, self.parent_id, self.name, self.start, time.perf_counter(), self.attributes)
+
+
+#stands in for a span when the request is not traced
+class NoopSpan:
+    context = None
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def end(self):
+        pass
+
+NOOP_SPAN = NoopSpan()
+
+
+#child of parent (a SpanContext or a traceparent header), of the current span by default.
+#Without a parent a trace is only started if root is set and the sampler picks it
+def start_span(name, parent=None, root=False, **attributes) -> Span | NoopSpan:
+    if isinstance(parent, str):
+        parent = parse_traceparent(parent)
+    elif parent is None:
+        parent = current_context.get()
+    if parent is None and not (root and random.random() < sample_rate):
+        return NOOP_SPAN
+    return Span(name, parent, attributes)
+
+
+#adds the traceparent of the span to the headers of an outgoing request
+def inject_traceparent(span, request_kwargs):
+    if span.context is not None:
+        request_kwargs["headers"] = {**(request_kwargs.get("headers") or {}), "traceparent": span.context.traceparent()}
+
+
+#span of the current context that has already run from start to end (perf_counter values)
+def record_span(name, start, end, **attributes):
+    parent = current_context.get()
+    if parent is not None:
+        record(SpanContext(parent.trace_id, new_id(64)), parent.span_id, name, start, end, attributes)
+
+
+def record(context: SpanContext, parent_id, name, start, end, attributes):
+    span = {"t": context.trace_id, "s": context.span_id, "p": parent_id, "n": name, "sv": service,
+            "ts": int((start + epoch_offset) * 1e6), "d": int((end - start) * 1e6)}
+    if attributes:
+        span["a"] = attributes
+    get_collector().submit(span)
+
+
+#spans are buffered and written by a background thread every `interval` seconds, a finished span
+#costs the request one deque append
+class SpanCollector:
+    def __init__(self, path, interval=0.1, max_pending=100000):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        #appends of whole lines, so services and event workers can share the file
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.spans = deque()
+        self.interval = interval
+        self.max_pending = max_pending
+        self.written = 0
+        self.dropped = 0
+        self.stopped = threading.Event()
+        self.writer = threading.Thread(target=self.run, name="trace-collector", daemon=True)
+        self.writer.start()
+
+    def submit(self, span):
+        if len(self.spans) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.spans.append(span)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+        self.write()
+
+    def write(self):
+        lines = []
+        while self.spans:
+            lines.append(json.dumps(self.spans.popleft(), separators=(",", ":")) + "\n")
+        if lines:
+            try:
+                os.write(self.fd, "".join(lines).encode())
+                self.written += len(lines)
+            except OSError as e:
+                logger.error(f"Error writing {len(lines)} spans to the trace file: {e}")
+
+    def get_metrics(self):
+        return {"pending": len(self.spans), "written": self.written, "dropped": self.dropped}
+
+    def close(self):
+        self.stopped.set()
+        self.writer.join()
+        os.close(self.fd)
+
+
+def get_collector() -> SpanCollector:
+    global collector
+    if collector is None:
+        with collector_lock:
+            if collector is None:
+                collector = SpanCollector(trace_file)
+    return collector
+
+
+#call before the first span, event workers get the same settings through get_tracing_settings()
+def collect_metrics():
+    if collector is not None:
+        metrics = collector.get_metrics()
+        yield "tracing_pending_spans", "spans waiting to be written", "gauge", {}, metrics["pending"]
+        yield "tracing_written_spans_total", "spans written", "counter", {}, metrics["written"]
+        yield "tracing_dropped_spans_total", "spans dropped because too many were waiting", "counter", {}, metrics["dropped"]
+
+registry.register(collect_metrics)
+
+
+def configure_tracing(service_name=None, rate=None, path=None):
+    global service, sample_rate, trace_file
+    if service_name is not None:
+        service = service_name
+    if rate is not None:
+        sample_rate = rate
+    if path is not None:
+        trace_file = path
+
+
+def get_tracing_settings():
+    return {"service_name": service, "rate": sample_rate, "path": trace_file}
+
+
+def close_tracing():
+    global collector
+    with collector_lock:
+        if collector is not None:
+            collector.close()
+            collector = None
+
+
+#server span of every request, continuing the caller's trace. With start_traces, requests without
+#a traceparent start a sampled trace and get the traceparent of their span back
+def trace_app(app, start_traces=False, untraced=("/v1/status", "/v1/metrics")):
+    is_quart = type(app).__module__.startswith("quart")
+    if is_quart:
+        from quart import request
+    else:
+        from flask import request
+    request_span: ContextVar[Span | None] = ContextVar("request_span", default=None)
+
+    def start_request_span():
+        if request.path in untraced:
+            return
+        parent = parse_traceparent(request.headers.get("traceparent"))
+        if parent is None and not start_traces:
+            return
+        span = start_span(f"{request.method} {request.path}", parent=parent, root=True)
+        if span is not NOOP_SPAN:
+            current_context.set(span.context)
+            request_span.set(span)
+
+    def end_request_span(response):
+        span = request_span.get()
+        if span is not None:
+            span.set("status", response.status_code)
+            if span.parent_id is None:
+                response.headers["traceparent"] = span.context.traceparent()
+        return response
+
+    #the context is cleared rather than reset, threads of the server may be reused for other requests
+    def close_request_span(error):
+        span = request_span.get()
+        if span is not None:
+            request_span.set(None)
+            current_context.set(None)
+            if error is not None:
+                span.set("error", f"{type(error).__name__}: {error}")
+            span.end()
+
+    if is_quart:
+        from Metrics import as_coroutine
+        app.before_request(as_coroutine(start_request_span))
+        app.after_request(as_coroutine(end_request_span))
+        app.teardown_request(as_coroutine(close_request_span))
+    else:
+        app.before_request(start_request_span)
+        app.after_request(end_request_span)
+        app.teardown_request(close_request_span)
+
+
+def print_trace(spans):
+    children = dict()
+    for span in spans:
+        children.setdefault(span.get("p"), []).append(span)
+    span_ids = {span["s"] for span in spans}
+    start = min(span["ts"] for span in spans)
+
+    def print_span(span, depth):
+        attributes = " ".join(f"{key}={value}" for key, value in span.get("a", {}).items())
+        print(f"{'  ' * depth}{span['n']} [{span['sv']}] +{(span['ts'] - start) / 1000:.3f}ms {span['d'] / 1000:.3f}ms {attributes}")
+        for child in sorted(children.get(span["s"], []), key=lambda child: child["ts"]):
+            print_span(child, depth + 1)
+
+    #spans whose parent was not recorded are printed as roots
+    for span in sorted((span for span in spans if span.get("p") not in span_ids), key=lambda span: span["ts"]):
+        print_span(span, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="prints traces from a trace file")
+    parser.add_argument("file", nargs="?", default=trace_file, help="trace file")
+    parser.add_argument("-trace", help="trace id to print")
+    parser.add_argument("-slowest", type=int, default=5, help="number of slowest traces to print")
+    args = parser.parse_args()
+
+    traces = dict()
+    with open(args.file) as file:
+        for line in file:
+            try:
+                span = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            traces.setdefault(span["t"], []).append(span)
+
+    if args.trace:
+        if args.trace not in traces:
+            print(f"trace {args.trace} not found in {args.file}")
+            return
+        trace_ids = [args.trace]
+    else:
+        duration = lambda spans: max(span["ts"] + span["d"] for span in spans) - min(span["ts"] for span in spans)
+        trace_ids = sorted(traces, key=lambda trace_id: duration(traces[trace_id]), reverse=True)[:args.slowest]
+    for trace_id in trace_ids:
+        print(f"trace {trace_id}")
+        print_trace(traces.get(trace_id, []))
+
+
+if __name__ == "__main__":
+    main()
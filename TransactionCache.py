@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from ServiceClient import http_get
+
+'''
+Read-through cache of transaction details
+
+Details never change once a transaction is logged, so they are kept in an LRU bounded to
+`capacity` transactions until they are evicted. Transactions the database does not know are
+remembered as missing for `negative_ttl` seconds only, since they may be about to be logged, and a
+status change of the transaction drops its entry. Concurrent misses of the same transaction share
+one request to the database
+
+The cache is per process: the main service and every event worker hold their own
+'''
+
+class TransactionCache:
+    def __init__(self, capacity=10000, negative_ttl=2.0):
+        self.capacity = capacity
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        #transaction id -> (details, expiry), details is None and expiry set for transactions not found
+        self.entries: OrderedDict[str, tuple[dict | None, float | None]] = OrderedDict()
+        self.in_flight: dict[str, Future] = dict()
+        #bumped by every invalidation, so a miss fetched before it is not remembered after it
+        self.generation = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def configure(self, capacity=None, negative_ttl=None):
+        with self.lock:
+            if capacity is not None:
+                self.capacity = capacity
+            if negative_ttl is not None:
+                self.negative_ttl = negative_ttl
+
+    #(True, details) on a hit, details being None for a transaction known to be missing. (False, None) on a miss
+    def get_cached(self, transaction_id):
+        with self.lock:
+            entry = self.entries.get(transaction_id)
+            if entry is None:
+                return False, None
+            details, expiry = entry
+            if expiry is not None and expiry <= time.monotonic():
+                del self.entries[transaction_id]
+                return False, None
+            self.entries.move_to_end(transaction_id)
+            if details is None:
+                self.negative_hits += 1
+                return True, None
+            self.hits += 1
+            return True, dict(details)
+
+    #details of the transaction, None if the database does not have it. Raises if the database could not be reached
+    def get(self, database_router, transaction_id):
+        found, details = self.get_cached(transaction_id)
+        if found:
+            return details
+        return self.fetch(database_router, transaction_id)
+
+    #misses of a transaction already being fetched wait for that request instead of sending their own
+    def fetch(self, database_router, transaction_id):
+        with self.lock:
+            future = self.in_flight.get(transaction_id)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = Future()
+                self.in_flight[transaction_id] = future
+                generation = self.generation
+            else:
+                self.coalesced += 1
+        #waited for outside the lock, so hits and fetches of other transactions carry on
+        if not owner:
+            details = future.result()
+            return dict(details) if details is not None else None
+
+        try:
+            param_json = {"transaction_id": transaction_id}
+            response = http_get(f"{database_router.server_for(transaction_id)}/txn", params=param_json)
+            if response.status_code == 200:
+                details = response.json()["details"]
+            elif response.json().get("details", ...) is None:
+                #the database answered that it does not have the transaction
+                details = None
+            else:
+                raise LookupError(f"status code {response.status_code}")
+        except BaseException as e:
+            #waiters are always released, even when the fetching thread is interrupted
+            with self.lock:
+                del self.in_flight[transaction_id]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.in_flight[transaction_id]
+            if details is not None:
+                self.store(transaction_id, details, None)
+            elif generation == self.generation:
+                self.store(transaction_id, None, time.monotonic() + self.negative_ttl)
+        future.set_result(details)
+        return dict(details) if details is not None else None
+
+    #caller holds the lock
+    def store(self, transaction_id, details, expiry):
+        self.entries[transaction_id] = (details, expiry)
+        self.entries.move_to_end(transaction_id)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, transaction_id):
+        with self.lock:
+            self.generation += 1
+            if self.entries.pop(transaction_id, None) is not None:
+                self.invalidations += 1
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+transaction_cache = TransactionCache()
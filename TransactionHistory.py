@@ -0,0 +1,192 @@
+import functools
+import json
+import logging
+import os
+import pathlib
+import threading
+from array import array
+
+'''
+Transaction history of the issuer's users
+
+Histories are held column-wise: timestamps and amounts in arrays of doubles, payees as ids into one
+table of interned payee numbers. Only recent entries stay in memory, once a user has 2 * page_size
+of them the oldest page_size are spilled to a shared page file. Entries are numbered in the order
+they were appended and every page holds page_size of them, so an entry's page is a division and
+queries only read the pages they reach, skipping pages whose time range is outside the query
+
+snapshot() copies the page index with the entries still in memory and checkpoint() syncs the page
+file and writes the copy. On restart the page file is cut back to the snapshot, entries appended
+since are replayed from the issuer journal
+'''
+logger = logging.getLogger(__name__)
+
+MAX_PAGE_SIZE = 1000
+#timestamp and amount as doubles, payee id as an unsigned int
+ENTRY_SIZE = 8 + 8 + 4
+
+
+class UserHistory:
+    def __init__(self):
+        #(offset in the page file, earliest timestamp, latest timestamp) of every spilled page
+        self.pages: list[tuple[int, float, float]] = []
+        self.timestamps = array("d")
+        self.amounts = array("d")
+        self.payees = array("I")
+
+
+class TransactionHistory:
+    def __init__(self, directory="databases/usr_history", page_size=256):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.snapshot_file = self.directory / "snapshot.json"
+        self.lock = threading.Lock()
+        self.histories: dict[str, UserHistory] = dict()
+
+        snapshot = self.load_snapshot()
+        #sequence of the last issuer journal record in the snapshot
+        self.sequence = snapshot.get("sequence", -1)
+        self.imported = snapshot.get("imported", False)
+        self.page_size = snapshot.get("page_size", page_size)
+        self.payee_names: list[str] = snapshot.get("payees", [])
+        self.payee_ids = {payee: payee_id for payee_id, payee in enumerate(self.payee_names)}
+        for user, entry in snapshot.get("users", dict()).items():
+            history = UserHistory()
+            history.pages = [tuple(page) for page in entry["pages"]]
+            history.timestamps.extend(entry["timestamps"])
+            history.amounts.extend(entry["amounts"])
+            history.payees.extend(entry["payees"])
+            self.histories[user] = history
+
+        #pages spilled after the snapshot are dropped, their entries come back from the journal
+        self.file_size = snapshot.get("page_file_size", 0)
+        self.page_file = os.open(self.directory / "pages.dat", os.O_RDWR | os.O_CREAT)
+        os.ftruncate(self.page_file, self.file_size)
+
+    def load_snapshot(self) -> dict:
+        try:
+            with open(self.snapshot_file) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return dict()
+
+    def intern(self, payee) -> int:
+        payee_id = self.payee_ids.get(payee)
+        if payee_id is None:
+            with self.lock:
+                payee_id = self.payee_ids.get(payee)
+                if payee_id is None:
+                    payee_id = len(self.payee_names)
+                    self.payee_names.append(payee)
+                    self.payee_ids[payee] = payee_id
+        return payee_id
+
+    #caller holds the user's stripe
+    def append(self, user, timestamp, payee, amount):
+        history = self.histories.get(user)
+        if history is None:
+            history = UserHistory()
+            self.histories[user] = history
+        history.timestamps.append(timestamp)
+        history.amounts.append(amount)
+        history.payees.append(self.intern(payee))
+        if len(history.timestamps) >= 2 * self.page_size:
+            self.spill(history)
+
+    #writes the oldest page_size entries in memory to the page file
+    def spill(self, history: UserHistory):
+        size = self.page_size
+        timestamps = history.timestamps[:size]
+        data = timestamps.tobytes() + history.amounts[:size].tobytes() + history.payees[:size].tobytes()
+        with self.lock:
+            offset = self.file_size
+            self.file_size += len(data)
+        os.pwrite(self.page_file, data, offset)
+        history.pages.append((offset, min(timestamps), max(timestamps)))
+        del history.timestamps[:size]
+        del history.amounts[:size]
+        del history.payees[:size]
+
+    #caller holds the user's stripe
+    def reset(self, user):
+        self.histories.pop(user, None)
+
+    #copy of the user's page index and entries in memory, queried without holding the stripe
+    def view(self, user):
+        history = self.histories.get(user, UserHistory())
+        return list(history.pages), history.timestamps[:], history.amounts[:], history.payees[:]
+
+    #pages are never rewritten, so they can be cached by offset
+    @functools.lru_cache(maxsize=256)
+    def read_page(self, offset):
+        data = os.pread(self.page_file, self.page_size * ENTRY_SIZE, offset)
+        columns = (array("d"), array("d"), array("I"))
+        start = 0
+        for column in columns:
+            end = start + self.page_size * column.itemsize
+            column.frombytes(data[start:end])
+            start = end
+        return columns
+
+    #(position, timestamp, payee id, amount) of the entries from position start on, reading pages lazily
+    def entries(self, view, start, since=None, until=None):
+        pages, timestamps, amounts, payees = view
+        position = start
+        while position < len(pages) * self.page_size:
+            page_number = position // self.page_size
+            offset, earliest, latest = pages[page_number]
+            if (since is None or latest >= since) and (until is None or earliest <= until):
+                page_timestamps, page_amounts, page_payees = self.read_page(offset)
+                for index in range(position - page_number * self.page_size, self.page_size):
+                    yield page_number * self.page_size + index, page_timestamps[index], page_payees[index], page_amounts[index]
+            position = (page_number + 1) * self.page_size
+        first = len(pages) * self.page_size
+        for index in range(max(position - first, 0), len(timestamps)):
+            yield first + index, timestamps[index], payees[index], amounts[index]
+
+    #entries of the view in the order they were appended, and the cursor of the next page
+    def query(self, view, since=None, until=None, limit=100, cursor=None):
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        transactions = []
+        for position, timestamp, payee_id, amount in self.entries(view, cursor or 0, since, until):
+            if (since is not None and timestamp < since) or (until is not None and timestamp > until):
+                continue
+            if len(transactions) == limit:
+                return transactions, position
+            transactions.append({"timestamp": timestamp, "payee": self.payee_names[payee_id], "amount": amount})
+        return transactions, None
+
+    #copy of the histories up to the issuer journal record sequence, taken while no writer is appending.
+    #Only the entries in memory are copied, spilled pages are never rewritten
+    def snapshot(self, sequence):
+        with self.lock:
+            file_size = self.file_size
+            payees = list(self.payee_names)
+        return {
+            "sequence": sequence,
+            "imported": True,
+            "page_size": self.page_size,
+            "page_file_size": file_size,
+            "payees": payees,
+            "users": {user: {
+                "pages": list(history.pages),
+                "timestamps": history.timestamps.tolist(),
+                "amounts": history.amounts.tolist(),
+                "payees": history.payees.tolist()
+            } for user, history in self.histories.items()}
+        }
+
+    #makes the snapshot the state restored on restart, writers may carry on meanwhile
+    def checkpoint(self, snapshot):
+        os.fsync(self.page_file)
+        tmp_file = self.snapshot_file.with_suffix(".json.tmp")
+        with open(tmp_file, "w") as file:
+            json.dump(snapshot, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, self.snapshot_file)
+        self.sequence = snapshot["sequence"]
+        self.imported = True
+
+    def close(self):
+        os.close(self.page_file)
@@ -0,0 +1,116 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+
+from Router import hash_token
+
+'''
+In-memory secondary indexes of the Database service
+
+Every index is a list of (timestamp, token) kept sorted, so a range query is two binary searches
+plus the size of the output. Transactions are logged in roughly increasing time order, which makes
+insertion an append in the common case. by_hash orders tokens by their position on the shard ring
+so that arcs can be exported when a shard is added
+'''
+
+MAX_PAGE_SIZE = 1000
+
+
+class TransactionIndex:
+    def __init__(self):
+        self.by_time: list[tuple[float, str]] = []
+        self.by_payer: dict[str, list[tuple[float, str]]] = defaultdict(list)
+        self.by_payee: dict[str, list[tuple[float, str]]] = defaultdict(list)
+        self.by_hash: list[tuple[int, str]] = []
+
+    #bulk load at startup, sorting once is cheaper than inserting one by one
+    def build(self, data):
+        for token, entry in data.items():
+            if not isinstance(entry, dict) or "details" not in entry:
+                continue
+            details = entry["details"]
+            key = (details["timestamp"], token)
+            self.by_time.append(key)
+            self.by_payer[details["payer"]].append(key)
+            self.by_payee[details["payee"]].append(key)
+            self.by_hash.append((hash_token(token), token))
+        self.by_time.sort()
+        self.by_hash.sort()
+        for entries in self.by_payer.values():
+            entries.sort()
+        for entries in self.by_payee.values():
+            entries.sort()
+
+    def add(self, token, details):
+        key = (details["timestamp"], token)
+        for entries in (self.by_time, self.by_payer[details["payer"]], self.by_payee[details["payee"]]):
+            if not entries or entries[-1] <= key:
+                entries.append(key)
+            else:
+                insort(entries, key)
+        insort(self.by_hash, (hash_token(token), token))
+
+    def remove(self, token, details):
+        key = (details["timestamp"], token)
+        for entries in (self.by_time, self.by_payer[details["payer"]], self.by_payee[details["payee"]]):
+            index = bisect_left(entries, key)
+            if index < len(entries) and entries[index] == key:
+                del entries[index]
+        key = (hash_token(token), token)
+        index = bisect_left(self.by_hash, key)
+        if index < len(self.by_hash) and self.by_hash[index] == key:
+            del self.by_hash[index]
+
+    #tokens whose hash lies on any of the ring arcs (start, end], ordered by hash
+    def query_hash_ranges(self, ranges, limit=1000, cursor=None):
+        intervals = []
+        for start, end in ranges:
+            if start < end:
+                intervals.append((start, end))
+            else:
+                intervals.append((start, float("inf")))
+                intervals.append((-1, end))
+        intervals.sort()
+
+        keys = []
+        for start, end in intervals:
+            first = bisect_right(self.by_hash, start, key=lambda entry: entry[0])
+            last = bisect_right(self.by_hash, end, key=lambda entry: entry[0])
+            if cursor is not None:
+                first = max(first, bisect_right(self.by_hash, cursor))
+            for position in range(first, last):
+                if len(keys) == limit:
+                    return [token for _, token in keys], keys[-1]
+                keys.append(self.by_hash[position])
+        return [token for _, token in keys], None
+
+    #returns the tokens matching every given filter in time order, and the cursor of the next page
+    def query(self, payer=None, payee=None, since=None, until=None, limit=100, cursor=None):
+        other_entries = None
+        if payer is not None and payee is not None:
+            #scan the shorter list and check membership in the other one
+            entries, other_entries = sorted((self.by_payer.get(payer, []), self.by_payee.get(payee, [])), key=len)
+        elif payer is not None:
+            entries = self.by_payer.get(payer, [])
+        elif payee is not None:
+            entries = self.by_payee.get(payee, [])
+        else:
+            entries = self.by_time
+
+        start = 0 if since is None else bisect_left(entries, since, key=lambda entry: entry[0])
+        end = len(entries) if until is None else bisect_right(entries, until, key=lambda entry: entry[0])
+        if cursor is not None:
+            start = max(start, bisect_right(entries, cursor))
+
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        keys = []
+        for position in range(start, end):
+            key = entries[position]
+            if other_entries is not None:
+                #both lists are sorted on the same key, so membership is a binary search
+                index = bisect_left(other_entries, key)
+                if index == len(other_entries) or other_entries[index] != key:
+                    continue
+            if len(keys) == limit:
+                return [token for _, token in keys], keys[-1]
+            keys.append(key)
+        return [token for _, token in keys], None
@@ -0,0 +1,300 @@
+import argparse
+import bisect
+import itertools
+import json
+import os
+import pathlib
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+'''
+End to end benchmark of POST /v1/txn
+
+Starts the Database, Issuer and main services against fresh databases in a temporary directory,
+drives payments through the main service and reports throughput, the latency distribution and the
+time spent in every step of the payment, read from the Server-Timing header of the responses
+
+- closed loop: `concurrency` clients each send their next payment once the previous one returns
+- open loop: payments arrive at `rate` per second (Poisson), whether or not earlier ones returned.
+  Latency is measured from the arrival, so a stalled service is not hidden by a stalled client
+
+Payers are drawn from a Zipf distribution (a few payers make most payments), payees uniformly and
+amounts from a log-normal distribution. Results are written as json, pass an earlier result as
+-baseline to print the changes against it
+
+    python benchmarks/pipeline.py -mode open -rate 200 -duration 30 -output results.json
+'''
+REPOSITORY = pathlib.Path(__file__).resolve().parent.parent
+MAIN_SERVER = "http://127.0.0.1:8000/v1"
+DATABASE_SERVER = "http://127.0.0.1:8001"
+ISSUER_SERVER = "http://127.0.0.1:8002"
+STAGES = ["insert", "verify", "fraud", "authorise", "fulfill", "publish"]
+
+
+def set_up_parser():
+    parser = argparse.ArgumentParser(description="load test of the payment pipeline")
+    parser.add_argument("-main", default="main.py", help="main service to benchmark, main.py or AsyncMain.py")
+    parser.add_argument("-main_args", default="", help="extra arguments of the main service")
+    parser.add_argument("-mode", choices=["closed", "open"], default="closed", help="closed or open loop load")
+    parser.add_argument("-concurrency", type=int, default=16, help="clients of the closed loop")
+    parser.add_argument("-rate", type=float, default=100, help="payments per second of the open loop")
+    parser.add_argument("-max_in_flight", type=int, default=512, help="max payments in flight in the open loop")
+    parser.add_argument("-duration", type=float, default=20, help="seconds of measured load")
+    parser.add_argument("-warmup", type=float, default=3, help="seconds of load before measuring")
+    parser.add_argument("-payers", type=int, default=1000, help="distinct payers")
+    parser.add_argument("-merchants", type=int, default=100, help="distinct payees")
+    parser.add_argument("-zipf", type=float, default=1.1, help="skew of the payer distribution, 0 is uniform")
+    parser.add_argument("-seed", type=int, default=1, help="seed of the workload")
+    parser.add_argument("-output", help="file the results are written to as json")
+    parser.add_argument("-baseline", help="earlier results to compare against")
+    parser.add_argument("-keep", action="store_true", help="keep the temporary directory with the databases and logs")
+    return parser
+
+
+class Workload:
+    def __init__(self, payers, merchants, zipf, seed):
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.payers = [f"{4000000000000000 + index}" for index in range(payers)]
+        self.merchants = [f"{5000000000000000 + index}" for index in range(merchants)]
+        self.payer_weights = list(itertools.accumulate(1 / (rank ** zipf) for rank in range(1, payers + 1)))
+        self.nonces = itertools.count(int(time.time()))
+
+    def next_payment(self):
+        with self.lock:
+            return {
+                "payer": self.random.choices(self.payers, cum_weights=self.payer_weights)[0],
+                "payee": self.random.choice(self.merchants),
+                "amount": round(min(self.random.lognormvariate(3, 1), 5000), 2),
+                "nonce": next(self.nonces)
+            }
+
+
+class Services:
+    def __init__(self, workload: Workload, main, main_args, keep):
+        self.directory = pathlib.Path(tempfile.mkdtemp(prefix="payment-benchmark-"))
+        self.keep = keep
+        (self.directory / "databases").mkdir()
+        (self.directory / "logs").mkdir()
+        self.write_json("txn_database.json", {"last_modified": "new"})
+        self.write_json("usr_database.json", {"last_modified": "new", **{payer: {"balance": 10 ** 12, "transactions": []} for payer in workload.payers}})
+        self.write_json("merchant_database.json", {merchant: {"balance": 0, "transaction": []} for merchant in workload.merchants})
+        self.processes = []
+
+        self.start("Database.py", [], f"{DATABASE_SERVER}/v1/status")
+        self.start("Issuer.py", [], f"{ISSUER_SERVER}/v1/status")
+        self.start(main, ["-database_server", DATABASE_SERVER, "-issuer_server", ISSUER_SERVER, *main_args.split()], f"{MAIN_SERVER}/status")
+
+    def write_json(self, name, data):
+        with open(self.directory / "databases" / name, "w") as file:
+            json.dump(data, file)
+
+    def start(self, script, arguments, status_url, timeout=30):
+        output = open(self.directory / "logs" / f"{pathlib.Path(script).stem}.out", "w")
+        process = subprocess.Popen([sys.executable, str(REPOSITORY / script), *arguments], cwd=self.directory, stdout=output, stderr=subprocess.STDOUT)
+        self.processes.append(process)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{script} exited with code {process.returncode}, see {output.name}")
+            try:
+                if requests.get(status_url, timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"{script} did not start within {timeout}s")
+
+    #main first, so it can flush its state into the database and issuer
+    def stop(self):
+        for process in reversed(self.processes):
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+                try:
+                    process.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        if self.keep:
+            print(f"databases and logs kept in {self.directory}")
+        else:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class Recorder:
+    def __init__(self, measure_from, measure_until):
+        self.measure_from = measure_from
+        self.measure_until = measure_until
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.status_codes = dict()
+        self.stages = {stage: [] for stage in STAGES}
+
+    def record(self, started, latency, status_code, server_timing):
+        if not self.measure_from <= started < self.measure_until:
+            return
+        with self.lock:
+            self.latencies.append(latency)
+            self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+            for stage, duration in parse_server_timing(server_timing).items():
+                self.stages.setdefault(stage, []).append(duration)
+
+
+def parse_server_timing(header):
+    stages = dict()
+    for metric in filter(None, (header or "").split(",")):
+        name, _, parameters = metric.strip().partition(";")
+        for parameter in parameters.split(";"):
+            key, _, value = parameter.strip().partition("=")
+            if key == "dur":
+                stages[name] = float(value)
+    return stages
+
+
+sessions = threading.local()
+
+#milliseconds from the arrival of the payment to its response, the token request included
+def send_payment(payment, arrival, recorder: Recorder):
+    session = getattr(sessions, "session", None)
+    if session is None:
+        session = sessions.session = requests.Session()
+    try:
+        token = session.get(f"{MAIN_SERVER}/token", params={"nonce": payment["nonce"]}).json()["token"]
+        request_json = {"payer": payment["payer"], "payee": payment["payee"], "amount": payment["amount"], "token": token, "webhook": "http://127.0.0.1:9000/v1"}
+        response = session.post(f"{MAIN_SERVER}/txn", json=request_json)
+        status_code, server_timing = response.status_code, response.headers.get("Server-Timing")
+    except requests.RequestException:
+        status_code, server_timing = "error", None
+    recorder.record(arrival, (time.monotonic() - arrival) * 1000, status_code, server_timing)
+
+
+def run_closed_loop(workload: Workload, recorder: Recorder, concurrency):
+    def client():
+        while time.monotonic() < recorder.measure_until:
+            send_payment(workload.next_payment(), time.monotonic(), recorder)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_open_loop(workload: Workload, recorder: Recorder, rate, max_in_flight):
+    arrivals = random.Random(workload.random.random())
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        arrival = time.monotonic()
+        while arrival < recorder.measure_until:
+            delay = arrival - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send_payment, workload.next_payment(), arrival, recorder)
+            arrival += arrivals.expovariate(rate)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarise(values):
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 0.50),
+        "p90": percentile(values, 0.90),
+        "p99": percentile(values, 0.99),
+        "p999": percentile(values, 0.999),
+        "max": values[-1] if values else None
+    }
+
+
+#counts of latencies per power of two of milliseconds
+def histogram(values):
+    bounds = [2 ** exponent for exponent in range(-2, 17)]
+    counts = [0] * (len(bounds) + 1)
+    for value in values:
+        counts[bisect.bisect_left(bounds, value)] += 1
+    return [{"le_ms": bound, "count": count} for bound, count in zip(bounds + [None], counts) if count]
+
+
+def get_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPOSITORY, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+#summaries of no values are None, for instance when every payment failed
+def format_ms(value):
+    return f"{value:.2f}" if value is not None else "n/a"
+
+
+def report(results, baseline=None):
+    latency = results["latency_ms"]
+    print(f"{results['completed']} payments in {results['duration']}s: {results['throughput']:.1f}/s, status codes {results['status_codes']}")
+    print(f"latency ms: p50 {format_ms(latency['p50'])}  p90 {format_ms(latency['p90'])}  p99 {format_ms(latency['p99'])}  max {format_ms(latency['max'])}")
+    for bucket in results["histogram"]:
+        bound = f"<= {bucket['le_ms']}" if bucket["le_ms"] is not None else "more"
+        print(f"  {bound:>10} ms  {bucket['count']}")
+    for stage, summary in results["stages"].items():
+        if summary["count"]:
+            print(f"  {stage:>10}: mean {format_ms(summary['mean'])}  p50 {format_ms(summary['p50'])}  p99 {format_ms(summary['p99'])} ms")
+
+    if baseline is not None:
+        print(f"against {baseline.get('version')}:")
+        changes = [("throughput", results["throughput"], baseline["throughput"])]
+        changes += [(f"latency {key}", latency[key], baseline["latency_ms"][key]) for key in ("p50", "p99")]
+        changes += [(f"{stage} p50", summary["p50"], baseline["stages"].get(stage, {}).get("p50")) for stage, summary in results["stages"].items()]
+        for name, value, previous in changes:
+            if value is not None and previous:
+                print(f"  {name:>16}: {previous:.2f} -> {value:.2f} ({(value - previous) / previous:+.1%})")
+
+
+def main():
+    args = set_up_parser().parse_args()
+    workload = Workload(args.payers, args.merchants, args.zipf, args.seed)
+    services = Services(workload, args.main, args.main_args, args.keep)
+    try:
+        start = time.monotonic()
+        recorder = Recorder(start + args.warmup, start + args.warmup + args.duration)
+        if args.mode == "closed":
+            run_closed_loop(workload, recorder, args.concurrency)
+        else:
+            run_open_loop(workload, recorder, args.rate, args.max_in_flight)
+    finally:
+        services.stop()
+
+    results = {
+        "version": get_version(),
+        "config": vars(args),
+        "duration": args.duration,
+        "completed": len(recorder.latencies),
+        "throughput": len(recorder.latencies) / args.duration,
+        "status_codes": {str(code): count for code, count in recorder.status_codes.items()},
+        "latency_ms": summarise(recorder.latencies),
+        "histogram": histogram(recorder.latencies),
+        "stages": {stage: summarise(durations) for stage, durations in recorder.stages.items()}
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
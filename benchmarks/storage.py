@@ -0,0 +1,223 @@
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+
+from pipeline import REPOSITORY, summarise, get_version
+
+'''
+Microbenchmarks of the storage of the Database, Issuer and merchant ledger
+
+For every store and size the store is pre-populated on disk, then loaded and written to in a fresh
+process, measuring
+- startup: seconds to load the pre-populated store
+- memory: resident memory added by the loaded store
+- latency: milliseconds per logical write (one transaction, one debit, one credit)
+- write amplification: bytes written to files per logical write, read from /proc/self/io
+
+Stores:
+- database_json: Database on the JsonFileEngine, which rewrites the whole file on every write
+- database_log: Database on the SegmentLogEngine
+- issuer: BalanceEngine and TransactionHistory of the Issuer
+- merchant: MerchantLedger
+
+    python benchmarks/storage.py -sizes 1000,100000,1000000 -output storage.json
+'''
+STORES = ["database_json", "database_log", "issuer", "merchant"]
+MERCHANTS = 1000
+
+
+def set_up_parser():
+    parser = argparse.ArgumentParser(description="storage microbenchmarks")
+    parser.add_argument("-stores", default=",".join(STORES), help="comma separated stores to benchmark")
+    parser.add_argument("-sizes", default="1000,100000,1000000", help="comma separated records pre-populated in every store")
+    parser.add_argument("-operations", type=int, default=1000, help="writes measured per store and size")
+    parser.add_argument("-max_seconds", type=float, default=30, help="writes stop after this many seconds even if fewer than -operations ran")
+    parser.add_argument("-output", help="file the results are written to as json")
+    parser.add_argument("-baseline", help="earlier results to compare against")
+    return parser
+
+
+def transaction_details(index):
+    return {"payer": f"{4000000000000000 + index % 100000}", "payee": f"{5000000000000000 + index % MERCHANTS}", "amount": 10.0, "timestamp": 1.7e9 + index}
+
+
+#writes a json object entry by entry, so pre-populating does not hold the whole store in memory
+def write_json_object(path, entries):
+    with open(path, "w") as file:
+        file.write("{")
+        for position, (key, value) in enumerate(entries):
+            file.write(("," if position else "") + json.dumps(key) + ":" + json.dumps(value))
+        file.write("}")
+
+
+def populate(store, size, directory):
+    from StorageEngine import SegmentLog, StorageEngine
+
+    match store:
+        case "database_json":
+            entries = ((f"{index}", {"details": transaction_details(index), "status": 4}) for index in range(size))
+            write_json_object(directory / "txn_database.json", itertools.chain([("last_modified", "new")], entries))
+        case "database_log":
+            log = SegmentLog(directory / "txn_log", fsync=False)
+            for start in range(0, size, 10000):
+                log.append([{**StorageEngine.transaction_record(f"{index}", transaction_details(index)), "status": 4} for index in range(start, min(size, start + 10000))])
+            log.close()
+        case "issuer":
+            users = ((f"{4000000000000000 + index}", {"balance": 10 ** 12, "transactions": []}) for index in range(size))
+            write_json_object(directory / "usr_database.json", itertools.chain([("last_modified", "new")], users))
+        case "merchant":
+            merchants = [f"{5000000000000000 + index}" for index in range(MERCHANTS)]
+            per_merchant = size // MERCHANTS
+            entries = ((merchant, {"balance": 0, "transaction": [[1.7e9, "4000000000000000", 10.0, f"{merchant}-{index}"] for index in range(per_merchant)]}) for merchant in merchants)
+            write_json_object(directory / "merchant_database.json", entries)
+
+
+def resident_bytes():
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def bytes_written():
+    try:
+        with open("/proc/self/io") as file:
+            for line in file:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def load(store, directory):
+    match store:
+        case "database_json":
+            from Database import Database
+            from StorageEngine import JsonFileEngine
+            database = Database(JsonFileEngine(str(directory / "txn_database.json")))
+            operation = lambda index: database.log_transaction("4000000000000000", "5000000000000000", 10.0, f"benchmark-{index}")
+            return operation, database.handle_shutdown
+        case "database_log":
+            from Database import Database
+            from StorageEngine import SegmentLogEngine
+            database = Database(SegmentLogEngine(str(directory / "txn_log"), compaction_interval=0))
+            operation = lambda index: database.log_transaction("4000000000000000", "5000000000000000", 10.0, f"benchmark-{index}")
+            return operation, database.handle_shutdown
+        case "issuer":
+            from BalanceEngine import BalanceEngine
+            with open(directory / "usr_database.json") as file:
+                users = json.load(file)
+            engine = BalanceEngine(users, str(directory / "usr_database.json"), str(directory / "usr_journal"), str(directory / "usr_history"))
+            del users
+            payers = list(engine.accounts)
+            operation = lambda index: engine.debit(payers[index % len(payers)], "5000000000000000", 1.0)
+            return operation, engine.close
+        case "merchant":
+            from MerchantLedger import MerchantLedger
+            ledger = MerchantLedger(str(directory / "merchant_database.json"), str(directory / "merchant_journal"))
+            merchants = list(ledger.merchants)
+            operation = lambda index: ledger.credit(f"benchmark-{index}", "4000000000000000", merchants[index % len(merchants)], 1.0)
+            return operation, ledger.close
+
+
+#runs in a fresh process so that memory and bytes written only count the store
+def measure(store, directory, operations, max_seconds, results):
+    os.chdir(directory)
+    sys.path.insert(0, str(REPOSITORY))
+    logging.disable(logging.WARNING)
+    #imported up front so that startup only counts loading the store
+    import Database, BalanceEngine, MerchantLedger
+
+    resident = resident_bytes()
+    start = time.perf_counter()
+    operation, close = load(store, directory)
+    startup = time.perf_counter() - start
+    memory = resident_bytes() - resident
+
+    latencies = []
+    written = bytes_written()
+    deadline = time.perf_counter() + max_seconds
+    for index in range(operations):
+        start = time.perf_counter()
+        operation(index)
+        latencies.append((time.perf_counter() - start) * 1000)
+        if time.perf_counter() > deadline:
+            break
+    if written is not None:
+        written = (bytes_written() - written) / len(latencies)
+    close()
+    results.put({"startup_s": startup, "memory_mb": memory / 2 ** 20, "latency_ms": summarise(latencies), "bytes_written_per_op": written})
+
+
+def populate_in_process(store, size, directory):
+    sys.path.insert(0, str(REPOSITORY))
+    populate(store, size, directory)
+
+
+def run_case(store, size, operations, max_seconds):
+    context = multiprocessing.get_context("spawn")
+    directory = pathlib.Path(tempfile.mkdtemp(prefix=f"storage-benchmark-{store}-"))
+    (directory / "logs").mkdir()
+    try:
+        process = context.Process(target=populate_in_process, args=(store, size, directory))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"pre-populating {store} with {size} records failed")
+        results = context.Queue()
+        process = context.Process(target=measure, args=(store, directory, operations, max_seconds, results))
+        process.start()
+        result = results.get()
+        process.join()
+        return result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def report(results, baseline=None):
+    print(f"{'store':>14} {'records':>9} {'startup s':>10} {'memory MB':>10} {'p50 ms':>8} {'p99 ms':>8} {'bytes/op':>12}")
+    for case in results["cases"]:
+        latency = case["latency_ms"]
+        written = f"{case['bytes_written_per_op']:.0f}" if case["bytes_written_per_op"] is not None else "-"
+        print(f"{case['store']:>14} {case['size']:>9} {case['startup_s']:>10.3f} {case['memory_mb']:>10.1f} {latency['p50']:>8.3f} {latency['p99']:>8.3f} {written:>12}")
+
+    if baseline is not None:
+        print(f"against {baseline.get('version')}:")
+        previous_cases = {(case["store"], case["size"]): case for case in baseline["cases"]}
+        for case in results["cases"]:
+            previous = previous_cases.get((case["store"], case["size"]))
+            if previous is None:
+                continue
+            changes = [("startup", case["startup_s"], previous["startup_s"]), ("p50", case["latency_ms"]["p50"], previous["latency_ms"]["p50"]),
+                       ("bytes/op", case["bytes_written_per_op"], previous["bytes_written_per_op"])]
+            print(f"  {case['store']} {case['size']}: " + ", ".join(f"{name} {(value - old) / old:+.1%}" for name, value, old in changes if value is not None and old))
+
+
+def main():
+    args = set_up_parser().parse_args()
+    cases = []
+    for store in args.stores.split(","):
+        for size in (int(size) for size in args.sizes.split(",")):
+            print(f"{store}: {size} records", file=sys.stderr)
+            cases.append({"store": store, "size": size, **run_case(store, size, args.operations, args.max_seconds)})
+
+    results = {"version": get_version(), "config": vars(args), "cases": cases}
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
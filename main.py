@@ -1,9 +1,5 @@
 from flask import Flask, request
 import sys
-from collections import defaultdict, deque
-from concurrent.futures import ThreadPoolExecutor
-import requests
-import argparse
 import logging
 import threading
 import signal
@@ -11,8 +7,19 @@ import signal
 from Event import * 
 from EventSubscriber import *
 from Backend import *
-from CustomExceptions import LoggingTransactionError, LoggingTransactionStatusError
+from CustomExceptions import LoggingTransactionError, IdempotencyKeyReuseError
 from RetryQueue import RetryQueue
+from EventQueue import EventQueue
+from EventLog import EventLog
+from EventWorkers import EventWorkerPool
+from IdempotencyCache import IdempotencyCache
+from TransactionCache import transaction_cache
+from Metrics import instrument_app
+from Tracing import configure_tracing, close_tracing, trace_app
+from StructuredLogging import configure_logging
+from Router import ShardRouter
+from ServiceClient import http_get, http_post, configure_clients, close_clients
+from MainService import EventBroker, set_up_parser, register_component_metrics
 
 #read up more on usage of logger
 
@@ -30,30 +37,24 @@ Rough payment workflow
 5. releasing funds to business 
 '''
 logger = logging.getLogger()
-logging.basicConfig(filename='logs/api_logs.txt', level=logging.INFO)
+configure_logging("logs/api_logs.jsonl", service="main")
 
 def set_shutdown_event(signum, frame):
     logger.info(f"Received signal {signum}, initiating graceful shutdown...")
     shutdown_event.set()
     raise KeyboardInterrupt
 
-def set_up_parser():
-    parser = argparse.ArgumentParser(
-                    prog="payment api",
-                    description="A simple payment api program using microservices and EDA",
-                    epilog="...")
-    parser.add_argument("-database_server", help="url of database server")
-    parser.add_argument("-issuer_server", help="url of issuer server")
-    return parser
-
 def check_database_availability():
-    response = requests.get(f"{database_server}/status")
-    if response.status_code == 200:
-        return StatusCode.SUCCESS
-    return StatusCode.FAILURE
+    for database_server in router.servers():
+        response = http_get(f"{database_server}/status")
+        if response.status_code != 200:
+            return StatusCode.FAILURE
+    return StatusCode.SUCCESS
 
 #endpoint setup
 app = Flask(__name__)
+instrument_app(app)
+trace_app(app, start_traces=True)
 @app.route("/v1/status", methods=["GET"])
 def get_server_status():
     return {"status": "running"}, 200
@@ -64,6 +65,7 @@ def compute_transaction_token():
     token = compute_token(nonce)
     return {"message": "Token successfully registered", "token":token}, 200
 
+#a retried request with the same token gets the response of the first one instead of paying again
 @app.route("/v1/txn", methods=["POST"])
 def create_transaction():
     info = request.get_json()
@@ -71,6 +73,22 @@ def create_transaction():
     amount = float(info["amount"])
     token = info["token"]
     webhook = info["webhook"]
+    try:
+        response, replayed = idempotency_cache.execute(
+            token,
+            [payer, payee, amount],
+            lambda: process_transaction(payer, payee, amount, token, webhook),
+            #without a transaction id nothing was recorded, the request can be run again
+            cacheable=lambda response: response[0]["transaction_id"] is not None
+        )
+    except IdempotencyKeyReuseError as e:
+        return {"message": f"{e}", "transaction_id": None, "details": None}, 422
+    if replayed:
+        return response[0], response[1], {"Idempotent-Replayed": "true"}
+    return response
+
+def process_transaction(payer, payee, amount, token, webhook):
+    timer = StageTimer()
     #synchronous critical path, asynchronous side effects
     transaction_json = {
         "payer": payer,
@@ -81,26 +99,30 @@ def create_transaction():
 
     #logging transaction with retries
     transaction_id = None
-    for retry_attempt in range(3):
-        try:
-            response = requests.post(f'{database_server}/txn', json=transaction_json)
-            if (response.status_code == 200):
-                transaction_id = response.json()["transaction_id"]
-                break
-            else:
-                raise LoggingTransactionError
-        except Exception as e:
-            logger.warning(f"Attempt {retry_attempt + 1}: Error logging transaction in database: {e}")
-            if retry_attempt != 2: 
-                delay = random.randint(0, 2 ** (retry_attempt + 1))
-                logger.warning(f"Delaying for {delay} seconds before retrying")
-                time.sleep(delay)
-            else:
-                logger.warning(f"All attempts at logging transaction failed.")
+    with router.writing([token]) as ring:
+        database_server = ring.get_server(token)
+        for retry_attempt in range(3):
+            try:
+                response = http_post(f'{database_server}/txn', json=transaction_json)
+                if (response.status_code == 200):
+                    transaction_id = response.json()["transaction_id"]
+                    break
+                else:
+                    raise LoggingTransactionError
+            except Exception as e:
+                logger.warning(f"Attempt {retry_attempt + 1}: Error logging transaction in database: {e}")
+                if retry_attempt != 2: 
+                    count_retry("insert")
+                    delay = random.randint(0, 2 ** (retry_attempt + 1))
+                    logger.warning(f"Delaying for {delay} seconds before retrying")
+                    time.sleep(delay)
+                else:
+                    logger.warning(f"All attempts at logging transaction failed.")
 
+    timer.mark("insert")
     if transaction_id == None:
         logger.warning(f"{time.time()}: Error creating transaction. Details: payer:{payer}, payee:{payee}, amount:{amount}, token:{token}")
-        return {"message": "Failure creating transaction, please try again later", "transaction_id":None, "details":None}, 500
+        return {"message": "Failure creating transaction, please try again later", "transaction_id":None, "details":None}, 500, timer.headers()
 
 
     http_response = {
@@ -113,170 +135,108 @@ def create_transaction():
             "token": token
         }
     }
-    broker.publish_event(CreatedEvent(transaction_id))
+    #snapshot carried by the events, so subscribers do not fetch the transaction back from the database
+    details = snapshot(http_response["details"])
+    broker.publish_event(CreatedEvent(transaction_id, details))
+    timer.mark("publish")
         
     #verify transaction
     status = verify_transaction(payer, payee, amount)
+    timer.mark("verify")
     if status == StatusCode.FAILURE:
-        broker.publish_event(RejectedEvent(transaction_id))
+        broker.publish_event(RejectedEvent(transaction_id, details))
         http_response["message"] = "transaction verification error"
-        return http_response, 500
+        return http_response, 500, timer.headers()
         
-    broker.publish_event(VerifiedEvent(transaction_id))
+    broker.publish_event(VerifiedEvent(transaction_id, details))
+    timer.mark("publish")
 
         
     #check for fraud
     status = check_fraud(payer, payee, amount)
+    timer.mark("fraud")
     if status == StatusCode.FAILURE:
-        broker.publish_event(RejectedEvent(transaction_id))
+        broker.publish_event(RejectedEvent(transaction_id, details))
         http_response["message"] = "transaction fraud error"
-        return http_response, 500
+        return http_response, 500, timer.headers()
 
-    broker.publish_event(CheckedEvent(transaction_id))
+    broker.publish_event(CheckedEvent(transaction_id, details))
+    timer.mark("publish")
 
     #get authorisation from issuer
     status = get_authorisation(payer, payee, amount, issuer_server)
+    timer.mark("authorise")
     if status == StatusCode.FAILURE:
-        broker.publish_event(RejectedEvent(transaction_id))
+        broker.publish_event(RejectedEvent(transaction_id, details))
         http_response["message"] = "transaction authorisation error"
-        return http_response, 500 
+        return http_response, 500, timer.headers()
         
-    broker.publish_event(AuthorisedEvent(transaction_id))
+    broker.publish_event(AuthorisedEvent(transaction_id, details))
+    timer.mark("publish")
         
     #update merchant's account
     status = fulfill_transaction(transaction_id, payer, payee, amount)
+    timer.mark("fulfill")
     if status == StatusCode.FAILURE:
-        broker.publish_event(RejectedEvent(transaction_id))
+        broker.publish_event(RejectedEvent(transaction_id, details))
         http_response["message"] = "transaction fulfillment incomplete"
         retry_queue.enqueue(transaction_id=transaction_id, webhook=webhook)
-        return http_response, 202
-    broker.publish_event(FulfilledEvent(transaction_id))
+        return http_response, 202, timer.headers()
+    broker.publish_event(FulfilledEvent(transaction_id, details))
+    timer.mark("publish")
 
     http_response["message"] = "transaction completed"
-    return http_response, 200
+    return http_response, 200, timer.headers()
         
 
 @app.route("/v1/txn", methods=["GET"])
 def get_transaction_details():
     transaction_id= request.args.get("transaction_id")
-    param_json = {"transaction_id": transaction_id}
     try:
-        response = requests.get(f"{database_server}/txn", params=param_json)
-        if response.status_code == 200:
-            return response.json()["details"], 200
+        details = transaction_cache.get(router, transaction_id)
+        if details is not None:
+            return details, 200
         else:
-            raise Exception
+            raise LookupError("transaction_id not found")
     except Exception as e:
         return {"message": f"Error getting transaction details {e}"}, 500    
 
-#EventBroker
-class EventBroker:
-    executor = ThreadPoolExecutor(max_workers=4)
-    subscribers = defaultdict(list)
-    event_queue: deque[Event] = deque()
-
-    @classmethod
-    def initialise_event_queue(cls):
-        try:
-            with open("databases/event_queue.json") as file:
-                events = json.load(file)
-                for event in events:
-                    match event["status"]:
-                        case 0:
-                            cls.publish_event(CreatedEvent(event["id"]))
-                        case 1:
-                            cls.publish_event(VerifiedEvent(event["id"]))
-                        case 2:
-                            cls.publish_event(CheckedEvent(event["id"]))
-                        case 3:
-                            cls.publish_event(AuthorisedEvent(event["id"]))
-                        case 4:
-                            cls.publish_event(FulfilledEvent(event["id"]))
-                        case 5:
-                            cls.publish_event(RejectedEvent(event["id"]))
-                        case _:
-                            cls.publish_event(TerminatedEvent(event["id"]))
-        except Exception as e:
-            logger.critical("Historial events not loaded")
-        else:
-            logger.info("Historial events loaded")
-    
-    @classmethod
-    def subscribe_to_event(cls, status: TransactionStatus, subscriber: EventSubscriber):
-        try:
-            if not isinstance(status, TransactionStatus):
-                raise TypeError(f"event_type {status} must implement TransactionStatus")
-            if not isinstance(subscriber, EventSubscriber):
-                raise TypeError(f"subscriber {subscriber} must implement EventSubscriber")
-        except TypeError as e:
-            logger.fatal("{time.time()}: Invalid type found in event subscription. {e}")
-            raise
-        else:
-            cls.subscribers[status].append(subscriber)
+@app.route("/v1/shards", methods=["GET"])
+def get_shards():
+    return {"shards": router.servers()}, 200
 
-    @classmethod
-    def publish_event(cls, event):
-        if not isinstance(event, Event):
-            logger.error(f"{time.time()}: event {event} does not implement Event")
-            cls.event_queue.append(TerminatedEvent(event.get_transaction_id()))
-        else:
-            cls.event_queue.append(event)
-    
-    @classmethod
-    def log_status(self, transaction_id, status):
-        request_json = {"transaction_id": transaction_id, "status": status}
-        for retry_attempt in range(3):
-            try:
-                response = requests.post(f"{database_server}/txn_status", json=request_json)
-                if response.status_code == 200:
-                    break
-                else: 
-                    raise LoggingTransactionStatusError
-            except Exception as e:
-                logger.warning(f"Attempt {retry_attempt + 1}: Error logging transaction ({transaction_id}) in database: {e}")
-                if retry_attempt != 2: 
-                    delay = random.randint(0, 2 ** (retry_attempt + 1))
-                    logger.warning(f"Delaying for {delay} seconds before retrying")
-                    time.sleep(delay)
-                else:
-                    logger.warning(f"All attempts at logging transaction failed.")
-    
-    @classmethod
-    def handle_shutdown(cls):
-        if cls.event_queue:
-            queue = []
-            while cls.event_queue:
-                    event = cls.event_queue.popleft()
-                    queue.append(event.to_string())
-            try:
-                with open("databases/event_queue.json") as file:
-                    json.dump(queue, file, indent=4)
-            except Exception as e:
-                logger.critical(f"Error flushing events to database")
-            else:
-                logger.info("Events flushed to database")
-
-        else:
-            logger.info("Event queue is empty. No data is flushed")
-    
-    @classmethod
-    def run(cls, shutdown_event):
-        while not shutdown_event.is_set():
-            if len(cls.event_queue) != 0:
-                event = cls.event_queue.popleft()
-                status = event.get_status()
-                transaction_id = event.get_transaction_id()
-                cls.log_status(transaction_id, status)
-            
-                #handle event
-                if status in cls.subscribers:
-                    for subscriber in cls.subscribers[status]:
-                        future = cls.executor.submit(subscriber.handle_event, database_server, transaction_id) 
-                        if future.result() == StatusCode.FAILURE:
-                            logger.error(f"{time.time()}: {subscriber} failed handling transaction {transaction_id} with status{status}")
-                            cls.publish_event(TerminatedEvent(transaction_id))
-        cls.handle_shutdown()
-                    
+#adds a database shard and moves its share of the transactions onto it
+@app.route("/v1/shards", methods=["POST"])
+def add_shard():
+    server = f'{request.get_json()["server"]}/v1'
+    try:
+        response = http_get(f"{server}/status")
+        if response.status_code != 200:
+            raise ConnectionError(f"shard status {response.status_code}")
+        moved = router.add_shard(server)
+        if isinstance(EventBroker.dispatcher, EventWorkerPool):
+            EventBroker.dispatcher.set_database_servers(router.servers())
+    except Exception as e:
+        logger.error(f"{time.time()}: Error adding shard {server}: {e}")
+        return {"message": f"Error adding shard {e}", "shards": router.servers()}, 500
+    return {"message": f"Shard added, {moved} transactions moved", "shards": router.servers()}, 200
+
+#resizes the pool of event worker processes, partitions move onto new workers once their events in flight are done
+@app.route("/v1/events/workers", methods=["POST"])
+def resize_event_workers():
+    workers = int(request.get_json()["workers"])
+    if workers < 1:
+        return {"message": "at least one event worker is needed"}, 400
+    if not isinstance(EventBroker.dispatcher, EventWorkerPool):
+        return {"message": "event subscribers run in the main process, start it with -event_workers to resize them"}, 409
+    EventBroker.dispatcher.resize(workers)
+    return {"message": f"Event workers resized to {workers}", "workers": workers}, 200
+
+@app.route("/v1/events", methods=["GET"])
+def get_event_queue_metrics():
+    dispatcher = EventBroker.dispatcher.get_metrics() if EventBroker.dispatcher else None
+    event_log = EventBroker.event_log.get_metrics() if EventBroker.event_log else None
+    return {"queue": EventBroker.event_queue.get_metrics(), "dispatcher": dispatcher, "log": event_log}, 200
 
 if __name__ == "__main__":
     #graceful shutdown mechanism
@@ -287,8 +247,12 @@ if __name__ == "__main__":
     #set up argparser
     parser = set_up_parser()
     args = parser.parse_args()
-    database_server = f"{args.database_server}/v1"
+    router = ShardRouter([f"{database_server}/v1" for database_server in args.database_server.split(",")])
     issuer_server = f"{args.issuer_server}/v1"
+    configure_clients(max_connections=args.pool_size, default_timeout=args.http_timeout)
+    transaction_cache.configure(capacity=args.transaction_cache_size, negative_ttl=args.transaction_cache_negative_ttl)
+    configure_authorisation_batching(window=args.authorisation_batch_window_ms / 1000, max_batch=args.authorisation_batch_size, pipeline_depth=args.authorisation_pipeline_depth)
+    configure_tracing(service_name="main", rate=args.trace_sample_rate, path=args.trace_file)
 
     #check database availability
     status = check_database_availability()
@@ -298,12 +262,23 @@ if __name__ == "__main__":
 
     #set up event broker
     broker = EventBroker()
+    EventBroker.database_router = router
+    EventBroker.event_queue = EventQueue(args.event_queue_size)
+    EventBroker.event_log = EventLog(args.event_log_directory)
+    EventBroker.event_workers = args.event_workers
+    EventBroker.event_partitions = args.event_partitions
+    EventBroker.subscriber_workers = args.subscriber_workers
+    EventBroker.subscriber_concurrency = args.subscriber_concurrency
+    EventBroker.subscriber_timeout = args.subscriber_timeout
     broker.subscribe_to_event(TransactionStatus.FULFILLED, EmailSubscriber())
     broker.subscribe_to_event(TransactionStatus.REJECTED,  AnalyticsSubscriber())
     broker.subscribe_to_event(TransactionStatus.TERMINATED, SupportSubscriber())
 
+    idempotency_cache = IdempotencyCache(capacity=args.idempotency_cache_size, ttl=args.idempotency_ttl)
+
     #set up retry queue
-    retry_queue = RetryQueue(database_server, broker)
+    retry_queue = RetryQueue(router, broker, workers=args.retry_workers, max_attempts=args.retry_max_attempts)
+    register_component_metrics(retry_queue, idempotency_cache)
 
     broker_thread = threading.Thread(target=broker.run, args=(shutdown_event, ))
     retry_thread = threading.Thread(target=retry_queue.run, args=(shutdown_event, ))
@@ -319,6 +294,11 @@ if __name__ == "__main__":
         logger.info("Waiting for threads to finish...")
         broker_thread.join(timeout=10)
         retry_thread.join(timeout=10)
+        close_authorisation_batchers()
+        idempotency_cache.close()
+        close_merchant_ledger()
+        close_clients()
+        close_tracing()
         logger.info("Shutdown complete")
 
 
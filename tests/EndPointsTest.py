@@ -1,5 +1,6 @@
 import requests 
 import time
+import json
 import random
 import os
 import sys
@@ -9,9 +10,9 @@ from Database import *
 from Event import TransactionStatus 
 from Issuer import *
 
-NUM_DATABASE_ENDPOINTS = 4
-NUM_ISSUER_ENDPOINTS = 3
-NUM_MAIN_ENDPOINTS = 4
+NUM_DATABASE_ENDPOINTS = 12
+NUM_ISSUER_ENDPOINTS = 6
+NUM_MAIN_ENDPOINTS = 8
 
 class DatabaseTest:
     database_server = "http://127.0.0.1:8001/v1"
@@ -50,11 +51,88 @@ class DatabaseTest:
         response = requests.post(f"{self.database_server}/txn_status", json=request_json)
         assert response.status_code == 200
     
+    def log_transactions_batch(self):
+        request_json = {
+            "transactions": [
+                {
+                    "payer": "0000111122223333", 
+                    "payee": "0000222233331111",
+                    "amount": 10, 
+                    "token": f"{int(time.time()) + random.randint(0, 10 ** 10)}"
+                } for _ in range(3)
+            ]
+        }
+        request_json["transactions"].append(request_json["transactions"][0])
+        response = requests.post(f"{self.database_server}/txn:batch", json=request_json)
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [result["transaction_id"] != None for result in results] == [True, True, True, False]
+        return [result["transaction_id"] for result in results[:3]]
+
+    def log_transaction_statuses_batch(self):
+        transaction_ids = self.log_transactions_batch()
+        request_json = {
+            "updates": [{"transaction_id": transaction_id, "status": TransactionStatus.FULFILLED} for transaction_id in transaction_ids]
+        }
+        request_json["updates"].append({"transaction_id": "missing", "status": TransactionStatus.FULFILLED})
+        response = requests.post(f"{self.database_server}/txn_status:batch", json=request_json)
+        assert response.status_code == 200
+        assert [result["logged"] for result in response.json()["results"]] == [True, True, True, False]
+    
+    def query_transactions(self):
+        since = time.time()
+        transaction_ids = self.log_transactions_batch()
+        param_json = {"payee": "0000222233331111", "since": since, "limit": 2}
+        response = requests.get(f"{self.database_server}/txn", params=param_json)
+        assert response.status_code == 200
+        first_page = response.json()
+        assert [txn["transaction_id"] for txn in first_page["transactions"]] == transaction_ids[:2]
+
+        param_json["cursor"] = first_page["next_cursor"]
+        response = requests.get(f"{self.database_server}/txn", params=param_json)
+        assert response.status_code == 200
+        assert [txn["transaction_id"] for txn in response.json()["transactions"]] == transaction_ids[2:]
+        assert response.json()["next_cursor"] == None
+
+    def move_transactions(self):
+        transaction_id = self.log_transaction()
+        #an arc from a point back to itself covers the whole ring
+        param_json = {"ranges": "0-0", "limit": 10 ** 6}
+        response = requests.get(f"{self.database_server}/txn:export", params=param_json)
+        assert response.status_code == 200
+        exported = [txn for txn in response.json()["transactions"] if txn["transaction_id"] == transaction_id]
+        assert len(exported) == 1
+
+        response = requests.post(f"{self.database_server}/txn:export", json={"transaction_ids": [transaction_id, "unknown"]})
+        assert response.status_code == 200
+        assert response.json()["transactions"] == exported
+
+        response = requests.post(f"{self.database_server}/txn:delete", json={"transaction_ids": [transaction_id]})
+        assert response.status_code == 200
+        response = requests.get(f"{self.database_server}/txn", params={"transaction_id": transaction_id})
+        assert response.status_code == 500
+
+        response = requests.post(f"{self.database_server}/txn:import", json={"transactions": exported})
+        assert response.status_code == 200
+        response = requests.get(f"{self.database_server}/txn", params={"transaction_id": transaction_id})
+        assert response.status_code == 200
+
+    def get_metrics(self):
+        response = requests.get(f"{self.database_server}/metrics")
+        assert response.status_code == 200
+        assert 'http_server_request_seconds_count{endpoint="/v1/txn",method="POST",status="200"}' in response.text
+        assert "group_commit_batch_records_bucket" in response.text
+
     def run(self):
         self.get_database_status()
         self.log_transaction()
         self.get_transaction_details()
         self.log_transaction_status()
+        self.log_transactions_batch()
+        self.log_transaction_statuses_batch()
+        self.query_transactions()
+        self.move_transactions()
+        self.get_metrics()
         print(f"{NUM_DATABASE_ENDPOINTS} endpoints in Database are working")
 
 class IssuerTest:
@@ -77,11 +155,36 @@ class IssuerTest:
         }
         response = requests.post(f"{self.server}/txn", json=request_json)
         assert response.status_code == 200
+
+    def create_transactions_batch(self):
+        request_json = {"transactions": [
+            {"payer": "0000111122223333", "payee": "0000222233331111", "amount": 10},
+            {"payer": "0000111122223333", "payee": "0000222233331111", "amount": 10 ** 9}
+        ]}
+        response = requests.post(f"{self.server}/txn:batch", json=request_json)
+        assert response.status_code == 200
+        assert [result["authorised"] for result in response.json()["results"]] == [True, False]
+
+    def get_user_transactions(self):
+        param_json = {"user": "0000111122223333", "limit": 1}
+        response = requests.get(f"{self.server}/user/txn", params=param_json)
+        assert response.status_code == 200
+        assert len(response.json()["transactions"]) == 1
+        assert response.json()["transactions"][0]["payee"] == "0000222233331111"
+        assert response.json()["next_cursor"] == 1
+
+    def get_metrics(self):
+        response = requests.get(f"{self.server}/metrics")
+        assert response.status_code == 200
+        assert 'issuer_authorisations_total{outcome="rejected"}' in response.text
     
     def run(self):
         self.get_status()
         self.create_user()
         self.create_transaction()
+        self.create_transactions_batch()
+        self.get_user_transactions()
+        self.get_metrics()
         print(f"{NUM_ISSUER_ENDPOINTS} endpoints in Issuer are working")
 
 
@@ -113,6 +216,38 @@ class MainTest:
         assert response.status_code == 200
         return response.json()["transaction_id"]
     
+    def replay_transaction(self):
+        token = self.compute_transaction_token()
+        request_json = {
+            "payer": "0000111122223333", 
+            "payee": "0000222233331111",
+            "amount": 10,
+            "token": token,
+            "webhook": "http://127.0.0.1:9000/v1"
+        }
+        first = requests.post(f"{self.server}/txn", json=request_json)
+        replay = requests.post(f"{self.server}/txn", json=request_json)
+        assert replay.status_code == first.status_code
+        assert replay.json()["transaction_id"] == first.json()["transaction_id"]
+        assert replay.headers["Idempotent-Replayed"] == "true"
+
+    #the caller's sampled trace is continued by main and the database
+    def trace_transaction(self):
+        trace_id = f"{random.getrandbits(128):032x}"
+        request_json = {
+            "payer": "0000111122223333", 
+            "payee": "0000222233331111",
+            "amount": 10,
+            "token": self.compute_transaction_token(),
+            "webhook": "http://127.0.0.1:9000/v1"
+        }
+        response = requests.post(f"{self.server}/txn", json=request_json, headers={"traceparent": f"00-{trace_id}-{random.getrandbits(64):016x}-01"})
+        assert response.status_code == 200
+        time.sleep(0.5)
+        with open("logs/traces.jsonl") as file:
+            services = {span["sv"] for span in map(json.loads, file) if span["t"] == trace_id}
+        assert {"main", "database:8001", "issuer"} <= services
+
     def get_transaction(self):
         transaction_id = self.create_transaction()
         param_json = {"transaction_id": transaction_id}
@@ -123,11 +258,46 @@ class MainTest:
         assert response.json()["amount"] == 10
     
 
+    def get_shards(self):
+        response = requests.get(f"{self.server}/shards")
+        assert response.status_code == 200
+        assert len(response.json()["shards"]) >= 1
+
+    def get_event_queue_metrics(self):
+        response = requests.get(f"{self.server}/events")
+        assert response.status_code == 200
+        assert response.json()["queue"]["depth"] <= response.json()["queue"]["capacity"]
+        assert response.json()["dispatcher"] is not None
+        assert response.json()["log"]["unacknowledged"] >= 0
+
+    #only worker processes can be resized, subscribers running in the main process are refused
+    def resize_event_workers(self):
+        response = requests.post(f"{self.server}/events/workers", json={"workers": 0})
+        assert response.status_code == 400
+        response = requests.post(f"{self.server}/events/workers", json={"workers": 2})
+        assert response.status_code in (200, 409)
+        if response.status_code == 200:
+            workers = requests.get(f"{self.server}/events").json()["dispatcher"]["workers"]
+            assert sum(not worker["leaving"] for worker in workers.values()) == 2
+
+    def get_metrics(self):
+        response = requests.get(f"{self.server}/metrics")
+        assert response.status_code == 200
+        assert 'payment_stage_seconds_count{stage="authorise"}' in response.text
+        assert "http_client_request_seconds_bucket" in response.text
+        assert "event_queue_depth" in response.text
+
     def run(self):
         self.get_status()
+        self.get_shards()
         self.compute_transaction_token()
         self.create_transaction()
         self.get_transaction()
+        self.replay_transaction()
+        self.trace_transaction()
+        self.get_event_queue_metrics()
+        self.resize_event_workers()
+        self.get_metrics()
         print(f"{NUM_MAIN_ENDPOINTS} endpoints in main are working")
 
 if __name__ == "__main__":